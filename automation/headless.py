@@ -0,0 +1,593 @@
+# Copyright (c) 2017-2018 by Christian Schnidrig.
+
+# Headless stand-in for the openHAB jsr223 runtime.
+#
+# Runs shutters.py outside of openHAB (plain jython or cpython): items,
+# events and the automation manager are simulated in-process and
+# sendCommand/postUpdate are applied synchronously. Java classes that are
+# not on the classpath (slf4j, quartz, snakeyaml, ...) are replaced by
+# small python equivalents.
+#
+# usage:
+#   python headless.py test
+#   python headless.py bench [--geometry] [--update-baseline]
+#   python headless.py simulate 2018
+#
+# Don't install this file in the jsr223 folder, openHAB would load it as a script.
+
+import sys
+import os
+import re
+import time
+import types
+import logging
+import argparse
+import datetime
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+
+#######################################################
+#######################################################
+#######################################################
+# java replacements
+
+def _installModule(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    parts = name.split('.')
+    for i in range(1, len(parts)):
+        parent = '.'.join(parts[:i])
+        if parent not in sys.modules:
+            sys.modules[parent] = types.ModuleType(parent)
+    sys.modules[name] = module
+    return module
+
+def _importable(name):
+    try:
+        __import__(name)
+        return True
+    except ImportError:
+        return False
+
+class LoggerFactory(object):
+    @staticmethod
+    def getLogger(name):
+        logger = logging.getLogger(name)
+        if not hasattr(logger, 'warn'):
+            logger.warn = logger.warning
+        return logger
+
+class Date(object):
+    def __init__(self, ms=None):
+        self.ms = int(time.time() * 1000) if ms == None else int(ms)
+
+    def getTime(self):
+        return self.ms
+
+    def before(self, other):
+        return self.ms < other.ms
+
+    def after(self, other):
+        return self.ms > other.ms
+
+    def toString(self):
+        return time.ctime(self.ms / 1000.0)
+
+    __str__ = toString
+
+class Locale(object):
+    GERMAN = 'de'
+
+class _GermanShortDateFormat(object):
+    def parse(self, text):
+        day, month, year = [int(x) for x in text.strip().split('.')]
+        if year < 100:
+            year += 2000
+        return Date(time.mktime((year, month, day, 0, 0, 0, 0, 0, -1)) * 1000)
+
+class DateFormat(object):
+    SHORT = 3
+
+    @staticmethod
+    def getDateInstance(style, locale):
+        return _GermanShortDateFormat()
+
+class InterruptedException(Exception):
+    pass
+
+_weekdays = {'SUN': 1, 'MON': 2, 'TUE': 3, 'WED': 4, 'THU': 5, 'FRI': 6, 'SAT': 7}
+_months = {'JAN': 1, 'FEB': 2, 'MAR': 3, 'APR': 4, 'MAY': 5, 'JUN': 6,
+           'JUL': 7, 'AUG': 8, 'SEP': 9, 'OCT': 10, 'NOV': 11, 'DEC': 12}
+
+def _cronField(text, low, high, names=None):
+    if text in ('*', '?'):
+        return None
+    values = set()
+    for part in text.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/')
+            step = int(step)
+        value = lambda x: names[x] if names != None and x in names else int(x)
+        if part == '*':
+            first, last = low, high
+        elif '-' in part:
+            first, last = [value(x) for x in part.split('-')]
+        else:
+            first = value(part)
+            last = first if step == 1 else high
+        values.update(range(first, last + 1, step))
+    return values
+
+# subset of org.quartz.CronExpression: lists, ranges, steps and names; no L, W, #
+class CronExpression(object):
+    def __init__(self, expression):
+        fields = expression.split()
+        self.expression = expression
+        self.seconds = _cronField(fields[0], 0, 59)
+        self.minutes = _cronField(fields[1], 0, 59)
+        self.hours = _cronField(fields[2], 0, 23)
+        self.days = _cronField(fields[3], 1, 31)
+        self.months = _cronField(fields[4], 1, 12, _months)
+        self.weekdays = _cronField(fields[5], 1, 7, _weekdays)
+        self.years = _cronField(fields[6], 1970, 2199) if len(fields) > 6 else None
+
+    def _matchesDay(self, t):
+        lt = time.localtime(t)
+        weekday = (lt.tm_wday + 1) % 7 + 1
+        return ((self.days == None or lt.tm_mday in self.days)
+                and (self.months == None or lt.tm_mon in self.months)
+                and (self.weekdays == None or weekday in self.weekdays)
+                and (self.years == None or lt.tm_year in self.years))
+
+    def _matches(self, t):
+        lt = time.localtime(t)
+        return ((self.seconds == None or lt.tm_sec in self.seconds)
+                and (self.minutes == None or lt.tm_min in self.minutes)
+                and (self.hours == None or lt.tm_hour in self.hours)
+                and self._matchesDay(t))
+
+    def isSatisfiedBy(self, date):
+        return self._matches(date.getTime() // 1000)
+
+    def getNextValidTimeAfter(self, date):
+        t = date.getTime() // 1000 + 1
+        end = t + 366 * 86400 * 5
+        while t < end:
+            lt = time.localtime(t)
+            if not self._matchesDay(t):
+                t += 86400 - lt.tm_hour * 3600 - lt.tm_min * 60 - lt.tm_sec
+            elif self.hours != None and lt.tm_hour not in self.hours:
+                t += 3600 - lt.tm_min * 60 - lt.tm_sec
+            elif self.minutes != None and lt.tm_min not in self.minutes:
+                t += 60 - lt.tm_sec
+            elif self._matches(t):
+                return Date(t * 1000)
+            else:
+                t += 1
+        return None
+
+class _YamlMap(dict):
+    # snakeyaml returns java maps: keys() is indexable under jython
+    def keys(self):
+        return list(dict.keys(self))
+
+def _yamlConvert(value):
+    if isinstance(value, dict):
+        return _YamlMap([(k, _yamlConvert(v)) for k, v in value.items()])
+    if isinstance(value, list):
+        return [_yamlConvert(v) for v in value]
+    return value
+
+class Yaml(object):
+    def load(self, source):
+        import yaml
+        if not isinstance(source, str):
+            source = source.read()
+        return _yamlConvert(yaml.safe_load(source))
+
+class _Unavailable(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        raise RuntimeError(self.name + " is not available in the headless runtime")
+
+def installJavaReplacements():
+    # logging always goes through python's logging module
+    _installModule('org.slf4j', LoggerFactory=LoggerFactory)
+    if not _importable('java.util'):
+        _installModule('java.util', Date=Date, Locale=Locale)
+        _installModule('java.text', DateFormat=DateFormat)
+        _installModule('java.lang', InterruptedException=InterruptedException)
+        _installModule('java.util.concurrent', TimeUnit=_Unavailable('TimeUnit'))
+        _installModule('java.nio.file', FileSystems=_Unavailable('FileSystems'),
+                       WatchService=_Unavailable('WatchService'), Path=_Unavailable('Path'),
+                       StandardWatchEventKinds=_Unavailable('StandardWatchEventKinds'))
+    if not _importable('org.quartz'):
+        _installModule('org.quartz', CronExpression=CronExpression)
+    if not _importable('org.yaml.snakeyaml'):
+        _installModule('org.yaml.snakeyaml', Yaml=Yaml)
+
+#######################################################
+#######################################################
+#######################################################
+# openHAB replacements
+
+class State(str):
+    def toString(self):
+        return str(self)
+
+class ItemStateEvent(object):
+    def __init__(self, itemName, state):
+        self.itemName = itemName
+        self.state = state
+
+    def getItemName(self):
+        return self.itemName
+
+    def getItemState(self):
+        return self.state
+
+class Item(object):
+    def __init__(self, name, itemType):
+        self.name = name
+        self.type = itemType
+        self.state = State("NULL")
+
+    def getName(self):
+        return self.name
+
+    def getType(self):
+        return self.type
+
+    def getState(self):
+        return self.state
+
+class ItemRegistry(object):
+    def __init__(self):
+        self.items = {}
+
+    def get(self, name):
+        return self.items.get(name)
+
+    def getItems(self):
+        return list(self.items.values())
+
+    def add(self, name, itemType="String"):
+        item = Item(name, itemType)
+        self.items[name] = item
+        return item
+
+    # reads the item definitions of *.items files (name and type only)
+    def loadItemsDir(self, directory):
+        pattern = re.compile(r'^\s*([A-Za-z]+)(?::[^\s]+)?\s+([A-Za-z_][A-Za-z0-9_]*)')
+        for fileName in sorted(os.listdir(directory)):
+            if not fileName.endswith('.items'):
+                continue
+            for line in open(os.path.join(directory, fileName)):
+                line = line.split('//')[0]
+                match = pattern.match(line)
+                if match != None and match.group(1) != 'Group':
+                    self.add(match.group(2), match.group(1))
+
+class Events(object):
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self.commands = []
+
+    def postUpdate(self, itemName, state):
+        item = self.runtime.ir.get(str(itemName))
+        if item == None:
+            raise KeyError("Item not found: " + str(itemName))
+        self._setState(item, str(state))
+
+    def sendCommand(self, itemName, command):
+        item = self.runtime.ir.get(str(itemName))
+        if item == None:
+            raise KeyError("Item not found: " + str(itemName))
+        command = str(command)
+        self.commands.append((item.getName(), command))
+        # autoupdate
+        if item.getType() == 'Rollershutter':
+            state = {'UP': '0', 'DOWN': '100'}.get(command, command)
+            if state in ('STOP', 'MOVE'):
+                return
+        else:
+            state = command
+        self._setState(item, state)
+
+    def _setState(self, item, state):
+        previous = item.state
+        item.state = State(state)
+        self.runtime.itemUpdated(item, previous)
+
+class Module(object):
+    def __init__(self, id, label, typeUID, configuration):
+        self.id = id
+        self.label = label
+        self.typeUID = typeUID
+        self.configuration = configuration
+
+    def getId(self):
+        return self.id
+
+    def getTypeUID(self):
+        return self.typeUID
+
+    def getConfiguration(self):
+        return self.configuration
+
+    def toString(self):
+        return self.typeUID + "(" + str(self.id) + ", " + str(dict(self.configuration)) + ")"
+
+    __str__ = toString
+
+class Configuration(dict):
+    pass
+
+class ModuleBuilder(object):
+    def __init__(self):
+        self.id = None
+        self.label = None
+        self.typeUID = None
+        self.configuration = Configuration()
+
+    @classmethod
+    def create(cls):
+        return cls()
+
+    def withId(self, id):
+        self.id = id
+        return self
+
+    def withLabel(self, label):
+        self.label = label
+        return self
+
+    def withTypeUID(self, typeUID):
+        self.typeUID = typeUID
+        return self
+
+    def withConfiguration(self, configuration):
+        self.configuration = configuration
+        return self
+
+    def build(self):
+        return Module(self.id, self.label, self.typeUID, self.configuration)
+
+class TriggerBuilder(ModuleBuilder):
+    pass
+
+class ConditionBuilder(ModuleBuilder):
+    pass
+
+class SimpleRule(object):
+    triggers = []
+    conditions = []
+    name = None
+    description = None
+    uid = None
+
+    def setTriggers(self, triggers):
+        self.triggers = triggers
+
+    def getTriggers(self):
+        return self.triggers
+
+    def setConditions(self, conditions):
+        self.conditions = conditions
+
+    def getConditions(self):
+        return self.conditions
+
+    def setName(self, name):
+        self.name = name
+
+    def getName(self):
+        return self.name
+
+    def setDescription(self, description):
+        self.description = description
+
+    def getDescription(self):
+        return self.description
+
+    def getUID(self):
+        return self.uid
+
+class AutomationManager(object):
+    def __init__(self):
+        self.rules = []
+        self.counter = 0
+
+    def addRule(self, rule):
+        self.counter += 1
+        rule.uid = "headless-" + str(self.counter)
+        self.rules.append(rule)
+        return rule
+
+    def removeRule(self, uid):
+        self.rules = [rule for rule in self.rules if rule.getUID() != uid]
+
+    def removeAll(self):
+        self.rules = []
+
+class ScriptExtension(object):
+    def importPreset(self, preset):
+        pass
+
+def _conditionMet(condition, ir):
+    configuration = condition.getConfiguration()
+    item = ir.get(configuration['itemName'])
+    if item == None:
+        return False
+    state = str(item.getState())
+    expected = str(configuration['state'])
+    operator = configuration['operator']
+    if operator == '=':
+        return state == expected
+    if operator == '!=':
+        return state != expected
+    try:
+        value = float(state)
+        expected = float(expected)
+    except ValueError:
+        return False
+    return {'>': value > expected, '<': value < expected,
+            '>=': value >= expected, '<=': value <= expected}.get(operator, False)
+
+class HeadlessRuntime(object):
+    def __init__(self, itemsDir=None):
+        self.ir = ItemRegistry()
+        if itemsDir != None and os.path.isdir(itemsDir):
+            self.ir.loadItemsDir(itemsDir)
+        self.events = Events(self)
+        self.automationManager = AutomationManager()
+
+    def getGlobals(self):
+        return {
+            '__name__': 'shutters',
+            'scriptExtension': ScriptExtension(),
+            'ir': self.ir,
+            'events': self.events,
+            'automationManager': self.automationManager,
+            'SimpleRule': SimpleRule,
+            'TriggerBuilder': TriggerBuilder,
+            'ConditionBuilder': ConditionBuilder,
+            'Configuration': Configuration,
+        }
+
+    def _fire(self, rule, input):
+        for condition in rule.getConditions() or []:
+            if not _conditionMet(condition, self.ir):
+                return
+        rule.execute(None, input)
+
+    def _rulesTriggeredBy(self, predicate):
+        for rule in list(self.automationManager.rules):
+            for trigger in rule.getTriggers() or []:
+                if predicate(trigger):
+                    yield rule
+                    break
+
+    # item triggers are executed synchronously
+    def itemUpdated(self, item, previous):
+        name = item.getName()
+        state = item.getState()
+        def predicate(trigger):
+            if trigger.getConfiguration().get('itemName') != name:
+                return False
+            if trigger.getTypeUID() == 'core.ItemStateChangeTrigger' and state == previous:
+                return False
+            expected = trigger.getConfiguration().get('state')
+            return expected == None or str(expected) == str(state)
+        for rule in self._rulesTriggeredBy(predicate):
+            self._fire(rule, {'state': state, 'oldState': previous, 'event': ItemStateEvent(name, state)})
+
+    def fireChannelEvent(self, channelUID, event):
+        def predicate(trigger):
+            configuration = trigger.getConfiguration()
+            return (trigger.getTypeUID() == 'core.ChannelEventTrigger'
+                    and configuration.get('channelUID') == channelUID
+                    and configuration.get('event') in (None, event))
+        for rule in self._rulesTriggeredBy(predicate):
+            self._fire(rule, {'event': event})
+
+    # executes the rules with a cron trigger that matches the timestamp
+    def fireCron(self, timestamp):
+        from org.quartz import CronExpression as QuartzCronExpression
+        from java.util import Date as JavaDate
+        date = JavaDate(int(timestamp * 1000))
+        def predicate(trigger):
+            return (trigger.getTypeUID() == 'timer.GenericCronTrigger'
+                    and QuartzCronExpression(trigger.getConfiguration()['cronExpression']).isSatisfiedBy(date))
+        for rule in self._rulesTriggeredBy(predicate):
+            self._fire(rule, {})
+
+#######################################################
+#######################################################
+#######################################################
+# loading shutters.py
+
+class _NoSleep(object):
+    # the tests wait for openHAB's event bus, the headless runtime is synchronous
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def sleep(self, seconds):
+        pass
+
+def loadShutters(runtime, automationDir=None, thingsDir=None, script=None):
+    automationDir = automationDir or scriptDir
+    script = script or os.path.join(automationDir, 'jsr223', 'shutters.py')
+    installJavaReplacements()
+    namespace = runtime.getGlobals()
+    exec(compile(open(script).read(), script, 'exec'), namespace)
+    namespace['time'] = _NoSleep()
+    namespace['automationDir'] = automationDir
+    namespace['shuttersFile'] = os.path.join(automationDir, namespace['shuttersFileName'])
+    namespace['scheduleFile'] = os.path.join(automationDir, namespace['scheduleFileName'])
+    namespace['benchmarkBaselineFile'] = os.path.join(automationDir, 'shutters_benchmark.json')
+    namespace['fragmentsDir'] = os.path.join(automationDir, namespace['fragmentsDirName'])
+    namespace['configSnapshotFile'] = os.path.join(automationDir, 'shutters_snapshot.json')
+    namespace['thingsDir'] = thingsDir or os.path.join(os.path.dirname(automationDir), 'things')
+    return namespace
+
+class _ErrorCounter(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.errors = 0
+
+    def emit(self, record):
+        self.errors += 1
+
+testClasses = ['MiscTest', 'ShutterTest', 'SunPositionTest', 'RulesTest', 'CalendarTest', 'RuleRegistryTest', 'ConfigTest']
+
+# runs the test classes of shutters.py, returns the number of failures
+def runTests(namespace):
+    counter = _ErrorCounter()
+    logging.getLogger(namespace['logger_name']).addHandler(counter)
+    started = time.time()
+    for name in testClasses:
+        if name in namespace:
+            namespace[name]().run()
+    logging.getLogger(namespace['logger_name']).info(
+        "Tests finished in " + ("%.0f" % ((time.time() - started) * 1000)) + "ms; failures: " + str(counter.errors))
+    return counter.errors
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Run shutters.py without openHAB")
+    parser.add_argument('command', choices=['test', 'bench', 'simulate', 'replay'])
+    parser.add_argument('year', nargs='?', type=int, help="year to simulate")
+    parser.add_argument('--automation-dir', default=scriptDir)
+    parser.add_argument('--items-dir', default=os.path.join(os.path.dirname(scriptDir), 'items'))
+    parser.add_argument('--things-dir', default=os.path.join(os.path.dirname(scriptDir), 'things'))
+    parser.add_argument('--geometry', action='store_true', help="geometry benchmarks only")
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--events', help="csv or jsonl file with the recorded events to replay")
+    parser.add_argument('--debug', action='store_true')
+    options = parser.parse_args(arguments)
+    logging.basicConfig(level=logging.DEBUG if options.debug else logging.INFO,
+                        format="%(asctime)s %(levelname)-5s %(name)s: %(message)s")
+    if not options.debug:
+        # the rules log every evaluation at INFO
+        for name in ['SunExposureRule', 'ShutterScheduleRule', 'Rules', 'DailySchedules', 'Calendar',
+                     'computeSunlitTimelines', 'Config']:
+            logging.getLogger('jython.shutters.' + name).setLevel(logging.WARNING)
+    runtime = HeadlessRuntime(options.items_dir)
+    namespace = loadShutters(runtime, options.automation_dir, options.things_dir)
+    if options.command == 'test':
+        return 1 if runTests(namespace) > 0 else 0
+    if options.command == 'bench':
+        return 1 if len(namespace['runBenchmarks'](options.geometry, options.update_baseline)) > 0 else 0
+    if options.command == 'simulate':
+        namespace['runSimulation'](options.year)
+    if options.command == 'replay':
+        if options.events == None:
+            parser.error("replay needs --events")
+        namespace['runReplay'](options.events)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
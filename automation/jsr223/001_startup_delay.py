@@ -1,22 +1,86 @@
 # originally copied from https://github.com/OH-Jython-Scripters/openhab2-jython/blob/master/Core/automation/jsr223/core/000_startup_delay.py
 
-from time import sleep
+# Delays the loading of the other scripts until what shutters.py needs is available:
+# the rule engine, the items configured in shutters.yml and the state items of each
+# rollershutter. Gives up after a timeout and logs what is still missing.
+
+import os
+from time import sleep, time
 from org.slf4j import LoggerFactory
+from org.yaml.snakeyaml import Yaml
 
 logger = LoggerFactory.getLogger("jython.001_startup_delay")
 
-logger.info("Checking for initialized context")
+# same as in shutters.py
+automationDir = '/etc/openhab2/automation'
+shuttersFile = automationDir + '/shutters.yml'
+fragmentsDir = automationDir + '/shutters.d'
+prefixes = ["", "state_auto_", "state_sunlit_"]
+
+pollInterval = 1
+timeout = 300
+
+def requiredItems():
+    configs = []
+    try:
+        configs.append(Yaml().load(open(shuttersFile)))
+        if os.path.isdir(fragmentsDir):
+            for name in sorted(os.listdir(fragmentsDir)):
+                if name.endswith('.yml') or name.endswith('.yaml'):
+                    configs.append(Yaml().load(open(os.path.join(fragmentsDir, name))))
+    except Exception as e:
+        logger.warn("Config not readable, not waiting for items: " + str(e))
+        return []
+    items = []
+    for config in configs:
+        if config == None:
+            continue
+        if config.get('items') != None:
+            for key in config['items']:
+                items.append(config['items'][key])
+        if config.get('sun_exposure') != None:
+            for shutterName in config['sun_exposure']:
+                for prefix in prefixes:
+                    items.append(prefix + shutterName)
+    return sorted(set(items))
+
+def missingItems(items):
+    missing = []
+    for itemName in items:
+        try:
+            if ir.get(itemName) == None:
+                missing.append(itemName)
+        except:
+            missing.append(itemName)
+    return missing
 
-while True:
+def contextInitialized():
     try:
         scriptExtension.importPreset("RuleSupport")
-        if automationManager is not None:
-            break
+        return automationManager is not None
     except:
-        logger.info("Context not initialized yet... waiting 10s before checking again")
-        sleep(10)
+        return False
+
+start = time()
+logger.info("Checking for initialized context")
+while not contextInitialized():
+    if time() - start > timeout:
+        logger.error("Context not initialized after " + str(timeout) + "s")
+        break
+    sleep(pollInterval)
 
-logger.info("Context initialized... waiting 30s before allowing scripts to load")
-sleep(30)
-logger.info("Complete")
+items = requiredItems()
+logger.info("Waiting for " + str(len(items)) + " items")
+missing = missingItems(items)
+lastReport = time()
+while len(missing) > 0:
+    if time() - start > timeout:
+        logger.error("Items still missing after " + str(timeout) + "s: " + ", ".join(missing))
+        break
+    if time() - lastReport >= 10:
+        logger.info("Waiting for items: " + ", ".join(missing))
+        lastReport = time()
+    sleep(pollInterval)
+    missing = missingItems(missing)
 
+logger.info("Complete after " + "%.1f" % (time() - start) + "s")
@@ -11,17 +11,47 @@ import math
 import sys
 import traceback
 import time
+import datetime
+import bisect
+import re
+import os
+import json
+import hashlib
+import base64
+import threading
+from array import array
+import pstats
+from collections import OrderedDict, deque
 from threading import Thread
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# optional: batch evaluation uses numpy when available (not under jython)
+try:
+    import numpy
+except ImportError:
+    numpy = None
  
 # java imports
 #from org.eclipse.smarthome.core.scheduler import CronExpression
 from org.quartz import CronExpression
 from java.util import Date, Locale
 from java.text import DateFormat
+from java.lang import InterruptedException
 from org.yaml.snakeyaml import Yaml
 import profile
-from org.eclipse.smarthome.core.service import AbstractWatchService
 from java.nio.file import FileSystems,WatchService,Path,StandardWatchEventKinds
+from java.util.concurrent import TimeUnit
 from threading import Thread
 
 # openhab2 jsr223 stuff
@@ -52,6 +82,10 @@ sunlitStateUnknown = "Unknown"
 sunlitStateTrue = "True"
 sunlitStateFalse = "False"
 
+# resolution in degrees of the precomputed sunlit bitmap (0 disables it)
+# the bitmap is off unless raster_resolution is set
+defaultRasterResolution = 0
+
 # location of script
 automationDir = '/etc/openhab2/automation'
 
@@ -59,38 +93,212 @@ shuttersFileName = 'shutters.yml'
 scheduleFileName = 'shutter_schedule.yml'
 shuttersFile = automationDir + '/' + shuttersFileName
 scheduleFile = automationDir + '/' + scheduleFileName
+# optional directory with yaml fragments that are merged into the config
+fragmentsDirName = 'shutters.d'
+fragmentsDir = automationDir + '/' + fragmentsDirName
+benchmarkBaselineFile = automationDir + '/shutters_benchmark.json'
+configSnapshotFile = automationDir + '/shutters_snapshot.json'
+
+# astro things (used for the geolocation if not configured in the settings)
+thingsDir = '/etc/openhab2/things'
 
 #######################################################
 # some globals
 config = None
 calendar = None
+configSnapshot = None
 
 # default logger
 logger = LoggerFactory.getLogger(logger_name)
 
-# globalRules
-globalRules = None
+# rules
+ruleRegistry = None
+dailyReloadRule = None
+# key in the rule registry -> SunExposureRule (one per facade shard if sharded)
+sunExposureRules = OrderedDict()
+sunlitTransitionRule = None
+solarEngine = None
+commandDispatcher = None
+cronDispatcher = None
+itemStateCache = None
+stateCacheRule = None
+profilerRule = None
+metricsRule = None
+metricsServer = None
+# names of the ShutterScheduleRules of todays daily schedule. The rules of all daily
+# schedules stay registered, switching the daily schedule only replaces this set.
+activeScheduleRules = frozenset()
 
 #######################################################
 #######################################################
 #######################################################
 # config
+# parsed yaml files: path -> (modification time, size, content)
+yamlCache = {}
+
+def loadYamlFile(path):
+    stat = os.stat(path)
+    cached = yamlCache.get(path)
+    if cached != None and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+        return cached[2]
+    content = Yaml().load(open(path))
+    yamlCache[path] = (stat.st_mtime, stat.st_size, content)
+    return content
+
+shutterConfigSections = ['items', 'settings', 'sun_exposure']
+scheduleConfigSections = ['calendar', 'daily_schedules', 'rules']
+
+# merges fragments into a copy of config: mappings are merged, lists appended
+def mergeConfig(config, fragments, sections):
+    merged = OrderedDict()
+    for section in sections:
+        value = config.get(section) if config != None else None
+        for fragment in fragments:
+            addition = fragment.get(section)
+            if addition == None:
+                continue
+            if value == None:
+                value = addition
+            elif isinstance(addition, list) or hasattr(addition, 'subList'):
+                value = list(value) + list(addition)
+            else:
+                combined = OrderedDict()
+                for key in value:
+                    combined[key] = value[key]
+                for key in addition:
+                    combined[key] = addition[key]
+                value = combined
+        if value != None:
+            merged[section] = value
+    return merged
+
+# converts the (java) maps and lists of the yaml parser to OrderedDicts and lists
+def normalizeYaml(value):
+    if hasattr(value, 'keys'):
+        result = OrderedDict()
+        for key in value.keys():
+            result[key] = normalizeYaml(value[key])
+        return result
+    if isinstance(value, (list, tuple)) or hasattr(value, 'subList'):
+        return [normalizeYaml(v) for v in value]
+    return value
+
+# horizon profile files: path -> (modification time, size, points)
+profileCache = {}
+
+# csv file with one "azimuth,elevation" point per line; other lines (header, comments) are skipped
+def loadProfileFile(path):
+    stat = os.stat(path)
+    cached = profileCache.get(path)
+    if cached != None and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+        return cached[2]
+    points = []
+    for line in open(path):
+        fields = line.replace(';', ',').split(',')
+        try:
+            points.append([float(fields[0]), float(fields[1])])
+        except (ValueError, IndexError):
+            continue
+    profileCache[path] = (stat.st_mtime, stat.st_size, points)
+    return points
+
+# replaces the profile_file of the obstacles by the points read from the file
+def resolveProfileFiles(value, directory):
+    if hasattr(value, 'keys'):
+        if value.get('profile_file') != None:
+            path = os.path.join(directory, str(value['profile_file']))
+            return OrderedDict([('profile', loadProfileFile(path))])
+        result = OrderedDict()
+        for key in value.keys():
+            result[key] = resolveProfileFiles(value[key], directory)
+        return result
+    if isinstance(value, (list, tuple)) or hasattr(value, 'subList'):
+        return [resolveProfileFiles(v, directory) for v in value]
+    return value
+
+def contentHash(fileNames):
+    digest = hashlib.sha1()
+    for fileName in fileNames:
+        digest.update(fileName.encode('utf-8'))
+        content = open(fileName, 'rb')
+        try:
+            digest.update(content.read())
+        finally:
+            content.close()
+    return digest.hexdigest()
+
+def snapshotKey(kind, value):
+    return kind + ":" + hashlib.sha1(str(value).encode('utf-8')).hexdigest()
+
 class Config():
-    def __init__(self):
+    def __init__(self, shuttersFileName=None, scheduleFileName=None, fragmentsDirName=None, snapshot=None):
         self.logger = LoggerFactory.getLogger(logger_name + ".Config")
-        self.shutterConfig = Yaml().load(open(shuttersFile))
-        self.scheduleConfig = Yaml().load(open(scheduleFile))
-        self.logger.info("Config loaded")
+        fragmentsDirName = fragmentsDirName or fragmentsDir
+        self.fromSnapshot = False
+        fileNames = [shuttersFileName or shuttersFile, scheduleFileName or scheduleFile]
+        # profile files are relative to shutters.yml
+        self.directory = os.path.dirname(fileNames[0])
+        self.sunExposure = None
+        if os.path.isdir(fragmentsDirName):
+            for name in sorted(os.listdir(fragmentsDirName)):
+                if name.endswith('.yml') or name.endswith('.yaml'):
+                    fileNames.append(os.path.join(fragmentsDirName, name))
+        if snapshot != None:
+            snapshot.open(contentHash(fileNames))
+            cached = snapshot.get('config')
+            if cached != None:
+                self.shutterConfig = cached['shutters']
+                self.scheduleConfig = cached['schedule']
+                self.fromSnapshot = True
+                self.logger.info("Config loaded from snapshot")
+                return
+        fragments = []
+        for fileName in fileNames[2:]:
+            fragment = loadYamlFile(fileName)
+            if fragment != None:
+                fragments.append(fragment)
+        self.shutterConfig = normalizeYaml(mergeConfig(loadYamlFile(fileNames[0]), fragments, shutterConfigSections))
+        self.scheduleConfig = normalizeYaml(mergeConfig(loadYamlFile(fileNames[1]), fragments, scheduleConfigSections))
+        if snapshot != None:
+            snapshot.put('config', OrderedDict([('shutters', self.shutterConfig), ('schedule', self.scheduleConfig)]))
+        self.logger.info("Config loaded" + (" (" + str(len(fragments)) + " fragments)" if len(fragments) > 0 else ""))
+
+    # raises an exception if the config is incomplete or inconsistent
+    def validate(self):
+        for section in ['items', 'sun_exposure']:
+            if self.shutterConfig.get(section) == None:
+                raise Exception("Config Error: missing section: " + section)
+        for section in scheduleConfigSections:
+            if self.scheduleConfig.get(section) == None:
+                raise Exception("Config Error: missing section: " + section)
+        for item in ['azimuth', 'elevation', 'weather_sunny', 'shutter_automation']:
+            if self.getItems().get(item) == None:
+                raise Exception("Config Error: missing item: " + item)
+        for calendarItem in self.getCalendar():
+            if calendarItem.get('daily_schedule') not in self.getDailySchedules():
+                raise Exception("Config Error: unknown daily schedule: " + str(calendarItem.get('daily_schedule')))
+        for scheduleName in self.getDailySchedules():
+            for ruleName in self.getDailySchedules()[scheduleName]:
+                if ruleName not in self.getRules():
+                    raise Exception("Config Error: unknown rule: " + str(ruleName) + " in daily schedule: " + scheduleName)
 
     def getShutters(self):
         return self.shutterConfig['sun_exposure']
 
     def getSunExposure(self):
-        return self.shutterConfig['sun_exposure']
+        if self.sunExposure == None:
+            self.sunExposure = resolveProfileFiles(self.shutterConfig['sun_exposure'], self.directory)
+        return self.sunExposure
 
     def getItems(self):
         return self.shutterConfig['items']
 
+    def getSettings(self):
+        settings = self.shutterConfig.get('settings')
+        if settings == None:
+            settings = {}
+        return settings
+
     def getCalendar(self):
         return self.scheduleConfig['calendar']
 
@@ -101,18 +309,186 @@ class Config():
         return self.scheduleConfig['rules']
 
 #######################################################
-def initStateItems(force=False, states=None):
+# Snapshot of the compiled config: the normalized config, the sunlit rasters and the
+# calendar index. The config is only taken if the yaml files did not change (content
+# hash); rasters and calendar indexes are stored by the hash of their own config.
+# Entries not used by the last load are dropped when the snapshot is saved.
+configSnapshotVersion = 1
+
+class ConfigSnapshot():
+    def __init__(self, fileName):
+        self.logger = LoggerFactory.getLogger(logger_name + ".ConfigSnapshot")
+        self.fileName = fileName
+        self.key = None
+        self.entries = None
+        self.previousKey = None
+        self.previous = {}
+        self.dirty = False
+
+    def _read(self):
+        try:
+            content = open(self.fileName)
+            try:
+                data = json.load(content, object_pairs_hook=OrderedDict)
+            finally:
+                content.close()
+        except (IOError, OSError, ValueError):
+            return None, {}
+        if data.get('version') != configSnapshotVersion:
+            return None, {}
+        return data.get('key'), data.get('entries') or {}
+
+    # starts a load of the config with the given content hash
+    def open(self, key):
+        if self.entries == None:
+            self.previousKey, self.previous = self._read()
+        else:
+            self.previousKey, self.previous = self.key, self.entries
+        self.key = key
+        self.entries = {}
+        self.dirty = self.previousKey != key
+
+    def get(self, name):
+        if self.entries == None:
+            return None
+        if name in self.entries:
+            return self.entries[name]
+        if name == 'config' and self.previousKey != self.key:
+            return None
+        value = self.previous.get(name)
+        if value != None:
+            self.entries[name] = value
+        return value
+
+    def put(self, name, value):
+        if self.entries == None:
+            return
+        self.entries[name] = value
+        self.dirty = True
+
+    def save(self):
+        if self.entries == None or not (self.dirty or len(self.entries) != len(self.previous)):
+            return
+        temporary = self.fileName + ".tmp"
+        try:
+            out = open(temporary, 'w')
+            try:
+                json.dump(OrderedDict([('version', configSnapshotVersion), ('key', self.key), ('entries', self.entries)]), out)
+            finally:
+                out.close()
+            os.rename(temporary, self.fileName)
+            self.dirty = False
+            self.logger.info("Snapshot saved: " + str(len(self.entries)) + " entries")
+        except (IOError, OSError, TypeError, ValueError) as e:
+            # e.g. dates in the yaml files can't be stored
+            self.logger.warn("Snapshot not saved: " + str(e))
+
+#######################################################
+# tests
+class ConfigTest():
+    def __init__(self):
+        self.logger = LoggerFactory.getLogger(logger_name + ".ConfigTest")
+
+    def fragmentsTest(self):
+        self.logger.info("fragmentsTest")
+        import tempfile
+        import shutil
+        directory = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(directory, fragmentsDirName))
+            files = {
+                'shutters.yml': """
+                    items: { azimuth: a, elevation: e, weather_sunny: w, shutter_automation: s }
+                    sun_exposure:
+                      shutter_kitchen: { orientation: 150, sun_openings: [ { azimuth: 80, above: [ { profile_file: horizon.csv } ] }, { azimuth: 220 } ] }
+                    """,
+                'horizon.csv': "azimuth,elevation\n80,12\n220;4.5\n",
+                'schedule.yml': """
+                    calendar:
+                      - { cron: "? * * *", daily_schedule: workday }
+                    daily_schedules:
+                      workday: [ close_dusk ]
+                    rules:
+                      close_dusk: { triggers: [ { cron: '0 0 22' } ], action: DOWN, items: [ shutter_kitchen ] }
+                    """,
+                fragmentsDirName + '/office.yml': """
+                    sun_exposure:
+                      shutter_office: { orientation: 60, sun_openings: [ { azimuth: 30 }, { azimuth: 140 } ] }
+                    calendar:
+                      - { cron: "? * 1 *", daily_schedule: weekend }
+                    daily_schedules:
+                      weekend: [ close_dusk ]
+                    """,
+            }
+            for name in files:
+                out = open(os.path.join(directory, name), 'w')
+                out.write(files[name])
+                out.close()
+            config = Config(os.path.join(directory, 'shutters.yml'), os.path.join(directory, 'schedule.yml'),
+                            os.path.join(directory, fragmentsDirName))
+            config.validate()
+            assert sorted(config.getSunExposure()) == ['shutter_kitchen', 'shutter_office']
+            assert config.getSunExposure()['shutter_kitchen']['sun_openings'][0]['above'][0]['profile'] == [[80, 12], [220, 4.5]]
+            assert len(config.getCalendar()) == 2
+            assert sorted(config.getDailySchedules()) == ['weekend', 'workday']
+
+            # unchanged files are loaded from the snapshot
+            snapshotFile = os.path.join(directory, 'snapshot.json')
+            files = (os.path.join(directory, 'shutters.yml'), os.path.join(directory, 'schedule.yml'),
+                     os.path.join(directory, fragmentsDirName))
+            snapshot = ConfigSnapshot(snapshotFile)
+            assert not Config(*files, snapshot=snapshot).fromSnapshot
+            snapshot.put('raster:1', 'AAE=')
+            snapshot.save()
+            snapshot = ConfigSnapshot(snapshotFile)
+            config = Config(*files, snapshot=snapshot)
+            assert config.fromSnapshot
+            assert config.getSunExposure()['shutter_office']['orientation'] == 60
+            assert config.getSunExposure()['shutter_kitchen']['sun_openings'][0]['above'][0]['profile'] == [[80, 12], [220, 4.5]]
+            assert snapshot.get('raster:1') == 'AAE='
+            # entries not used by a load are dropped
+            snapshot.open("changed")
+            assert snapshot.get('config') == None
+            snapshot.save()
+            assert ConfigSnapshot(snapshotFile)._read() == ("changed", {})
+
+            out = open(os.path.join(directory, fragmentsDirName, 'broken.yml'), 'w')
+            out.write("daily_schedules:\n  vacation: [ open_all ]\n")
+            out.close()
+            config = Config(os.path.join(directory, 'shutters.yml'), os.path.join(directory, 'schedule.yml'),
+                            os.path.join(directory, fragmentsDirName))
+            try:
+                config.validate()
+                assert False
+            except AssertionError:
+                raise
+            except Exception as e:
+                assert "open_all" in str(e)
+        finally:
+            shutil.rmtree(directory)
+
+    def run(self):
+        self.logger.info("TEST start")
+        try:
+            self.fragmentsTest()
+        except Exception as e:
+            self.logger.error(traceback.format_exc())
+
+        self.logger.info("TEST end")
+
+#######################################################
+def initStateItems(force=False, states=None, bus=None):
     logger = LoggerFactory.getLogger(logger_name + ".initStateItems")
     logger.info("Initializing")
+    bus = bus if bus != None else openhabItemBus
     if states == None:
         states = {prefix_auto: autoStateDown, prefix_sunlit: sunlitStateFalse}
     for item_name in config.getShutters():
         for prefix in states:
-            item = ir.get(prefix + item_name)
-            if item == None:
+            if not bus.exists(prefix + item_name):
                 logger.error("Item: " + prefix + item_name + " not found.")
-            elif str(item.getState()) == "NULL" or force:
-                events.postUpdate(item.getName(), states[prefix])
+            elif bus.getState(prefix + item_name) == "NULL" or force:
+                bus.postUpdate(prefix + item_name, states[prefix])
 
 #######################################################
 def normalize_name(name, prefix=None):
@@ -195,12 +571,37 @@ def itemStateChangeTrigger(itemName, state=None, triggerName=None):
 # Shutters
 
 #######################################################
-class Horizon():
+# obstacles are immutable: identical ones are shared between the sun exposure models
+obstacleCache = {}
+
+def createObstacle(obstacleClass, orientation, config):
+    key = (obstacleClass.__name__, orientation, str(config))
+    obstacle = obstacleCache.get(key)
+    if obstacle == None:
+        obstacle = obstacleClass(orientation, config)
+        obstacleCache[key] = obstacle
+    return obstacle
+
+# called on reload: drops the obstacles of changed or removed shutters. Unchanged models
+# taken over from the previous config keep theirs.
+def clearObstacleCache():
+    obstacleCache.clear()
+
+#######################################################
+class Horizon(object):
+    __slots__ = ['elevation']
+    logger = LoggerFactory.getLogger(logger_name + ".Horizon")
+
     def __init__(self, orientation, config):
-        self.logger = LoggerFactory.getLogger(logger_name + ".Horizon")
-        self.elevation = config['elevation']
+        self.elevation = float(config['elevation'])
     def getElevationAtAzimuth(self, azimuth):
         return self.elevation
+    def getElevationRange(self, azimuth1, azimuth2):
+        return (self.elevation, self.elevation)
+    def getElevationsAtAzimuths(self, azimuths):
+        if numpy != None:
+            return numpy.full(len(azimuths), float(self.elevation))
+        return [self.elevation] * len(azimuths)
 
 
 #######################################################
@@ -227,15 +628,45 @@ class Horizon():
 
 #===============================================================================
 
-class HLine():
+class HLine(object):
+    __slots__ = ['orientation', 'profileAngle', 'tan_pa']
+    logger = LoggerFactory.getLogger(logger_name + ".HLine")
+
     def __init__(self, orientation, config):
-        self.logger = LoggerFactory.getLogger(logger_name + ".HLine")
         self.orientation = orientation
         self.profileAngle = self._calculateProfileAngle(config['elevation'], config['azimuth'])
+        self.tan_pa = math.tan(math.radians(self.profileAngle))
         self.logger.debug("profileAngle: " + str(self.profileAngle) + "/*")
 
     def getElevationAtAzimuth(self, azimuth):
-        return self._getElevationAtAzimuth(azimuth, self.profileAngle)
+        return math.degrees(math.atan(math.cos(math.radians(azimuth - self.orientation)) * self.tan_pa))
+
+    def getElevationsAtAzimuths(self, azimuths):
+        tan_pa = self.tan_pa
+        if numpy != None:
+            a = numpy.radians(numpy.asarray(azimuths, dtype=float) - self.orientation)
+            return numpy.degrees(numpy.arctan(numpy.cos(a) * tan_pa))
+        radians = math.radians
+        degrees = math.degrees
+        atan = math.atan
+        cos = math.cos
+        o = self.orientation
+        return [degrees(atan(cos(radians(a - o)) * tan_pa)) for a in azimuths]
+
+    # min/max elevation of the obstacle between two azimuths
+    def getElevationRange(self, azimuth1, azimuth2):
+        elevations = [self.getElevationAtAzimuth(azimuth1), self.getElevationAtAzimuth(azimuth2)]
+        for extremum in self._getExtremumAzimuths():
+            # the extrema repeat every 180 degrees
+            a = extremum + 180 * math.ceil((azimuth1 - extremum) / 180.0)
+            while a <= azimuth2:
+                elevations.append(self.getElevationAtAzimuth(a))
+                a += 180
+        return (min(elevations), max(elevations))
+
+    # e = atan( cos(a) tan(PA) ) has its extrema where the window faces the obstacle
+    def _getExtremumAzimuths(self):
+        return [self.orientation]
 
     def _calculateProfileAngle(self, elevation, azimuth):
         return math.degrees(
@@ -246,15 +677,6 @@ class HLine():
             )
         )
  
-    def _getElevationAtAzimuth(self, azimuth, profileAngle):
-        self.logger.debug( str(azimuth) + ";" + str(profileAngle) )
-        return math.degrees(
-            math.atan(
-                math.cos( math.radians(azimuth-self.orientation) )
-                *
-                math.tan( math.radians(profileAngle) )
-            )
-        ) 
 
 #######################################################
 
@@ -262,9 +684,14 @@ class HLine():
 
 # tan g = (tan e1 - tan e2) / (tan a2 - tan a1)
 
+# e = atan( cos(a) (tan e0 - tan g * tan a) ) = atan( tan e0 cos(a) - tan g sin(a) )
+# -> extrema at tan a = - tan g / tan e0
+
 class Line(HLine):
+    __slots__ = ['tan_gamma', 'tan_e0']
+    logger = LoggerFactory.getLogger(logger_name + ".Line")
+
     def __init__(self, orientation, config):
-        self.logger = LoggerFactory.getLogger(logger_name + ".Line")
         self.orientation = orientation
         a1 = math.radians(config[0]['azimuth']-self.orientation)
         e1 = math.radians(self._calculateProfileAngle(config[0]['elevation'], config[0]['azimuth']))
@@ -280,60 +707,261 @@ class Line(HLine):
         self.logger.debug(str(self.tan_gamma) + "/" + str(self.tan_e0))
 
     def getElevationAtAzimuth(self, azimuth):
-        e = math.atan(self.tan_e0 - self.tan_gamma * math.tan(math.radians(azimuth-self.orientation)))
-        return self._getElevationAtAzimuth(azimuth, math.degrees(e))
+        a = math.radians(azimuth - self.orientation)
+        return math.degrees(math.atan(self.tan_e0 * math.cos(a) - self.tan_gamma * math.sin(a)))
+
+    def getElevationsAtAzimuths(self, azimuths):
+        tan_e0 = self.tan_e0
+        tan_g = self.tan_gamma
+        if numpy != None:
+            a = numpy.radians(numpy.asarray(azimuths, dtype=float) - self.orientation)
+            return numpy.degrees(numpy.arctan(tan_e0 * numpy.cos(a) - tan_g * numpy.sin(a)))
+        radians = math.radians
+        degrees = math.degrees
+        atan = math.atan
+        cos = math.cos
+        sin = math.sin
+        o = self.orientation
+        result = []
+        for a in azimuths:
+            a = radians(a - o)
+            result.append(degrees(atan(tan_e0 * cos(a) - tan_g * sin(a))))
+        return result
+
+    def _getExtremumAzimuths(self):
+        return [self.orientation + math.degrees(math.atan2(-self.tan_gamma, self.tan_e0))]
 
 #######################################################
-class SunExposure():
-    def __init__(self, config):
-        self.logger = LoggerFactory.getLogger(logger_name + ".SunExposure")
-        self.config = config
-        self.openings = {}
-        self.orientation = config['orientation']
-        self._parseSunOpenings()
+# Skyline sampled at (azimuth, elevation) points, e.g. from a horizon survey. Between the
+# points the elevation is interpolated linearly, beyond the first and last point it is constant.
+
+class Profile(object):
+    __slots__ = ['azimuths', 'elevations']
+    logger = LoggerFactory.getLogger(logger_name + ".Profile")
+
+    def __init__(self, orientation, config):
+        points = sorted([(float(point[0]), float(point[1])) for point in config['profile']])
+        if len(points) == 0:
+            raise Exception("Config Error: empty horizon profile")
+        self.azimuths = array('d', [point[0] for point in points])
+        self.elevations = array('d', [point[1] for point in points])
+        self.logger.debug(str(len(points)) + " points")
+
+    def getElevationAtAzimuth(self, azimuth):
+        azimuths = self.azimuths
+        i = bisect.bisect_right(azimuths, azimuth)
+        if i == 0:
+            return self.elevations[0]
+        if i == len(azimuths):
+            return self.elevations[-1]
+        a0 = azimuths[i - 1]
+        e0 = self.elevations[i - 1]
+        return e0 + (self.elevations[i] - e0) * (azimuth - a0) / (azimuths[i] - a0)
+
+    def getElevationsAtAzimuths(self, azimuths):
+        if numpy != None:
+            return numpy.interp(numpy.asarray(azimuths, dtype=float), numpy.asarray(self.azimuths), numpy.asarray(self.elevations))
+        getElevationAtAzimuth = self.getElevationAtAzimuth
+        return [getElevationAtAzimuth(a) for a in azimuths]
+
+    # the extrema are at the ends or at the points in between
+    def getElevationRange(self, azimuth1, azimuth2):
+        elevations = [self.getElevationAtAzimuth(azimuth1), self.getElevationAtAzimuth(azimuth2)]
+        elevations.extend(self.elevations[bisect.bisect_right(self.azimuths, azimuth1):bisect.bisect_left(self.azimuths, azimuth2)])
+        return (min(elevations), max(elevations))
+
+#######################################################
+# Precomputed azimuth x elevation bitmap of a SunExposure.
+# Each cell is either shaded, sunlit or an edge cell (an obstacle or a section
+# boundary runs through it). Only edge cells need the exact geometry.
+
+rasterShaded = 0
+rasterSunlit = 1
+rasterEdge = 2
+
+class SunlitRaster(object):
+    __slots__ = ['resolution', 'minAzimuth', 'maxAzimuth', 'azimuthCells', 'elevationCells', 'cells']
+    logger = LoggerFactory.getLogger(logger_name + ".SunlitRaster")
+    minElevation = -90.0
+    maxElevation = 90.0
+
+    def __init__(self, exposure, resolution):
+        self.resolution = float(resolution)
+        self.minAzimuth = float(exposure.sections[0])
+        self.maxAzimuth = float(exposure.sections[-1])
+        self.azimuthCells = max(1, int(math.ceil((self.maxAzimuth - self.minAzimuth) / self.resolution)))
+        self.elevationCells = int(math.ceil((self.maxElevation - self.minElevation) / self.resolution))
+        key = snapshotKey("raster", exposure.signature + "|" + str(self.resolution))
+        cached = configSnapshot.get(key) if configSnapshot != None else None
+        if cached != None:
+            self.cells = bytearray(base64.b64decode(cached))
+            return
+        self.cells = bytearray(self.azimuthCells * self.elevationCells)
+        self._build(exposure)
+        if configSnapshot != None:
+            configSnapshot.put(key, base64.b64encode(bytes(self.cells)).decode('ascii'))
+        self.logger.debug("raster: " + str(self.azimuthCells) + "x" + str(self.elevationCells))
+
+    def _build(self, exposure):
+        sections = exposure.sections
+        s = 0
+        for i in range(self.azimuthCells):
+            a1 = self.minAzimuth + i * self.resolution
+            a2 = min(a1 + self.resolution, self.maxAzimuth)
+            while sections[s + 1] <= a1:
+                s += 1
+            offset = i * self.elevationCells
+            if a2 > sections[s + 1] or a1 + self.resolution > self.maxAzimuth:
+                # section boundary within the cell
+                for j in range(self.elevationCells):
+                    self.cells[offset + j] = rasterEdge
+                continue
+            above = (None, None)
+            below = (None, None)
+            if exposure.above[s] != None:
+                above = exposure.above[s].getElevationRange(a1, a2)
+            if exposure.below[s] != None:
+                below = exposure.below[s].getElevationRange(a1, a2)
+            for j in range(self.elevationCells):
+                e1 = self.minElevation + j * self.resolution
+                e2 = e1 + self.resolution
+                if (above[0] != None and e2 <= above[0]) or (below[1] != None and e1 >= below[1]):
+                    self.cells[offset + j] = rasterShaded
+                elif (above[1] == None or e1 > above[1]) and (below[0] == None or e2 < below[0]):
+                    self.cells[offset + j] = rasterSunlit
+                else:
+                    self.cells[offset + j] = rasterEdge
+
+    # returns True/False or None if the exact geometry has to decide
+    def lookup(self, azimuth, elevation):
+        if azimuth < self.minAzimuth or azimuth >= self.maxAzimuth:
+            return False
+        if elevation < self.minElevation or elevation >= self.maxElevation:
+            return None
+        i = int((azimuth - self.minAzimuth) / self.resolution)
+        j = int((elevation - self.minElevation) / self.resolution)
+        if i >= self.azimuthCells or j >= self.elevationCells:
+            return None
+        cell = self.cells[i * self.elevationCells + j]
+        if cell == rasterEdge:
+            return None
+        return cell == rasterSunlit
+
+#######################################################
+def getSunExposureSignature(config, rasterResolution):
+    return str(config) + "|" + str(rasterResolution)
 
-    def _parseSunOpenings(self):
-        for opening_config in self.config['sun_openings']:
+# compiled sun exposure model of a rollershutter: the sections (sorted start azimuths
+# of the sun openings) and the obstacles above and below in each section
+class SunExposure(object):
+    __slots__ = ['signature', 'orientation', 'sections', 'above', 'below', 'minAzimuth', 'maxAzimuth', 'raster']
+    logger = LoggerFactory.getLogger(logger_name + ".SunExposure")
+
+    def __init__(self, config, rasterResolution=None):
+        self.signature = getSunExposureSignature(config, rasterResolution)
+        self.orientation = config['orientation']
+        self._compile(config['sun_openings'])
+        if config.get('raster_resolution') != None:
+            rasterResolution = config['raster_resolution']
+        if rasterResolution == None:
+            rasterResolution = defaultRasterResolution
+        self.raster = None
+        if rasterResolution > 0 and len(self.sections) > 1:
+            self.raster = SunlitRaster(self, rasterResolution)
+
+    def _compile(self, openingConfigs):
+        openings = {}
+        for opening_config in openingConfigs:
             opening = {}
             for position in ['above', 'below' ]:
                 opening[position] = None
                 if opening_config.get(position) != None:
                     if len(opening_config[position]) == 1:
-                        if (opening_config[position][0].get('azimuth') == None ):
-                            opening[position] = Horizon(self.orientation, opening_config[position][0])
+                        if opening_config[position][0].get('profile') != None:
+                            opening[position] = createObstacle(Profile, self.orientation, opening_config[position][0])
+                        elif (opening_config[position][0].get('azimuth') == None ):
+                            opening[position] = createObstacle(Horizon, self.orientation, opening_config[position][0])
                         else:
-                            opening[position] = HLine(self.orientation, opening_config[position][0])
+                            opening[position] = createObstacle(HLine, self.orientation, opening_config[position][0])
                     else:
-                        opening[position] = Line(self.orientation, opening_config[position])
-            self.openings[opening_config['azimuth']] = opening
+                        opening[position] = createObstacle(Line, self.orientation, opening_config[position])
+            openings[opening_config['azimuth']] = opening
+        azimuths = sorted(openings)
+        self.sections = array('d', azimuths)
+        self.above = tuple([openings[a]['above'] for a in azimuths])
+        self.below = tuple([openings[a]['below'] for a in azimuths])
+        # outside of this range the window is never sunlit
+        self.minAzimuth = self.sections[0]
+        self.maxAzimuth = self.sections[-1]
+
+    # the obstacle ('above' or 'below') of the section starting at azimuth
+    def getObstacle(self, azimuth, position):
+        i = bisect.bisect_left(self.sections, azimuth)
+        if i == len(self.sections) or self.sections[i] != azimuth:
+            return None
+        return self.above[i] if position == 'above' else self.below[i]
 
     def isSunlit(self, azimuth, elevation):
-        self.logger.debug(str(azimuth) + "-" + str(elevation))
-        sections = sorted(list(self.openings))
-        self.logger.debug(str(self.config))
-        self.logger.debug(str(sections))
-        section = None
-        for i in sections:
-            self.logger.debug("i: " + str(i) + "; " + str(azimuth))
-            if float(i) > float(str(azimuth)):
-                break
-            else:
-                section = i
-        self.logger.debug(str(section))
-        if section == sections[len(sections)-1]:
+        azimuth = float(azimuth)
+        if azimuth < self.minAzimuth or azimuth >= self.maxAzimuth:
+            return False
+        elevation = float(elevation)
+        if self.raster != None:
+            sunlit = self.raster.lookup(azimuth, elevation)
+            if sunlit != None:
+                return sunlit
+        return self._isSunlit(azimuth, elevation)
+
+    # evaluates many sun positions at once, returns a list (or numpy array) of booleans
+    def isSunlitBatch(self, azimuths, elevations):
+        if numpy != None:
+            return self._isSunlitNumpy(numpy.asarray(azimuths, dtype=float), numpy.asarray(elevations, dtype=float))
+        result = []
+        append = result.append
+        isSunlit = self._isSunlit
+        if self.raster == None:
+            for i in range(len(azimuths)):
+                append(isSunlit(float(azimuths[i]), float(elevations[i])))
+            return result
+        lookup = self.raster.lookup
+        for i in range(len(azimuths)):
+            azimuth = float(azimuths[i])
+            elevation = float(elevations[i])
+            sunlit = lookup(azimuth, elevation)
+            if sunlit == None:
+                sunlit = isSunlit(azimuth, elevation)
+            append(sunlit)
+        return result
+
+    def _isSunlitNumpy(self, azimuths, elevations):
+        sections = self.sections
+        index = numpy.searchsorted(numpy.asarray(sections, dtype=float), azimuths, side='right') - 1
+        result = numpy.zeros(len(azimuths), dtype=bool)
+        for i in range(len(sections) - 1):
+            mask = index == i
+            if not mask.any():
+                continue
+            a = azimuths[mask]
+            e = elevations[mask]
+            sunlit = numpy.ones(len(a), dtype=bool)
+            if self.above[i] != None:
+                sunlit &= e > self.above[i].getElevationsAtAzimuths(a)
+            if self.below[i] != None:
+                sunlit &= e < self.below[i].getElevationsAtAzimuths(a)
+            result[mask] = sunlit
+        return result
+
+    def _isSunlit(self, azimuth, elevation):
+        section = bisect.bisect_right(self.sections, azimuth) - 1
+        if section < 0 or section >= len(self.sections) - 1:
             return False
-        if section == None:
+        above = self.above[section]
+        if above != None and elevation <= above.getElevationAtAzimuth(azimuth):
             return False
-        sunlit = True
-        if self.openings[section].get('above') != None:
-            e1 = self.openings[section]['above'].getElevationAtAzimuth(azimuth)
-            self.logger.debug ("above: " + str(elevation) + ">" + str(e1) )
-            sunlit = float(str(elevation)) > e1
-        if self.openings[section].get('below') != None:
-            e2 = self.openings[section]['below'].getElevationAtAzimuth(azimuth)
-            self.logger.debug ("below: " + str(elevation) + "<" + str(e2) )
-            sunlit = sunlit and (float(str(elevation)) < e2)
-        return sunlit
+        below = self.below[section]
+        if below != None and elevation >= below.getElevationAtAzimuth(azimuth):
+            return False
+        return True
 
 #######################################################
 # tests
@@ -463,13 +1091,421 @@ class ShutterTest():
             """))
         assert se2.isSunlit(200, 9) == True
 
+    def rasterTest(self):
+        self.logger.info("rasterTest")
+        config = Yaml().load("""
+            orientation: 240
+            sun_openings:
+              - azimuth: 160
+                below:
+                  - { azimuth: 240, elevation: 60 }
+                above:
+                  - { elevation: 5 }
+              - azimuth: 240
+                below:
+                  - { azimuth: 240, elevation: 60 }
+                  - { azimuth: 280, elevation: 10 }
+                above:
+                  - { azimuth: 240, elevation: 3 }
+              - azimuth: 280
+                below:
+                  - { azimuth: 280, elevation: 60, angle: 35 }
+                above:
+                  - { azimuth: 240, elevation: 3 }
+              - azimuth: 330.5
+            """)
+        se = SunExposure(config, 0.7)
+        assert se.raster != None
+        exact = 0
+        for a in range(1400, 3400, 7):
+            for e in range(-100, 900, 9):
+                azimuth = a / 10.0
+                elevation = e / 10.0
+                if se.raster.lookup(azimuth, elevation) == None:
+                    exact += 1
+                assert se.isSunlit(azimuth, elevation) == se._isSunlit(azimuth, elevation)
+        self.logger.debug("exact evaluations: " + str(exact))
+
+        se2 = SunExposure(config, 0)
+        assert se2.raster == None
+        assert se2.isSunlit(241, 4) == True
+
+    def batchTest(self):
+        self.logger.info("batchTest")
+        se = SunExposure(Yaml().load("""
+            orientation: 240
+            sun_openings:
+              - azimuth: 160
+                below:
+                  - { azimuth: 240, elevation: 60 }
+                above:
+                  - { elevation: 5 }
+              - azimuth: 240
+                below:
+                  - { azimuth: 240, elevation: 60 }
+                  - { azimuth: 280, elevation: 10 }
+                above:
+                  - { azimuth: 240, elevation: 3 }
+              - azimuth: 330
+            """))
+        azimuths = []
+        elevations = []
+        for a in range(100, 360, 3):
+            for e in range(-10, 90, 4):
+                azimuths.append(a + 0.25)
+                elevations.append(e + 0.5)
+        batch = se.isSunlitBatch(azimuths, elevations)
+        assert len(batch) == len(azimuths)
+        for i in range(len(azimuths)):
+            assert bool(batch[i]) == se.isSunlit(azimuths[i], elevations[i])
+        line = se.getObstacle(240, 'below')
+        elevations = line.getElevationsAtAzimuths([200, 240, 270])
+        assert abs(elevations[1] - line.getElevationAtAzimuth(240)) < 1e-9
+
+    def internTest(self):
+        self.logger.info("internTest")
+        exposureConfig = Yaml().load("""
+            shutter_a: { orientation: 240, sun_openings: [ { azimuth: 160, above: [ { elevation: 5 } ] }, { azimuth: 330 } ] }
+            shutter_b: { orientation: 240, sun_openings: [ { azimuth: 160, above: [ { elevation: 5 } ] }, { azimuth: 330 } ] }
+            shutter_c: { orientation: 240, sun_openings: [ { azimuth: 160, above: [ { elevation: 5 } ] }, { azimuth: 300 } ] }
+            """)
+        exposure = createSunExposures(exposureConfig, {})
+        assert exposure['shutter_a'] is exposure['shutter_b']
+        assert exposure['shutter_a'] is not exposure['shutter_c']
+        assert exposure['shutter_a'].getObstacle(160, 'above') is exposure['shutter_c'].getObstacle(160, 'above')
+        assert not exposure['shutter_c'].isSunlit(310, 30)
+        assert exposure['shutter_a'].isSunlit(310, 30)
+
+        # a reload only caches the obstacles of the new models
+        clearObstacleCache()
+        exposure = createSunExposures(Yaml().load("""
+            shutter_a: { orientation: 240, sun_openings: [ { azimuth: 160, above: [ { elevation: 5 } ] }, { azimuth: 330 } ] }
+            shutter_c: { orientation: 240, sun_openings: [ { azimuth: 160, above: [ { elevation: 7 } ] }, { azimuth: 300 } ] }
+            """), {}, exposure)
+        assert exposure['shutter_a'].getObstacle(160, 'above') is not exposure['shutter_c'].getObstacle(160, 'above')
+        assert list(obstacleCache.values()) == [exposure['shutter_c'].getObstacle(160, 'above')]
+
+    def profileTest(self):
+        self.logger.info("profileTest")
+        profile = Profile(240, Yaml().load("{ profile: [ [200, 20], [160, 10], [180, 30], [220, 5] ] }"))
+        assert profile.getElevationAtAzimuth(150) == 10
+        assert profile.getElevationAtAzimuth(170) == 20
+        assert profile.getElevationAtAzimuth(190) == 25
+        assert profile.getElevationAtAzimuth(230) == 5
+        assert profile.getElevationRange(170, 210) == (12.5, 30)
+        assert list(profile.getElevationsAtAzimuths([170, 190])) == [20, 25]
+
+        se = SunExposure(Yaml().load("""
+            orientation: 240
+            sun_openings:
+              - azimuth: 160
+                above:
+                  - { profile: [ [160, 10], [180, 30], [200, 20], [220, 5] ] }
+              - azimuth: 330
+            """))
+        assert not se.isSunlit(180, 25)
+        assert se.isSunlit(190, 26)
+        assert se.isSunlit(215, 10)
+        assert se.isSunlitBatch([180, 190], [25, 26])[1]
+
     def run(self):
         self.logger.info("TEST start")
         try:
             self.horizonTest()
             self.hLineTest()
             self.lineTest()
+            self.internTest()
+            self.profileTest()
             self.sunExposureTest()
+            self.rasterTest()
+            self.batchTest()
+        except Exception as e:
+            self.logger.error(traceback.format_exc())
+
+        self.logger.info("TEST end")
+
+#######################################################
+#######################################################
+#######################################################
+# Sun position
+
+# NOAA solar position algorithm (see https://www.esrl.noaa.gov/gmd/grad/solcalc/calcdetails.html)
+# timestamp: seconds since epoch (UTC); returns (azimuth, elevation) in degrees
+# no atmospheric refraction correction (same as the astro binding)
+def sunPosition(latitude, longitude, timestamp):
+    radians = math.radians
+    degrees = math.degrees
+    jc = (timestamp / 86400.0 + 2440587.5 - 2451545.0) / 36525.0
+    meanLong = (280.46646 + jc * (36000.76983 + jc * 0.0003032)) % 360
+    meanAnom = 357.52911 + jc * (35999.05029 - 0.0001537 * jc)
+    eccent = 0.016708634 - jc * (0.000042037 + 0.0000001267 * jc)
+    m = radians(meanAnom)
+    eqOfCenter = math.sin(m) * (1.914602 - jc * (0.004817 + 0.000014 * jc)) \
+        + math.sin(2 * m) * (0.019993 - 0.000101 * jc) + math.sin(3 * m) * 0.000289
+    omega = radians(125.04 - 1934.136 * jc)
+    appLong = meanLong + eqOfCenter - 0.00569 - 0.00478 * math.sin(omega)
+    meanObliq = 23 + (26 + (21.448 - jc * (46.815 + jc * (0.00059 - jc * 0.001813))) / 60) / 60
+    obliq = radians(meanObliq + 0.00256 * math.cos(omega))
+    declination = math.asin(math.sin(obliq) * math.sin(radians(appLong)))
+    y = math.tan(obliq / 2) ** 2
+    l0 = radians(meanLong)
+    eqOfTime = 4 * degrees(y * math.sin(2 * l0) - 2 * eccent * math.sin(m)
+        + 4 * eccent * y * math.sin(m) * math.cos(2 * l0)
+        - 0.5 * y * y * math.sin(4 * l0) - 1.25 * eccent * eccent * math.sin(2 * m))
+    trueSolarTime = ((timestamp % 86400) / 60.0 + eqOfTime + 4 * longitude) % 1440
+    hourAngle = radians(trueSolarTime / 4 - 180)
+    lat = radians(latitude)
+    cosZenith = math.sin(lat) * math.sin(declination) + math.cos(lat) * math.cos(declination) * math.cos(hourAngle)
+    zenith = math.acos(max(-1.0, min(1.0, cosZenith)))
+    elevation = 90 - degrees(zenith)
+    denominator = math.cos(lat) * math.sin(zenith)
+    if abs(denominator) < 1e-12:
+        return (180.0, elevation)
+    cosAzimuth = (math.sin(lat) * math.cos(zenith) - math.sin(declination)) / denominator
+    azimuth = degrees(math.acos(max(-1.0, min(1.0, cosAzimuth))))
+    if hourAngle > 0:
+        azimuth = (azimuth + 180) % 360
+    else:
+        azimuth = (540 - azimuth) % 360
+    return (azimuth, elevation)
+
+def getLocation(settings):
+    location = settings.get('location')
+    if location == None:
+        return findGeolocation(thingsDir)
+    return (float(location['latitude']), float(location['longitude']))
+
+# geolocation of the astro binding's sun thing, e.g.:
+#   astro:sun:local [ geolocation="46.000,8.8000", altitude=600, interval=30 ]
+def findGeolocation(directory):
+    logger = LoggerFactory.getLogger(logger_name + ".findGeolocation")
+    pattern = re.compile(r'astro:sun:\S+\s*\[[^\]]*geolocation\s*=\s*"\s*([-0-9.]+)\s*,\s*([-0-9.]+)')
+    if not os.path.isdir(directory):
+        return None
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.things'):
+            continue
+        match = pattern.search(open(os.path.join(directory, name)).read())
+        if match != None:
+            logger.info("Using geolocation from " + name + ": " + match.group(1) + "," + match.group(2))
+            return (float(match.group(1)), float(match.group(2)))
+    return None
+
+# local midnight of the given date and of the day after (seconds since epoch)
+def getDayBounds(day):
+    start = time.mktime(day.timetuple())
+    end = time.mktime((day + datetime.timedelta(days=1)).timetuple())
+    return (start, end)
+
+#######################################################
+# Solar engine: sun positions for any time, with the trajectories of the
+# most recently used days cached at minute resolution
+
+class SolarEngine():
+    def __init__(self, location, cacheSize=3):
+        self.logger = LoggerFactory.getLogger(logger_name + ".SolarEngine")
+        self.latitude, self.longitude = location
+        self.cacheSize = cacheSize
+        self.trajectories = OrderedDict()
+
+    def position(self, timestamp):
+        return sunPosition(self.latitude, self.longitude, timestamp)
+
+    # (start, azimuths, elevations) of a local day, one entry per minute including the next midnight
+    def trajectory(self, day):
+        trajectory = self.trajectories.pop(day, None)
+        if trajectory == None:
+            start, end = getDayBounds(day)
+            azimuths = []
+            elevations = []
+            t = start
+            while t <= end:
+                azimuth, elevation = self.position(t)
+                azimuths.append(azimuth)
+                elevations.append(elevation)
+                t += 60
+            trajectory = (start, azimuths, elevations)
+            self.logger.debug("trajectory calculated: " + str(day))
+            while len(self.trajectories) >= self.cacheSize:
+                self.trajectories.popitem(last=False)
+        self.trajectories[day] = trajectory
+        return trajectory
+
+    # first time of the day at which the sun crosses the given elevation
+    def findCrossing(self, day, elevation, rising):
+        start, azimuths, elevations = self.trajectory(day)
+        for i in range(1, len(elevations)):
+            e1 = elevations[i - 1]
+            e2 = elevations[i]
+            if (rising and e1 < elevation <= e2) or (not rising and e1 > elevation >= e2):
+                return start + 60 * (i - 1 + (elevation - e1) / (e2 - e1))
+        return None
+
+    # interpolated from the cached trajectory
+    def positionAt(self, timestamp):
+        start, azimuths, elevations = self.trajectory(datetime.date.fromtimestamp(timestamp))
+        i = int((timestamp - start) // 60)
+        if i < 0 or i + 1 >= len(azimuths):
+            return self.position(timestamp)
+        f = (timestamp - start) / 60.0 - i
+        a1 = azimuths[i]
+        a2 = azimuths[i + 1]
+        if a2 - a1 > 180:
+            a2 -= 360
+        elif a1 - a2 > 180:
+            a2 += 360
+        azimuth = (a1 + f * (a2 - a1)) % 360
+        elevation = elevations[i] + f * (elevations[i + 1] - elevations[i])
+        return (azimuth, elevation)
+
+#######################################################
+# sunlit intervals of a shutter for one day
+
+class SunlitTimeline():
+    def __init__(self, start, end, intervals):
+        self.start = start
+        self.end = end
+        self.intervals = intervals
+        self.starts = [i[0] for i in intervals]
+
+    def covers(self, timestamp):
+        return self.start <= timestamp < self.end
+
+    def isSunlitAt(self, timestamp):
+        i = bisect.bisect_right(self.starts, timestamp) - 1
+        return i >= 0 and timestamp < self.intervals[i][1]
+
+    # times at which the sunlit state changes
+    def getTransitions(self):
+        transitions = []
+        for interval in self.intervals:
+            if interval[0] > self.start:
+                transitions.append(interval[0])
+            if interval[1] < self.end:
+                transitions.append(interval[1])
+        return transitions
+
+# margin offsets probed around the sun position, see SunExposureRule.applyMargin
+def getMarginProbes(margin):
+    return [(0, 0), (margin, 0), (-margin, 0), (0, margin), (0, -margin)]
+
+# margins: {shutterName: sunlit_margin}. With a margin the sunlit state changes once the
+# sun is margin degrees past the edge, like SunExposureRule.applyMargin does.
+def computeSunlitTimelines(exposure, engine, day, margins=None):
+    logger = LoggerFactory.getLogger(logger_name + ".computeSunlitTimelines")
+    start, azimuths, elevations = engine.trajectory(day)
+    end = getDayBounds(day)[1]
+    times = [start + 60 * i for i in range(len(azimuths))]
+    times[-1] = end
+    timelines = {}
+    # shared models are evaluated once per margin
+    modelTimelines = {}
+    for shutterName in exposure:
+        sunExposure = exposure[shutterName]
+        margin = margins.get(shutterName, 0) if margins != None else 0
+        key = (id(sunExposure), margin)
+        if key in modelTimelines:
+            timelines[shutterName] = modelTimelines[key]
+            continue
+        probes = getMarginProbes(margin) if margin > 0 else [(0, 0)]
+        probed = [sunExposure.isSunlitBatch([(azimuth + da) % 360 for azimuth in azimuths], [elevation + de for elevation in elevations])
+                  for da, de in probes]
+        # the state changes to sunlit when all probes are sunlit, back when none is
+        def sampledAt(i, sunlit):
+            values = [bool(p[i]) for p in probed]
+            return any(values) if sunlit else all(values)
+        def sunlitAt(t, sunlit):
+            azimuth, elevation = engine.position(t)
+            values = [sunExposure.isSunlit((azimuth + da) % 360, elevation + de) for da, de in probes]
+            return any(values) if sunlit else all(values)
+        sunlit = bool(probed[0][0])
+        intervals = []
+        intervalStart = start if sunlit else None
+        for i in range(1, len(times)):
+            if sampledAt(i, sunlit) == sunlit:
+                continue
+            # refine the transition to the second
+            t1 = times[i - 1]
+            t2 = times[i]
+            while t2 - t1 > 1:
+                t = (t1 + t2) // 2
+                if sunlitAt(t, sunlit) == sunlit:
+                    t1 = t
+                else:
+                    t2 = t
+            sunlit = not sunlit
+            if sunlit:
+                intervalStart = t2
+            else:
+                intervals.append((intervalStart, t2))
+                intervalStart = None
+        if intervalStart != None:
+            intervals.append((intervalStart, end))
+        timelines[shutterName] = SunlitTimeline(start, end, intervals)
+        modelTimelines[key] = timelines[shutterName]
+        logger.info(shutterName + " sunlit: " + ", ".join(
+            [time.strftime("%H:%M:%S", time.localtime(i[0])) + "-" + time.strftime("%H:%M:%S", time.localtime(i[1]))
+             for i in intervals]))
+    return timelines
+
+#######################################################
+# tests
+class SunPositionTest():
+    def __init__(self):
+        self.logger = LoggerFactory.getLogger(logger_name + ".SunPositionTest")
+
+    def sunPositionTest(self):
+        self.logger.info("sunPositionTest")
+        # 2017-06-21 11:25 UTC: solar noon at 46N/8.8E
+        azimuth, elevation = sunPosition(46.0, 8.8, 1498044300)
+        assert abs(elevation - 67.4) < 0.5
+        assert abs(azimuth - 180) < 2
+        # 2017-12-21 16:00 UTC: after sunset
+        azimuth, elevation = sunPosition(46.0, 8.8, 1513872000)
+        assert elevation < 0
+        assert azimuth > 230 and azimuth < 260
+
+    def timelineTest(self):
+        self.logger.info("timelineTest")
+        exposure = {"shutter_living": SunExposure(Yaml().load("""
+            orientation: 240
+            sun_openings:
+              - azimuth: 160
+                above:
+                  - { elevation: 5 }
+              - azimuth: 330
+            """))}
+        day = datetime.date(2017, 6, 21)
+        timeline = computeSunlitTimelines(exposure, SolarEngine((46.0, 8.8)), day)["shutter_living"]
+        assert len(timeline.intervals) == 1
+        for t in range(int(timeline.start), int(timeline.end), 300):
+            azimuth, elevation = sunPosition(46.0, 8.8, t)
+            assert timeline.isSunlitAt(t) == exposure["shutter_living"].isSunlit(azimuth, elevation)
+        assert len(timeline.getTransitions()) == 2
+
+    def solarEngineTest(self):
+        self.logger.info("solarEngineTest")
+        engine = SolarEngine((46.0, 8.8), 2)
+        day = datetime.date(2017, 6, 21)
+        start = getDayBounds(day)[0]
+        for t in range(int(start), int(start) + 86400, 997):
+            exact = engine.position(t)
+            interpolated = engine.positionAt(t)
+            assert abs(exact[1] - interpolated[1]) < 0.05
+            assert abs((exact[0] - interpolated[0] + 180) % 360 - 180) < 0.1
+        engine.trajectory(datetime.date(2017, 6, 22))
+        engine.trajectory(datetime.date(2017, 6, 23))
+        assert len(engine.trajectories) == 2
+        assert day not in engine.trajectories
+
+        assert findGeolocation("/nonexistent") == None
+
+    def run(self):
+        self.logger.info("TEST start")
+        try:
+            self.sunPositionTest()
+            self.timelineTest()
+            self.solarEngineTest()
         except Exception as e:
             self.logger.error(traceback.format_exc())
 
@@ -480,22 +1516,812 @@ class ShutterTest():
 #######################################################
 # Rules
 
+#######################################################
+# Item access: the rules read and write items through an item bus, so that
+# they can also run against simulated items.
+
+class OpenhabItemBus():
+    def exists(self, itemName):
+        return ir.get(itemName) != None
+
+    def getState(self, itemName):
+        return ir.get(itemName).getState().toString()
+
+    def isOn(self, itemName):
+        return self.getState(itemName) == "ON"
+
+    def postUpdate(self, itemName, state):
+        events.postUpdate(itemName, state)
+
+    def sendCommand(self, itemName, command):
+        events.sendCommand(itemName, command)
+
+    def flush(self):
+        pass
+
+class SimulatedItemBus():
+    def __init__(self, states=None, commandListener=None):
+        self.states = dict(states) if states != None else {}
+        self.commandListener = commandListener
+
+    def exists(self, itemName):
+        return True
+
+    def getState(self, itemName):
+        return self.states.get(itemName, "NULL")
+
+    def isOn(self, itemName):
+        return self.getState(itemName) == "ON"
+
+    def postUpdate(self, itemName, state):
+        self.states[itemName] = state
+
+    def sendCommand(self, itemName, command):
+        self.states[itemName] = command
+        if self.commandListener != None:
+            self.commandListener(itemName, command)
+
+    def flush(self):
+        pass
+
+openhabItemBus = OpenhabItemBus()
+
+# state of the two state items of a rollershutter, its reported position and the last
+# command sent to it
+class ShutterState(object):
+    __slots__ = ['auto', 'sunlit', 'position', 'commanded', 'commandedAt', 'positionAtCommand', 'sunlitChangedAt']
+
+    def __init__(self):
+        self.auto = "NULL"
+        self.sunlit = "NULL"
+        self.position = "NULL"
+        self.commanded = None
+        self.commandedAt = 0
+        self.positionAtCommand = None
+        # time of the last sunlit transition, kept across reloads of the rules
+        self.sunlitChangedAt = None
+
+# seconds after which a command is sent again, even if it seems redundant
+defaultCommandResendInterval = 6 * 3600
+
+# position reported after a command was executed
+commandPositions = {"UP": "0", "DOWN": "100"}
+
+# known state values, so the cache holds the shared constants instead of new strings
+cachedStateValues = dict((value, value) for value in [autoStateSun, autoStateDown, autoStateUp, autoStateManual,
+                                                       sunlitStateUnknown, sunlitStateTrue, sunlitStateFalse, "NULL"])
+
+# in-memory copy of the states of the items read by the rules. Kept up to date by the
+# StateCacheRule (external updates) and by the updates posted through the cache itself.
+# Items that are not tracked are passed on to the underlying bus.
+# Updates of tracked items are written behind: unchanged values are dropped and the
+# others are posted when the rule execution ends (flush), the last value per item only.
+class StateCache():
+    def __init__(self, bus=None):
+        self.logger = LoggerFactory.getLogger(logger_name + ".StateCache")
+        self.bus = bus if bus != None else openhabItemBus
+        self.shutters = {}
+        self.switches = {}
+        self.values = {}
+        # item name -> (shutter state, attribute)
+        self.shutterItems = {}
+        # item name -> state before the first deferred update
+        self.pending = OrderedDict()
+        self.pendingStates = {}
+        # rules (e.g. the facade shards) run concurrently
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.updates = 0
+        self.writes = 0
+        self.writesSaved = 0
+        self.resendInterval = defaultCommandResendInterval
+        self.clock = time.time
+        self.commandsSent = 0
+        self.commandsSuppressed = 0
+
+    # (re)defines the cached items; states of newly tracked items are read once from the bus
+    def track(self, shutterNames, switchItems, valueItems=None):
+        shutters = {}
+        shutterItems = {}
+        for shutterName in shutterNames:
+            state = self.shutters.get(shutterName)
+            if state == None:
+                state = ShutterState()
+                if self.bus.exists(prefix_auto + shutterName):
+                    state.auto = self._value(self.bus.getState(prefix_auto + shutterName))
+                if self.bus.exists(prefix_sunlit + shutterName):
+                    state.sunlit = self._value(self.bus.getState(prefix_sunlit + shutterName))
+                if self.bus.exists(shutterName):
+                    state.position = self._value(self.bus.getState(shutterName))
+            shutters[shutterName] = state
+            shutterItems[prefix_auto + shutterName] = (state, 'auto')
+            shutterItems[prefix_sunlit + shutterName] = (state, 'sunlit')
+            shutterItems[shutterName] = (state, 'position')
+        switches = {}
+        for itemName in switchItems:
+            if itemName in self.switches:
+                switches[itemName] = self.switches[itemName]
+            elif self.bus.exists(itemName):
+                switches[itemName] = self.bus.isOn(itemName)
+        values = {}
+        for itemName in valueItems or []:
+            if itemName in self.values:
+                values[itemName] = self.values[itemName]
+            elif self.bus.exists(itemName):
+                values[itemName] = self.bus.getState(itemName)
+        self.shutters = shutters
+        self.shutterItems = shutterItems
+        self.switches = switches
+        self.values = values
+        self.logger.info("Tracking " + str(len(shutterItems) + len(switches) + len(values)) + " items")
+
+    def getTrackedItems(self):
+        return sorted(list(self.shutterItems) + list(self.switches) + list(self.values))
+
+    def getShutterState(self, shutterName):
+        return self.shutters.get(shutterName)
+
+    def _value(self, state):
+        state = str(state)
+        return cachedStateValues.get(state, state)
+
+    # called for every state update of a tracked item
+    def update(self, itemName, state):
+        self.updates += 1
+        entry = self.shutterItems.get(itemName)
+        if entry != None:
+            setattr(entry[0], entry[1], self._value(state))
+        elif itemName in self.switches:
+            self.switches[itemName] = str(state) == "ON"
+        elif itemName in self.values:
+            self.values[itemName] = str(state)
+
+    def exists(self, itemName):
+        return itemName in self.shutterItems or itemName in self.switches or itemName in self.values \
+            or self.bus.exists(itemName)
+
+    def getState(self, itemName):
+        entry = self.shutterItems.get(itemName)
+        if entry != None:
+            self.lookups += 1
+            return getattr(entry[0], entry[1])
+        if itemName in self.switches:
+            self.lookups += 1
+            return "ON" if self.switches[itemName] else "OFF"
+        value = self.values.get(itemName)
+        if value != None:
+            self.lookups += 1
+            return value
+        return self.bus.getState(itemName)
+
+    def isOn(self, itemName):
+        isOn = self.switches.get(itemName)
+        if isOn != None:
+            self.lookups += 1
+            return isOn
+        return self.bus.isOn(itemName)
+
+    def postUpdate(self, itemName, state):
+        entry = self.shutterItems.get(itemName)
+        if entry == None:
+            self.writes += 1
+            self.bus.postUpdate(itemName, state)
+            return
+        with self.lock:
+            current = getattr(entry[0], entry[1])
+            if itemName not in self.pending:
+                if current == str(state):
+                    self.writesSaved += 1
+                    return
+                self.pending[itemName] = current
+            elif self.pending[itemName] == str(state):
+                # back to the state that was last written
+                del self.pending[itemName]
+                self.writesSaved += 1
+            else:
+                self.writesSaved += 1
+            self.pendingStates[itemName] = state
+            self.update(itemName, state)
+
+    # posts the deferred updates
+    def flush(self):
+        with self.lock:
+            pending, states = self.pending, self.pendingStates
+            if len(pending) > 0:
+                self.pending, self.pendingStates = OrderedDict(), {}
+        if len(pending) > 0:
+            for itemName in pending:
+                self.writes += 1
+                self.bus.postUpdate(itemName, states[itemName])
+            self.logger.debug("Flushed " + str(len(pending)) + " updates; " + str(self.writesSaved) + " saved so far")
+        # e.g. closes the command batch of the CommandDispatcher
+        if hasattr(self.bus, 'flush'):
+            self.bus.flush()
+
+    def getWriteStats(self):
+        return {'writes': self.writes, 'writesSaved': self.writesSaved}
+
+    # a command is redundant if it was sent before and the position reported since
+    # is the one it leads to. Unknown positions (e.g. one-way shutters, after a restart)
+    # never suppress a command.
+    def isRedundant(self, state, command, now):
+        if self.resendInterval <= 0 or state.commanded != command or now - state.commandedAt >= self.resendInterval:
+            return False
+        if state.position in ["NULL", "UNDEF"]:
+            return False
+        expected = commandPositions.get(command, command if command.isdigit() else None)
+        if expected != None:
+            return state.position == expected
+        # e.g. STOP: nothing moved since
+        return state.position == state.positionAtCommand
+
+    def sendCommand(self, itemName, command):
+        state = self.shutters.get(itemName)
+        if state != None:
+            now = self.clock()
+            if self.isRedundant(state, command, now):
+                self.commandsSuppressed += 1
+                metrics.inc('shutters_commands_suppressed_total', (('shutter', itemName), ('action', command)))
+                self.logger.info("Suppressed redundant command: " + itemName + "=" + command)
+                return
+            state.commanded = command
+            state.commandedAt = now
+            state.positionAtCommand = state.position
+        self.commandsSent += 1
+        metrics.inc('shutters_commands_total', (('shutter', itemName), ('action', command)))
+        self.bus.sendCommand(itemName, command)
+
+# trigger time and name of the rule executed by the current thread
+ruleExecution = threading.local()
+
+# commands sent by one rule execution; done when the last one was sent
+class CommandBatch():
+    def __init__(self, ruleName, triggeredAt):
+        self.ruleName = ruleName
+        self.triggeredAt = triggeredAt
+        self.pending = 0
+        self.commands = 0
+        self.failed = 0
+        # time the last command that got through was sent
+        self.lastSent = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+# sends the commands of the rollershutters of one bridge (e.g. a RFXCOM transceiver)
+# one after the other, at least spacing seconds apart
+class CommandQueue():
+    def __init__(self, name, bus, spacing=0, retries=0, onSent=None):
+        self.logger = LoggerFactory.getLogger(logger_name + ".CommandQueue." + name)
+        self.name = name
+        self.bus = bus
+        self.spacing = spacing
+        self.retries = retries
+        self.onSent = onSent
+        self.queue = Queue()
+        self.lastSent = 0
+        self.thread = Thread(target=lambda: self.drain())
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def put(self, itemName, command, batch):
+        self.queue.put((itemName, command, batch))
+
+    def stop(self):
+        self.queue.put(None)
+
+    def join(self):
+        self.queue.join()
+
+    def drain(self):
+        while True:
+            entry = self.queue.get()
+            try:
+                if entry == None:
+                    return
+                itemName, command, batch = entry
+                sent = True
+                for attempt in range(self.retries + 1):
+                    wait = self.lastSent + self.spacing - time.time()
+                    if wait > 0:
+                        time.sleep(wait)
+                    self.lastSent = time.time()
+                    try:
+                        self.bus.sendCommand(itemName, command)
+                        break
+                    except Exception as e:
+                        self.logger.warn("Sending " + itemName + "=" + command + " failed (attempt " + str(attempt + 1) + "): " + str(e))
+                else:
+                    sent = False
+                    self.logger.error("Dropped " + itemName + "=" + command + " after " + str(self.retries + 1) + " attempts")
+                    metrics.inc('shutters_commands_failed_total', (('shutter', itemName), ('action', command)))
+                if self.onSent != None:
+                    self.onSent(batch, sent)
+            except:
+                self.logger.error(traceback.format_exc())
+            finally:
+                self.queue.task_done()
+
+# routes commands to a queue per bridge, so a burst of commands doesn't overwhelm a
+# transmitter. Queues of different bridges are drained in parallel, the rule thread
+# doesn't wait.
+class CommandDispatcher():
+    def __init__(self, queueConfig, bus=None):
+        self.logger = LoggerFactory.getLogger(logger_name + ".CommandDispatcher")
+        self.bus = bus if bus != None else openhabItemBus
+        self.queueConfig = queueConfig
+        self.queues = {}
+        self.routes = {}
+        for name in queueConfig:
+            config = queueConfig[name] or {}
+            self.queues[name] = CommandQueue(name, self.bus, float(config.get('spacing') or 0), int(config.get('retries') or 0),
+                                             self.commandSent)
+            for itemName in config.get('items') or []:
+                self.routes[itemName] = name
+        if 'default' not in self.queues:
+            self.queues['default'] = CommandQueue('default', self.bus, onSent=self.commandSent)
+        self.batches = threading.local()
+        # seconds from the trigger until the last command of an execution was sent
+        self.latencies = []
+
+    def exists(self, itemName):
+        return self.bus.exists(itemName)
+
+    def getState(self, itemName):
+        return self.bus.getState(itemName)
+
+    def isOn(self, itemName):
+        return self.bus.isOn(itemName)
+
+    def postUpdate(self, itemName, state):
+        self.bus.postUpdate(itemName, state)
+
+    def sendCommand(self, itemName, command):
+        batch = getattr(self.batches, 'batch', None)
+        if batch == None:
+            batch = CommandBatch(getattr(ruleExecution, 'ruleName', None), getattr(ruleExecution, 'triggeredAt', None) or time.time())
+            self.batches.batch = batch
+        with batch.lock:
+            batch.pending += 1
+            batch.commands += 1
+        self.queues[self.routes.get(itemName, 'default')].put(itemName, command, batch)
+
+    # no more commands for the batch of this thread
+    def flush(self):
+        self.bus.flush()
+        batch = getattr(self.batches, 'batch', None)
+        if batch == None:
+            return
+        self.batches.batch = None
+        with batch.lock:
+            batch.closed = True
+            done = batch.pending == 0
+        if done:
+            self.batchDone(batch)
+
+    # sent: False if the command was dropped after the last retry
+    def commandSent(self, batch, sent=True):
+        with batch.lock:
+            batch.pending -= 1
+            if sent:
+                batch.lastSent = time.time()
+            else:
+                batch.failed += 1
+            done = batch.closed and batch.pending == 0
+        if done:
+            self.batchDone(batch)
+
+    # the latency is the one of the last command that got through
+    def batchDone(self, batch):
+        failed = (", " + str(batch.failed) + " failed") if batch.failed > 0 else ""
+        if batch.lastSent == None:
+            self.logger.info(str(batch.ruleName) + ": no command sent" + failed)
+            return
+        latency = batch.lastSent - batch.triggeredAt
+        self.latencies = self.latencies[-99:] + [latency]
+        metrics.observe('shutters_command_latency_seconds', latency)
+        self.logger.info(str(batch.ruleName) + ": " + str(batch.commands - batch.failed) + " commands sent" + failed + "; last one " +
+                         "%.1f" % latency + "s after the trigger")
+
+    # waits until all queued commands were sent
+    def join(self):
+        for name in self.queues:
+            self.queues[name].join()
+
+    def stop(self):
+        for name in self.queues:
+            self.queues[name].stop()
+
+#######################################################
+# Metrics: counters and histograms in the prometheus text format
+
+metricDefinitions = {
+    'shutters_sunlit_evaluations_total': ('counter', 'Sunlit evaluations of a rollershutter.'),
+    'shutters_commands_total': ('counter', 'Commands sent to a rollershutter.'),
+    'shutters_commands_suppressed_total': ('counter', 'Redundant commands not sent to a rollershutter.'),
+    'shutters_commands_failed_total': ('counter', 'Commands dropped after the last retry failed.'),
+    'shutters_rule_executions_total': ('counter', 'Rule executions.'),
+    'shutters_config_reloads_total': ('counter', 'Config (re)loads.'),
+    'shutters_state_updates_written_total': ('counter', 'Updates of state items written.'),
+    'shutters_state_updates_saved_total': ('counter', 'Updates of state items not written because they did not change anything.'),
+    'shutters_rule_duration_seconds': ('histogram', 'Wall time of a rule execution.'),
+    'shutters_command_latency_seconds': ('histogram', 'Time from a trigger until the last command of the execution was sent.'),
+}
+
+metricsBuckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+class Metrics():
+    def __init__(self):
+        self.logger = LoggerFactory.getLogger(logger_name + ".Metrics")
+        # name -> labels -> value
+        self.counters = {}
+        # name -> labels -> [bucket counts, sum, count]
+        self.histograms = {}
+        # functions returning [(name, labels, value)] of counters kept elsewhere
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    # labels: tuple of (label, value)
+    def inc(self, name, labels=(), amount=1):
+        with self.lock:
+            counter = self.counters.get(name)
+            if counter == None:
+                counter = {}
+                self.counters[name] = counter
+            counter[labels] = counter.get(labels, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram == None:
+                histogram = {}
+                self.histograms[name] = histogram
+            entry = histogram.get(labels)
+            if entry == None:
+                entry = [[0] * len(metricsBuckets), 0.0, 0]
+                histogram[labels] = entry
+            i = bisect.bisect_left(metricsBuckets, value)
+            if i < len(metricsBuckets):
+                entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def get(self, name, labels=()):
+        return self.counters.get(name, {}).get(labels, 0)
+
+    def _labels(self, labels, extra=None):
+        labels = list(labels)
+        if extra != None:
+            labels.append(extra)
+        if len(labels) == 0:
+            return ""
+        return "{" + ",".join([k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"') + '"' for k, v in labels]) + "}"
+
+    def render(self):
+        counters = {}
+        with self.lock:
+            for name in self.counters:
+                counters[name] = dict(self.counters[name])
+            histograms = {}
+            for name in self.histograms:
+                histograms[name] = dict([(labels, [list(e[0]), e[1], e[2]]) for labels, e in self.histograms[name].items()])
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                counters.setdefault(name, {})[labels] = value
+        lines = []
+        for name in sorted(counters):
+            definition = metricDefinitions.get(name, ('counter', ''))
+            lines.append("# HELP " + name + " " + definition[1])
+            lines.append("# TYPE " + name + " " + definition[0])
+            for labels in sorted(counters[name]):
+                lines.append(name + self._labels(labels) + " " + str(counters[name][labels]))
+        for name in sorted(histograms):
+            lines.append("# HELP " + name + " " + metricDefinitions.get(name, ('', ''))[1])
+            lines.append("# TYPE " + name + " histogram")
+            for labels in sorted(histograms[name]):
+                buckets, total, count = histograms[name][labels]
+                cumulative = 0
+                for i in range(len(metricsBuckets)):
+                    cumulative += buckets[i]
+                    lines.append(name + "_bucket" + self._labels(labels, ('le', str(metricsBuckets[i]))) + " " + str(cumulative))
+                lines.append(name + "_bucket" + self._labels(labels, ('le', '+Inf')) + " " + str(count))
+                lines.append(name + "_sum" + self._labels(labels) + " " + repr(total))
+                lines.append(name + "_count" + self._labels(labels) + " " + str(count))
+        return "\n".join(lines) + "\n"
+
+    # e.g. for the textfile collector of the node exporter
+    def writeFile(self, fileName):
+        temporary = fileName + ".tmp"
+        out = open(temporary, 'w')
+        try:
+            out.write(self.render())
+        finally:
+            out.close()
+        os.rename(temporary, fileName)
+
+metrics = Metrics()
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *arguments):
+        pass
+
+#######################################################
+# Timing: wall time of the rule executions, their phases and the loaders
+
+# records the time spent in each phase of a run: phase(name) ends the previous phase
+class PhaseTimer():
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+        self.current = None
+        self.started = time.time()
+        self.elapsed = {}
+
+    def phase(self, name):
+        now = time.time()
+        if self.current != None:
+            self.elapsed[self.current] = self.elapsed.get(self.current, 0) + now - self.started
+        self.current = name
+        self.started = now
+
+    def stop(self):
+        self.phase(None)
+        for phase in self.elapsed:
+            self.timings.record(self.name + ":" + phase, self.elapsed[phase])
+
+class NullPhaseTimer():
+    def phase(self, name):
+        pass
+
+    def stop(self):
+        pass
+
+nullPhaseTimer = NullPhaseTimer()
+
+class RuleTimings():
+    def __init__(self, size=500):
+        self.logger = LoggerFactory.getLogger(logger_name + ".RuleTimings")
+        self.enabled = False
+        self.size = size
+        # name -> the last size durations in seconds
+        self.samples = {}
+        self.profiling = False
+        self.profileExecutions = 0
+        self.profileStats = None
+        self.profileOut = None
+        self.profileDone = None
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds):
+        samples = self.samples.get(name)
+        if samples == None:
+            samples = deque(maxlen=self.size)
+            self.samples[name] = samples
+        samples.append(seconds)
+
+    def phases(self, name):
+        if not self.enabled:
+            return nullPhaseTimer
+        return PhaseTimer(self, name)
+
+    # percentile -> seconds
+    def percentiles(self, name, percentiles=(50, 90, 99, 100)):
+        samples = sorted(self.samples.get(name) or [])
+        if len(samples) == 0:
+            return None
+        result = OrderedDict()
+        for p in percentiles:
+            result[p] = samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+        return result
+
+    def report(self):
+        for name in sorted(self.samples):
+            result = self.percentiles(name)
+            self.logger.info(name + ": n=" + str(len(self.samples[name])) + "; "
+                             + "; ".join(["p" + str(p) + "=" + "%.1f" % (result[p] * 1000) + "ms" for p in result]))
+
+    # profiles the next executions; done is called afterwards
+    def startProfiling(self, executions, done=None):
+        with self.lock:
+            self.profileExecutions = executions
+            self.profileStats = None
+            self.profileDone = done
+        self.logger.info("Profiling the next " + str(executions) + " rule executions")
+
+    def run(self, name, function, *arguments):
+        with self.lock:
+            # one execution at a time
+            profiled = self.profileExecutions > 0 and not self.profiling
+            if profiled:
+                self.profiling = True
+        if not profiled:
+            return function(*arguments)
+        profiler = profile.Profile()
+        try:
+            return profiler.runcall(function, *arguments)
+        finally:
+            with self.lock:
+                if self.profileStats == None:
+                    self.profileOut = StringIO()
+                    self.profileStats = pstats.Stats(profiler, stream=self.profileOut)
+                else:
+                    self.profileStats.add(profiler)
+                self.profileExecutions -= 1
+                self.profiling = False
+                done = self.profileExecutions <= 0
+            if done:
+                self.logProfile()
+
+    def logProfile(self):
+        self.profileStats.sort_stats('cumulative').print_stats(25)
+        self.logger.info("Profile:\n" + self.profileOut.getvalue())
+        self.profileStats = None
+        if self.profileDone != None:
+            self.profileDone()
+
+ruleTimings = RuleTimings()
+
 #######################################################
 class JythonSimpleRule(SimpleRule):
     def execute(self, module, input):
+        if not self.isActive():
+            return
+        ruleExecution.ruleName = self.getName()
+        ruleExecution.triggeredAt = time.time()
         try:
-            self._execute(module, input)
+            ruleTimings.run(self.getName(), self._execute, module, input)
         except:
             logger.error(traceback.format_exc())
+        finally:
+            self.flush()
+            elapsed = time.time() - ruleExecution.triggeredAt
+            metrics.inc('shutters_rule_executions_total', (('rule', self.getName()),))
+            metrics.observe('shutters_rule_duration_seconds', elapsed, (('rule', self.getName()),))
+            if ruleTimings.enabled:
+                ruleTimings.record(self.getName(), elapsed)
+
+    # called at the end of each execution: post the updates written behind
+    def flush(self):
+        pass
+
+    # inactive rules ignore their triggers; these runs are neither timed nor counted
+    def isActive(self):
+        return True
+
+class StateCacheRule(JythonSimpleRule):
+    def __init__(self, stateCache):
+        self.logger = LoggerFactory.getLogger(logger_name + ".StateCacheRule")
+        self.stateCache = stateCache
+        self.trackedItems = stateCache.getTrackedItems()
+        self.setTriggers([itemStateChangeTrigger(itemName, triggerName="stateCache_" + itemName)
+                          for itemName in self.trackedItems])
+        self.setName(module_name + ":StateCacheRule")
+        self.setDescription("Keeps the in-memory copy of the rollershutter state items up to date.")
+
+    def _execute(self, module, input):
+        self.stateCache.update(input['event'].getItemName(), input['state'])
+
+# commands are queued per bridge if command_queues are configured
+def setupCommandDispatcher(settings):
+    global commandDispatcher
+    queueConfig = settings.get('command_queues')
+    if commandDispatcher != None:
+        if queueConfig != None and str(queueConfig) == str(commandDispatcher.queueConfig):
+            return
+        # the queued commands are still sent
+        commandDispatcher.stop()
+        commandDispatcher = None
+    if queueConfig != None:
+        commandDispatcher = CommandDispatcher(queueConfig)
+
+def setupStateCache(config):
+    global itemStateCache
+    global stateCacheRule
+    setupCommandDispatcher(config.getSettings())
+    if itemStateCache == None:
+        itemStateCache = StateCache()
+    itemStateCache.bus = commandDispatcher if commandDispatcher != None else openhabItemBus
+    items = config.getItems()
+    defaultHysteresis, hysteresis = getHysteresisSettings(config.getSettings(), config.getShutters())
+    if defaultHysteresis[2] != None or len([h for h in hysteresis.values() if h[2] != None]) > 0:
+        # e.g. a sun sensor
+        itemStateCache.track(config.getShutters(), [items['shutter_automation']], [items['weather_sunny']])
+    else:
+        itemStateCache.track(config.getShutters(), [items['weather_sunny'], items['shutter_automation']])
+    resendInterval = config.getSettings().get('command_resend_interval')
+    itemStateCache.resendInterval = resendInterval if resendInterval != None else defaultCommandResendInterval
+    if stateCacheRule == None or stateCacheRule.trackedItems != itemStateCache.getTrackedItems():
+        stateCacheRule = StateCacheRule(itemStateCache)
+
+# switching the item ON profiles the next executions of the rules
+class ProfilerRule(JythonSimpleRule):
+    def __init__(self, itemName, executions, bus=None):
+        self.logger = LoggerFactory.getLogger(logger_name + ".ProfilerRule")
+        self.itemName = itemName
+        self.executions = executions
+        self.bus = bus if bus != None else openhabItemBus
+        self.setTriggers([itemStateChangeTrigger(itemName, "ON", "profiler_" + itemName)])
+        self.setName(module_name + ":ProfilerRule")
+        self.setDescription("Profiles the next rule executions.")
+
+    def _execute(self, module, input):
+        ruleTimings.report()
+        ruleTimings.startProfiling(self.executions, lambda: self.bus.postUpdate(self.itemName, "OFF"))
+
+def setupProfiling(settings):
+    global profilerRule
+    ruleTimings.enabled = settings.get('profiling') == True
+    itemName = settings.get('profiler_item')
+    executions = settings.get('profiler_executions')
+    executions = int(executions) if executions != None else 10
+    if itemName == None:
+        profilerRule = None
+    elif profilerRule == None or profilerRule.itemName != itemName or profilerRule.executions != executions:
+        profilerRule = ProfilerRule(itemName, executions)
+
+class MetricsRule(JythonSimpleRule):
+    def __init__(self, fileName, interval):
+        self.logger = LoggerFactory.getLogger(logger_name + ".MetricsRule")
+        self.fileName = fileName
+        self.interval = interval
+        self.setTriggers([cronTrigger("0 0/" + str(interval) + " * * * ? *", "metricsFile")])
+        self.setName(module_name + ":MetricsRule")
+        self.setDescription("Writes the metrics file.")
+
+    def _execute(self, module, input):
+        metrics.writeFile(self.fileName)
+
+def stateCacheMetrics():
+    if itemStateCache == None:
+        return []
+    return [('shutters_state_updates_written_total', (), itemStateCache.writes),
+            ('shutters_state_updates_saved_total', (), itemStateCache.writesSaved)]
+
+metrics.collectors.append(stateCacheMetrics)
+
+# metrics_file: written every metrics_interval minutes; metrics_port: http on localhost
+def setupMetrics(settings):
+    global metricsRule
+    global metricsServer
+    logger = LoggerFactory.getLogger(logger_name + ".setupMetrics")
+    fileName = settings.get('metrics_file')
+    interval = settings.get('metrics_interval')
+    interval = max(1, min(59, int(interval))) if interval != None else 1
+    if fileName == None:
+        metricsRule = None
+    elif metricsRule == None or metricsRule.fileName != fileName or metricsRule.interval != interval:
+        metricsRule = MetricsRule(fileName, interval)
+    port = settings.get('metrics_port')
+    if metricsServer != None and (port == None or metricsServer.server_address[1] != int(port)):
+        metricsServer.shutdown()
+        metricsServer.server_close()
+        metricsServer = None
+    if port != None and metricsServer == None:
+        metricsServer = HTTPServer(('127.0.0.1', int(port)), MetricsRequestHandler)
+        thread = Thread(target=lambda: metricsServer.serve_forever())
+        thread.setDaemon(True)
+        thread.start()
+        logger.info("Metrics on http://127.0.0.1:" + str(port) + "/metrics")
 
 class ShutterBaseRule(JythonSimpleRule):
-    def __init__(self, shutterAutomationItem, testing=False, forced=False):
+    def __init__(self, shutterAutomationItem, testing=False, forced=False, bus=None):
         self.testing = testing
         self.forced = forced
-        if ir.get(shutterAutomationItem) == None:
+        self.bus = bus if bus != None else openhabItemBus
+        if not self.bus.exists(shutterAutomationItem):
             self.logger.error("Item: " + shutterAutomationItem + " not found.")
         self.shutterAutomationItem = shutterAutomationItem
 
+    def flush(self):
+        self.bus.flush()
+
     def sendCommand(self, shutterName, state, auto):
         if not (auto or self.forced):
             self.logger.info("Auto(OFF): Not sending command: " + shutterName + "=" + state)
@@ -504,88 +2330,425 @@ class ShutterBaseRule(JythonSimpleRule):
                 self.logger.info("Auto(forced): sending command: " + shutterName + "=" + state)
             else:
                 self.logger.info("Auto(ON): sending command: " + shutterName + "=" + state)
+            if not isinstance(self.bus, StateCache):
+                # otherwise counted by the StateCache, unless it suppresses the command
+                metrics.inc('shutters_commands_total', (('shutter', shutterName), ('action', state)))
             if self.testing:
-                events.sendCommand(shutterName, state if state != "STOP" else "50")
+                self.bus.sendCommand(shutterName, state if state != "STOP" else "50")
             else:
-                events.sendCommand(shutterName, state)
+                self.bus.sendCommand(shutterName, state)
 
 #######################################################
 # Sun Exposure Rule
 
 class SunExposureRule(ShutterBaseRule):
-    def __init__(self, exposure, azimuthItem, elevationItem, isSunnyItem, shutterAutomationItem, testing=False, forced=False):
+    def __init__(self, exposure, azimuthItem, elevationItem, isSunnyItem, shutterAutomationItem, testing=False, forced=False, bus=None,
+                 shardName=None):
         #super(ShutterBaseRule, self).__init__(shutterAutomationItem, testing)
         self.logger = LoggerFactory.getLogger(logger_name + ".SunExposureRule")
-        ShutterBaseRule.__init__(self, shutterAutomationItem, testing, forced)
+        ShutterBaseRule.__init__(self, shutterAutomationItem, testing, forced, bus)
         self.exposure = exposure
-        if ir.get(elevationItem) == None:
+        self.timelines = None
+        self.crossCheck = False
+        self.azimuthItem = azimuthItem
+        if not self.bus.exists(elevationItem):
             self.logger.error("Item: " + elevationItem + " not found.")
         self.elevationItem = elevationItem
-        if ir.get(isSunnyItem) == None:
+        if not self.bus.exists(isSunnyItem):
             self.logger.error("Item: " + isSunnyItem + " not found.")
         self.isSunnyItem = isSunnyItem
+        self.solarEngine = None
+        # (margin, minDwell, sunnyThresholds) of the shutters without their own
+        self.defaultHysteresis = (0, 0, None)
+        self.hysteresis = {}
+        # sunny state per (on, off) thresholds
+        self.sunny = {}
+        # time of the last sunlit transition of the shutters not tracked by a StateCache
+        self.sunlitChanged = {}
+        # (min, max) azimuth in which the shutters can be sunlit, None: always evaluate
+        self.reachable = None
         self.setTriggers([itemStateChangeTrigger(azimuthItem)])
-        self.setName(module_name + ":SunExposureRule")
+        self.setName(module_name + ":SunExposureRule" + (":" + shardName if shardName != None else ""))
         self.setDescription("Calculates if a rollershutter is exposed to sunlight.")
 
-    def run(self, azimuth, elevation, auto):
-        isSunny = ir.get(self.isSunnyItem).getState().toString() == "ON"
-        self.logger.info("azimuth: " + str(azimuth) + "; elevation: " + str(elevation) + "; isSunny: " + str(isSunny))
+    # evaluate every interval seconds with the sun position from the solar engine
+    # instead of waiting for updates of the astro binding
+    def useSolarEngine(self, solarEngine, interval):
+        self.solarEngine = solarEngine
+        interval = max(1, min(59, int(interval)))
+        self.setTriggers([cronTrigger("0/" + str(interval) + " * * * * ? *", "sunExposureInterval")])
+
+    def setTimelines(self, timelines, crossCheck=False):
+        self.timelines = timelines
+        self.crossCheck = crossCheck
+
+    # margin: degrees the sun has to be past an edge before the sunlit state changes
+    # minDwell: minimal seconds between two sunlit transitions of a shutter
+    # sunnyThresholds: (on, off) if the sunny item is a number (e.g. a sun sensor)
+    # shutters: {shutterName: (margin, minDwell, sunnyThresholds)} overriding the defaults
+    def setHysteresis(self, margin=0, minDwell=0, sunnyThresholds=None, shutters=None):
+        self.defaultHysteresis = (margin, minDwell, sunnyThresholds)
+        self.hysteresis = shutters or {}
+
+    def getHysteresis(self, shutterName=None):
+        return self.hysteresis.get(shutterName, self.defaultHysteresis)
+
+    def getSunnyThresholds(self):
+        return set([self.defaultHysteresis[2]] + [hysteresis[2] for hysteresis in self.hysteresis.values()])
+
+    def getSunlitChangedAt(self, shutterName):
+        state = self.bus.getShutterState(shutterName) if hasattr(self.bus, 'getShutterState') else None
+        if state != None:
+            return state.sunlitChangedAt
+        return self.sunlitChanged.get(shutterName)
+
+    def setSunlitChangedAt(self, shutterName, t):
+        state = self.bus.getShutterState(shutterName) if hasattr(self.bus, 'getShutterState') else None
+        if state != None:
+            state.sunlitChangedAt = t
+        else:
+            self.sunlitChanged[shutterName] = t
+
+    def setReachableRange(self, reachable):
+        self.reachable = reachable
 
+    # outside of the reachable range the rule only runs while a shutter still has to be opened
+    def isAwake(self, azimuth):
+        if self.reachable == None or azimuth == None:
+            return True
+        if self.reachable[0] <= azimuth <= self.reachable[1]:
+            return True
         for shutterName in self.exposure:
-            shutterAutoState = ir.get(prefix_auto + shutterName).getState().toString()
+            if self.bus.getState(prefix_auto + shutterName) == autoStateSun \
+                    and self.bus.getState(prefix_sunlit + shutterName) != sunlitStateFalse:
+                return True
+        return False
+
+    def isSunny(self, shutterName=None):
+        return self.isSunnyWith(self.getHysteresis(shutterName)[2])
+
+    def isSunnyWith(self, sunnyThresholds):
+        if sunnyThresholds == None:
+            return self.bus.isOn(self.isSunnyItem)
+        sunny = self.sunny.get(sunnyThresholds, False)
+        try:
+            value = float(self.bus.getState(self.isSunnyItem))
+        except ValueError:
+            # NULL, UNDEF: keep the last state
+            return sunny
+        if value >= sunnyThresholds[0]:
+            sunny = True
+        elif value <= sunnyThresholds[1]:
+            sunny = False
+        self.sunny[sunnyThresholds] = sunny
+        return sunny
+
+    # keeps the current sunlit state unless the sun is at least margin degrees past the edge
+    def applyMargin(self, shutterName, azimuth, elevation, isSunlit, sunlitState):
+        margin = self.getHysteresis(shutterName)[0]
+        if margin <= 0 or azimuth == None or sunlitState not in [sunlitStateTrue, sunlitStateFalse]:
+            return isSunlit
+        if isSunlit == (sunlitState == sunlitStateTrue):
+            return isSunlit
+        exposure = self.exposure[shutterName]
+        for da, de in getMarginProbes(margin)[1:]:
+            if exposure.isSunlit((azimuth + da) % 360, elevation + de) != isSunlit:
+                return not isSunlit
+        return isSunlit
+
+    # the timeline of the shutter if it covers now
+    def getTimeline(self, shutterName, now):
+        if now == None or self.timelines == None:
+            return None
+        timeline = self.timelines.get(shutterName)
+        if timeline != None and timeline.covers(now):
+            return timeline
+        return None
+
+    def isSunlit(self, shutterName, azimuth, elevation, now=None):
+        metrics.inc('shutters_sunlit_evaluations_total', (('shutter', shutterName),))
+        timeline = self.getTimeline(shutterName, now)
+        if timeline != None:
+            isSunlit = timeline.isSunlitAt(now)
+            if self.crossCheck and azimuth != None:
+                # within the margin both states are right
+                exposure = self.exposure[shutterName]
+                if all([exposure.isSunlit((azimuth + da) % 360, elevation + de) != isSunlit
+                        for da, de in getMarginProbes(self.getHysteresis(shutterName)[0])]):
+                    self.logger.warn(shutterName + ": timeline and geometry disagree at azimuth: " + str(azimuth) + "; elevation: " + str(elevation))
+            return isSunlit
+        return self.exposure[shutterName].isSunlit(azimuth, elevation)
+
+    def run(self, azimuth, elevation, auto, now=None):
+        phases = ruleTimings.phases(self.getName())
+        phases.phase("state")
+        sunny = dict((sunnyThresholds, self.isSunnyWith(sunnyThresholds)) for sunnyThresholds in self.getSunnyThresholds())
+        self.logger.info("azimuth: " + str(azimuth) + "; elevation: " + str(elevation) + "; isSunny: " + str(sunny[self.defaultHysteresis[2]]))
+        t = now if now != None else time.time()
+
+        for shutterName in self.exposure:
+            phases.phase("state")
+            shutterAutoState = self.bus.getState(prefix_auto + shutterName)
             if shutterAutoState == autoStateSun:
-                sunlitState = ir.get(prefix_sunlit + shutterName).getState().toString()
-                isSunlit = self.exposure[shutterName].isSunlit(azimuth, elevation)
+                sunlitState = self.bus.getState(prefix_sunlit + shutterName)
+                phases.phase("geometry")
+                isSunlit = self.isSunlit(shutterName, azimuth, elevation, now)
+                if self.getTimeline(shutterName, now) == None:
+                    # the margin is already part of the timeline
+                    isSunlit = self.applyMargin(shutterName, azimuth, elevation, isSunlit, sunlitState)
+                phases.phase("commands")
                 self.logger.info(shutterName + " isSunlit: " + str(isSunlit))
+                margin, minDwell, sunnyThresholds = self.getHysteresis(shutterName)
+                if minDwell > 0:
+                    changedAt = self.getSunlitChangedAt(shutterName)
+                    if changedAt != None and changedAt > t - minDwell:
+                        self.logger.info(shutterName + " changed less than " + str(minDwell) + "s ago")
+                        continue
                 if isSunlit:
-                    if isSunny:
+                    if sunny[sunnyThresholds]:
                         if sunlitState == sunlitStateFalse:
                             self.sendCommand(shutterName, "STOP", auto)
-                            events.postUpdate(prefix_sunlit + shutterName, sunlitStateTrue)
+                            self.bus.postUpdate(prefix_sunlit + shutterName, sunlitStateTrue)
+                            self.setSunlitChangedAt(shutterName, t)
                         else:
                             if sunlitState == sunlitStateUnknown:
-                                events.postUpdate(prefix_sunlit + shutterName, sunlitStateTrue)
+                                self.bus.postUpdate(prefix_sunlit + shutterName, sunlitStateTrue)
 
                 else:
                     if sunlitState == sunlitStateTrue:
                         self.sendCommand(shutterName, "UP", auto)
-                        events.postUpdate(prefix_sunlit + shutterName, sunlitStateFalse)
+                        self.bus.postUpdate(prefix_sunlit + shutterName, sunlitStateFalse)
+                        self.setSunlitChangedAt(shutterName, t)
                     else:
                         if sunlitState == sunlitStateUnknown:
-                            events.postUpdate(prefix_sunlit + shutterName, sunlitStateTrue)
+                            self.bus.postUpdate(prefix_sunlit + shutterName, sunlitStateTrue)
             else:
                 self.logger.info(shutterName + " is: " + str(shutterAutoState))
+        phases.stop()
 
     def _execute(self, module, input):
         self.logger.debug("Executing Exposure Rule: ")
         self.logger.debug(str(input))
-        azimuth = float(str(input['state']))
-        elevation = float(ir.get(self.elevationItem).getState().toString())
-        auto = ir.get(self.shutterAutomationItem).getState().toString() == "ON"
+        now = time.time()
+        if self.solarEngine != None:
+            azimuth, elevation = self.solarEngine.positionAt(now)
+        else:
+            azimuth = float(str(input['state']))
+            elevation = float(self.bus.getState(self.elevationItem))
+        if not self.isAwake(azimuth):
+            # keep following the sun sensor
+            for sunnyThresholds in self.getSunnyThresholds():
+                self.isSunnyWith(sunnyThresholds)
+            self.logger.debug("azimuth: " + str(azimuth) + " out of reach")
+            return
+        auto = self.bus.isOn(self.shutterAutomationItem)
         self.logger.debug("shutter_automation is: " + str(auto))
-        self.run(azimuth, elevation, auto)
+        self.run(azimuth, elevation, auto, now)
 
 
-def setupSunExposureRule(exposureConfig, items):
-    logger = LoggerFactory.getLogger(logger_name + ".setupSunExposureRule")
-    logger.info("creating rule")
+# models of unchanged shutters are taken over from previous, shutters with the same
+# geometry share one model
+def createSunExposures(exposureConfig, settings, previous=None):
+    resolution = settings.get('raster_resolution')
+    models = {}
+    if previous != None:
+        for shutter in previous:
+            models[previous[shutter].signature] = previous[shutter]
     exposure = {}
     for shutter in exposureConfig:
-        exposure[shutter] = SunExposure(exposureConfig[shutter])
-    globalRules.append(SunExposureRule(exposure, items['azimuth'], items['elevation'], items['weather_sunny'], items['shutter_automation']))
+        signature = getSunExposureSignature(exposureConfig[shutter], resolution)
+        if signature not in models:
+            models[signature] = SunExposure(exposureConfig[shutter], resolution)
+        exposure[shutter] = models[signature]
+    return exposure
+
+# (margin, minDwell, sunnyThresholds) from the settings, overridden by the ones in the
+# sun_exposure entry of a shutter
+def createHysteresis(settings, shutterConfig=None):
+    values = {}
+    for key in ['sunlit_margin', 'sunlit_min_dwell', 'sunny_on_threshold', 'sunny_off_threshold']:
+        values[key] = settings.get(key)
+        if shutterConfig != None and shutterConfig.get(key) != None:
+            values[key] = shutterConfig[key]
+    sunnyThresholds = None
+    if values['sunny_on_threshold'] != None:
+        on = float(values['sunny_on_threshold'])
+        off = values['sunny_off_threshold']
+        sunnyThresholds = (on, float(off) if off != None else on)
+    return (float(values['sunlit_margin'] or 0), float(values['sunlit_min_dwell'] or 0), sunnyThresholds)
+
+# the hysteresis of the settings and {shutterName: hysteresis} of the shutters with their own
+def getHysteresisSettings(settings, exposureConfig):
+    default = createHysteresis(settings)
+    shutters = {}
+    for shutterName in exposureConfig:
+        hysteresis = createHysteresis(settings, exposureConfig[shutterName])
+        if hysteresis != default:
+            shutters[shutterName] = hysteresis
+    return default, shutters
+
+# degrees added on both sides of the azimuth range of a facade shard
+defaultShardGuardBand = 2.0
+
+# groups the shutters into facade shards: shutters with the same orientation and
+# overlapping azimuth ranges. Returns [(shard name, shutter names, reachable range)]
+def createSunExposureShards(exposure, guardBand):
+    facades = {}
+    for shutterName in exposure:
+        facades.setdefault(exposure[shutterName].orientation, []).append(shutterName)
+    shards = []
+    for orientation in sorted(facades):
+        ranges = []
+        for shutterName in sorted(facades[orientation], key=lambda name: (exposure[name].minAzimuth, name)):
+            model = exposure[shutterName]
+            if len(ranges) > 0 and model.minAzimuth <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], model.maxAzimuth)
+                ranges[-1][2].append(shutterName)
+            else:
+                ranges.append([model.minAzimuth, model.maxAzimuth, [shutterName]])
+        for minAzimuth, maxAzimuth, shutterNames in ranges:
+            shardName = str(orientation) + ":" + "%g-%g" % (minAzimuth, maxAzimuth)
+            shards.append((shardName, shutterNames, (minAzimuth - guardBand, maxAzimuth + guardBand)))
+    return shards
+
+def setupSunExposureRule(exposureConfig, items, settings):
+    global sunExposureRules
+    logger = LoggerFactory.getLogger(logger_name + ".setupSunExposureRule")
+    previous = {}
+    for rule in sunExposureRules.values():
+        previous.update(rule.exposure)
+    exposure = createSunExposures(exposureConfig, settings, previous)
+    signature = "|".join([str(items), str(settings.get('sun_position')), str(settings.get('sun_evaluation_interval')),
+                          str(getLocation(settings))])
+    defaultHysteresis, hysteresis = getHysteresisSettings(settings, exposureConfig)
+    margin = max([defaultHysteresis[0]] + [h[0] for h in hysteresis.values()])
+    if settings.get('sun_exposure_shards'):
+        guardBand = settings.get('sun_exposure_guard_band')
+        guardBand = float(guardBand) if guardBand != None else defaultShardGuardBand
+        # the margin probes positions beyond the edges of the openings
+        shards = createSunExposureShards(exposure, guardBand + margin)
+    else:
+        shards = [(None, list(exposure), None)]
+    rules = OrderedDict()
+    for shardName, shutterNames, reachable in shards:
+        key = "SunExposureRule" + (":" + shardName if shardName != None else "")
+        shardExposure = exposure if shardName == None else dict((name, exposure[name]) for name in shutterNames)
+        rule = sunExposureRules.get(key)
+        if rule != None and rule.signature == signature:
+            # the triggers didn't change: keep the registered rule
+            logger.info("updating sun exposure models of " + key)
+            rule.exposure = shardExposure
+        else:
+            logger.info("creating rule " + key)
+            rule = SunExposureRule(shardExposure, items['azimuth'], items['elevation'], items['weather_sunny'], items['shutter_automation'],
+                                   bus=itemStateCache, shardName=shardName)
+            rule.signature = signature
+        rule.setReachableRange(reachable)
+        rule.setHysteresis(*defaultHysteresis, shutters=dict((name, hysteresis[name]) for name in shardExposure if name in hysteresis))
+        rules[key] = rule
+    if len(rules) > 1:
+        logger.info(str(len(exposure)) + " shutters in " + str(len(rules)) + " facade shards")
+    sunExposureRules = rules
+
+#######################################################
+# Sunlit Transition Rule: fires at the precomputed sunlit boundaries of the day
+
+class SunlitTransitionRule(JythonSimpleRule):
+    def __init__(self, sunExposureRules, transitions):
+        self.logger = LoggerFactory.getLogger(logger_name + ".SunlitTransitionRule")
+        self.sunExposureRules = sunExposureRules
+        self.transitions = transitions
+        triggers = []
+        for transition in transitions:
+            triggers.append(cronTrigger(time.strftime("%S %M %H %d %m ? %Y", time.localtime(transition)),
+                                        "sunlitTransition_" + str(int(transition))))
+        self.setTriggers(triggers)
+        self.setName(module_name + ":SunlitTransitionRule")
+        self.setDescription("Updates rollershutters at the precomputed sunlit transitions.")
+
+    def _execute(self, module, input):
+        now = time.time()
+        azimuth, elevation = solarEngine.positionAt(now)
+        for rule in self.sunExposureRules:
+            if rule.isAwake(azimuth):
+                auto = rule.bus.isOn(rule.shutterAutomationItem)
+                rule.run(azimuth, elevation, auto, now)
+
+    def flush(self):
+        for rule in self.sunExposureRules:
+            rule.flush()
+
+def setupSolarEngine(settings):
+    global solarEngine
+    logger = LoggerFactory.getLogger(logger_name + ".setupSolarEngine")
+    solarEngine = None
+    location = getLocation(settings)
+    if location == None:
+        logger.info("No location configured: sun position from the astro binding only")
+        return
+    solarEngine = SolarEngine(location)
+    if settings.get('sun_position') == 'internal':
+        interval = settings.get('sun_evaluation_interval')
+        if interval == None:
+            interval = 30
+        logger.info("SunExposureRule evaluates every " + str(interval) + "s")
+        for rule in sunExposureRules.values():
+            rule.useSolarEngine(solarEngine, interval)
+
+def setupSunlitTimeline(settings):
+    global sunlitTransitionRule
+    logger = LoggerFactory.getLogger(logger_name + ".setupSunlitTimeline")
+    previous = sunlitTransitionRule
+    sunlitTransitionRule = None
+    rules = list(sunExposureRules.values())
+    if not settings.get('sunlit_timeline') or solarEngine == None:
+        for rule in rules:
+            rule.setTimelines(None)
+        return
+    logger.info("computing todays sunlit timeline")
+    exposure = {}
+    margins = {}
+    for rule in rules:
+        exposure.update(rule.exposure)
+        for shutterName in rule.exposure:
+            margins[shutterName] = rule.getHysteresis(shutterName)[0]
+    timelines = computeSunlitTimelines(exposure, solarEngine, datetime.date.today(), margins)
+    for rule in rules:
+        rule.setTimelines(timelines, settings.get('sunlit_timeline_cross_check') == True)
+    now = time.time()
+    transitions = set()
+    for shutterName in timelines:
+        for transition in timelines[shutterName].getTransitions():
+            # cron triggers have a resolution of one second
+            transition = math.ceil(transition)
+            if transition > now:
+                transitions.add(transition)
+    logger.info(str(len(transitions)) + " sunlit transitions scheduled")
+    transitions = sorted(transitions)
+    if previous != None and previous.transitions == transitions:
+        previous.sunExposureRules = rules
+        sunlitTransitionRule = previous
+    elif len(transitions) > 0:
+        sunlitTransitionRule = SunlitTransitionRule(rules, transitions)
 
 #######################################################
 # Shutter Rule
 
 class ShutterScheduleRule(ShutterBaseRule):
-    def __init__(self, action, items, ruleName, shutterAutomationItem, description = "", testing=False, forced=False):
-        ShutterBaseRule.__init__(self, shutterAutomationItem, testing, forced)
+    def __init__(self, action, items, ruleName, shutterAutomationItem, description = "", testing=False, forced=False, bus=None,
+                 cronDispatched=False):
         self.logger = LoggerFactory.getLogger(logger_name + ".ShutterScheduleRule")
+        ShutterBaseRule.__init__(self, shutterAutomationItem, testing, forced, bus)
         self.action = action
         self.items = items
+        # cron schedules are fired by the CronDispatcher instead of the rule engine
+        self.cronDispatched = cronDispatched
         self.triggerList = []
         self.conditionList = []
+        # trigger and condition configs, e.g. for the simulator
+        self.cronSchedules = []
+        self.channelEvents = []
+        self.itemStateConditions = []
         self.ruleName = normalize_name(ruleName, "")
         self.prefixedRuleName = normalize_name(self.ruleName)
         self.setName(module_name + ":ShutterScheduleRule:" + ruleName)
@@ -594,6 +2757,9 @@ class ShutterScheduleRule(ShutterBaseRule):
     def addCronTrigger(self, schedule):
         name = self.ruleName + "-cron:" + str(schedule).replace("*", "s").replace("?", "q").replace(" ", "l").replace("/", "x")
         triggerName = name + "_trigger"
+        self.cronSchedules.append(schedule)
+        if self.cronDispatched:
+            return
         self.triggerList.append(cronTrigger(schedule + " ? * * *", triggerName))
         self.setTriggers(self.triggerList)
 
@@ -601,17 +2767,22 @@ class ShutterScheduleRule(ShutterBaseRule):
         name = self.ruleName + "-" + channelUID + "-" + event
         triggerName = name + "_trigger"
         conditionName = name + "_condition"
+        self.channelEvents.append((channelUID, event))
         self.triggerList.append(channelEventTrigger(channelUID, event, triggerName))
         self.setTriggers(self.triggerList) 
  
     def addItemStateCondition(self, config):
         conditionName = self.ruleName + "-" + config['item_name'] + "_"  + config['state']
+        self.itemStateConditions.append(config)
         self.conditionList.append(itemStateCondition(config['item_name'], config['operator'], config['state'], conditionName))
         self.setConditions(self.conditionList)
 
     def run(self, auto):
+        phases = ruleTimings.phases(self.getName())
         for shutterName in self.items:
-            autoState = ir.get(prefix_auto + shutterName).getState().toString()
+            phases.phase("state")
+            autoState = self.bus.getState(prefix_auto + shutterName)
+            phases.phase("commands")
             if self.action == autoStateUp:
                     self.sendCommand(shutterName, "UP", auto)
             if self.action == autoStateDown:
@@ -619,20 +2790,134 @@ class ShutterScheduleRule(ShutterBaseRule):
             if self.action == autoStateSun:
                 if autoState == autoStateDown:
                     self.sendCommand(shutterName, "STOP", auto)
-                    events.postUpdate(prefix_sunlit + shutterName, sunlitStateTrue)
+                    self.bus.postUpdate(prefix_sunlit + shutterName, sunlitStateTrue)
                 if autoState == autoStateUp:
-                    events.postUpdate(prefix_sunlit + shutterName, sunlitStateFalse)
+                    self.bus.postUpdate(prefix_sunlit + shutterName, sunlitStateFalse)
                 if autoState == autoStateManual:
-                    events.postUpdate(prefix_sunlit + shutterName, sunlitStateUnknown)
+                    self.bus.postUpdate(prefix_sunlit + shutterName, sunlitStateUnknown)
 
-            events.postUpdate(prefix_auto + shutterName, self.action)
+            self.bus.postUpdate(prefix_auto + shutterName, self.action)
+        phases.stop()
+
+    def isActive(self):
+        if self.ruleName not in activeScheduleRules:
+            self.logger.debug("Not in todays daily schedule: " + self.ruleName)
+            return False
+        return True
 
     def _execute(self, module, input):
         self.logger.info("Executing Rule: " + self.ruleName + "; action: " + self.action + "; items: " + str(self.items))
-        auto = ir.get(self.shutterAutomationItem).getState().toString() == "ON"
+        auto = self.bus.isOn(self.shutterAutomationItem)
         self.logger.debug("shutter_automation is: " + str(auto))
         self.run(auto)
 
+#######################################################
+# Cron Dispatcher: one thread fires the cron schedules of all ShutterScheduleRules.
+# Each distinct cron expression is one entry of a timeline sorted by the next fire
+# time; all rules due at the same time are executed in one wakeup.
+
+class CronDispatcher():
+    def __init__(self, bus=None):
+        self.logger = LoggerFactory.getLogger(logger_name + ".CronDispatcher")
+        self.bus = bus if bus != None else openhabItemBus
+        self.clock = time.time
+        # [(cron expression, rules)]
+        self.entries = []
+        # sorted [(next fire time in ms, entry index)]
+        self.timeline = []
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.wakeups = 0
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=lambda: self.dispatch())
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    # replaces the timeline by the cron schedules of rules
+    def schedule(self, rules):
+        schedules = OrderedDict()
+        for rule in rules:
+            for schedule in rule.cronSchedules:
+                schedules.setdefault(schedule + " ? * * *", []).append(rule)
+        now = Date(int(self.clock() * 1000))
+        entries = []
+        timeline = []
+        for expression in schedules:
+            cron = CronExpression(expression)
+            entries.append((cron, schedules[expression]))
+            next = cron.getNextValidTimeAfter(now)
+            if next != None:
+                timeline.append((next.getTime(), len(entries) - 1))
+        timeline.sort()
+        with self.condition:
+            self.entries = entries
+            self.timeline = timeline
+            self.condition.notify()
+        self.logger.info(str(len(entries)) + " cron schedules of " + str(len(rules)) + " rules")
+
+    # removes the entries due at now (seconds) from the timeline, schedules their next
+    # time and returns the rules to execute (each once)
+    def takeDue(self, now):
+        rules = OrderedDict()
+        with self.condition:
+            while len(self.timeline) > 0 and self.timeline[0][0] <= now * 1000:
+                due, index = self.timeline.pop(0)
+                cron, entryRules = self.entries[index]
+                for rule in entryRules:
+                    rules[id(rule)] = rule
+                next = cron.getNextValidTimeAfter(Date(due))
+                if next != None:
+                    bisect.insort(self.timeline, (next.getTime(), index))
+        return list(rules.values())
+
+    # conditions are evaluated here, the rule engine doesn't see the cron schedules
+    def fire(self, rules):
+        for rule in rules:
+            if itemStateConditionsMet(rule.itemStateConditions, self.bus):
+                rule.execute(None, {})
+            else:
+                self.logger.debug("Conditions not met: " + rule.ruleName)
+
+    def dispatch(self):
+        self.logger.info("Start dispatching")
+        while True:
+            with self.condition:
+                if self.stopped:
+                    break
+                if len(self.timeline) == 0:
+                    self.condition.wait()
+                    continue
+                wait = self.timeline[0][0] / 1000.0 - self.clock()
+                if wait > 0:
+                    # woken up early by a new timeline; checks the clock at least every minute
+                    self.condition.wait(min(wait, 60))
+                    continue
+            self.wakeups += 1
+            try:
+                self.fire(self.takeDue(self.clock()))
+            except:
+                self.logger.error(traceback.format_exc())
+        self.logger.info("Stop dispatching")
+
+def setupCronDispatcher(settings):
+    global cronDispatcher
+    if not settings.get('cron_dispatcher'):
+        if cronDispatcher != None:
+            cronDispatcher.stop()
+            cronDispatcher = None
+        return
+    if cronDispatcher == None:
+        cronDispatcher = CronDispatcher(itemStateCache)
+        cronDispatcher.start()
+    cronDispatcher.bus = itemStateCache
+
 #######################################################
 # tests
 class RulesTest():
@@ -666,26 +2951,26 @@ class RulesTest():
 
         # sunlit: true, state: SUN, weather: cloudy
         time.sleep(1)
-        ser._execute(240, 30, True)
+        ser.run(240, 30, True)
         time.sleep(1)
         assert shutterItem.getState().toString() == "100"
 
         # sunlit: true, state: SUN, weather: sunny
         events.postUpdate(isSunnyItem.getName(), "ON")
         time.sleep(1)
-        ser._execute(240, 30, True)
+        ser.run(240, 30, True)
         time.sleep(1)
         assert shutterItem.getState().toString() == "50"
 
         # sunlit: true, state: SUN, weather: cloudy
         events.postUpdate(isSunnyItem.getName(), "OFF")
         time.sleep(1)
-        ser._execute(240, 30, True)
+        ser.run(240, 30, True)
         time.sleep(1)
         assert shutterItem.getState().toString() == "50"
 
         # sunlit: false, state: SUN, weather: cloudy
-        ser._execute(60, 30, True)
+        ser.run(60, 30, True)
         time.sleep(1)
         assert shutterItem.getState().toString() == "0"
 
@@ -694,12 +2979,12 @@ class RulesTest():
         events.postUpdate(autoStateItem.getName(), autoStateDown)
         events.sendCommand(shutterItem.getName(), "DOWN")
         time.sleep(1)
-        ser._execute(240, 30, True)
+        ser.run(240, 30, True)
         time.sleep(1)
         assert shutterItem.getState().toString() == "100"
 
         # sunlit: false, state: DOWN, weather: sunny
-        ser._execute(60, 30, True)
+        ser.run(60, 30, True)
         time.sleep(1)
         assert shutterItem.getState().toString() == "100"
 
@@ -707,12 +2992,12 @@ class RulesTest():
         events.postUpdate(autoStateItem.getName(), autoStateUp)
         events.sendCommand(shutterItem.getName(), "UP")
         time.sleep(1)
-        ser._execute(240, 30, True)
+        ser.run(240, 30, True)
         time.sleep(1)
         assert shutterItem.getState().toString() == "0"
 
         # sunlit: false, state: UP, weather: sunny
-        ser._execute(60, 30, True)
+        ser.run(60, 30, True)
         time.sleep(1)
         assert shutterItem.getState().toString() == "0"
 
@@ -721,14 +3006,14 @@ class RulesTest():
         events.postUpdate(sunlitStateItem.getName(), sunlitStateUnknown)
         events.sendCommand(shutterItem.getName(), "UP")
         time.sleep(1)
-        ser._execute(240, 30, True)
+        ser.run(240, 30, True)
         time.sleep(1)
         assert shutterItem.getState().toString() == "0"
 
         # sunlit: true, state: SUN, weather: sunny, sunlitstat: unknown
         events.postUpdate(autoStateItem.getName(), autoStateSun)
         time.sleep(1)
-        ser._execute(240, 30, True)
+        ser.run(240, 30, True)
         time.sleep(1)
         assert shutterItem.getState().toString() == "0"
         assert sunlitStateItem.getState().toString() == sunlitStateTrue
@@ -747,25 +3032,25 @@ class RulesTest():
         events.sendCommand(shutterItem.getName(), "DOWN")
         events.postUpdate(sunlitStateItem.getName(), sunlitStateFalse)
         time.sleep(1)
-        ssrU._execute(True)
+        ssrU.run(True)
         time.sleep(1)
         assert shutterItem.getState().toString() == "0"
         assert autoStateItem.getState().toString() == autoStateUp
         assert sunlitStateItem.getState().toString() == sunlitStateFalse
 
-        ssrD._execute(True)
+        ssrD.run(True)
         time.sleep(1)
         assert shutterItem.getState().toString() == "100"
         assert autoStateItem.getState().toString() == autoStateDown
         assert sunlitStateItem.getState().toString() == sunlitStateFalse
 
-        ssrM._execute(True)
+        ssrM.run(True)
         time.sleep(1)
         assert shutterItem.getState().toString() == "100"
         assert autoStateItem.getState().toString() == autoStateManual
         assert sunlitStateItem.getState().toString() == sunlitStateFalse
 
-        ssrS._execute(True)
+        ssrS.run(True)
         time.sleep(1)
         assert shutterItem.getState().toString() == "100"
         assert autoStateItem.getState().toString() == autoStateSun
@@ -773,41 +3058,464 @@ class RulesTest():
 
         events.postUpdate(sunlitStateItem.getName(), sunlitStateFalse)
         time.sleep(1)
-        ssrU._execute(True)
+        ssrU.run(True)
         time.sleep(1)
         assert shutterItem.getState().toString() == "0"
         assert autoStateItem.getState().toString() == autoStateUp
         assert sunlitStateItem.getState().toString() == sunlitStateFalse
 
-        ssrM._execute(True)
+        ssrM.run(True)
         time.sleep(1)
         assert shutterItem.getState().toString() == "0"
         assert autoStateItem.getState().toString() == autoStateManual
         assert sunlitStateItem.getState().toString() == sunlitStateFalse
 
-        ssrS._execute(True)
+        ssrS.run(True)
         time.sleep(1)
         assert shutterItem.getState().toString() == "0"
         assert autoStateItem.getState().toString() == autoStateSun
         assert sunlitStateItem.getState().toString() == sunlitStateUnknown
 
-        ssrD._execute(True)
+        ssrD.run(True)
         time.sleep(1)
         assert shutterItem.getState().toString() == "100"
         assert autoStateItem.getState().toString() == autoStateDown
         assert sunlitStateItem.getState().toString() == sunlitStateUnknown
 
-        ssrS._execute(True)
+        ssrS.run(True)
         time.sleep(1)
         assert shutterItem.getState().toString() == "50"
         assert autoStateItem.getState().toString() == autoStateSun
         assert sunlitStateItem.getState().toString() == sunlitStateTrue
 
+    def stateCacheTest(self):
+        shutterName = "shutter_living"
+        bus = SimulatedItemBus({prefix_auto + shutterName: autoStateSun, prefix_sunlit + shutterName: sunlitStateFalse,
+                                "weather_sunny": "OFF", "shutter_automation": "ON"})
+        cache = StateCache(bus)
+        cache.track([shutterName], ["weather_sunny", "shutter_automation"])
+        assert cache.getShutterState(shutterName).auto == autoStateSun
+        assert cache.isOn("shutter_automation")
+        assert not cache.isOn("weather_sunny")
+
+        # updates from outside reach the cache through the StateCacheRule
+        rule = StateCacheRule(cache)
+        assert len(rule.getTriggers()) == 5
+        cache.update("weather_sunny", "ON")
+        assert cache.getState("weather_sunny") == "ON"
+
+        exposure = {shutterName: SunExposure(Yaml().load("{orientation: 240, sun_openings: [{azimuth: 160}, {azimuth: 330}]}"))}
+        ser = SunExposureRule(exposure, "astro_sun_azimuth", "astro_sun_elevation", "weather_sunny", "shutter_automation", bus=cache)
+        lookups = cache.lookups
+        ser.run(240, 30, True)
+        assert bus.states[shutterName] == "STOP"
+        assert cache.getShutterState(shutterName).sunlit is sunlitStateTrue
+        assert cache.lookups - lookups == 3
+
+        # updates are written at the end of the execution, unchanged ones not at all
+        assert bus.states[prefix_sunlit + shutterName] == sunlitStateFalse
+        ser.flush()
+        assert bus.states[prefix_sunlit + shutterName] == sunlitStateTrue
+        ssr = ShutterScheduleRule(autoStateSun, [shutterName], "testRule", "shutter_automation", bus=cache)
+        ssr.run(True)
+        ssr.run(True)
+        ssr.flush()
+        assert cache.getWriteStats() == {'writes': 1, 'writesSaved': 2}
+        cache.postUpdate(prefix_auto + shutterName, autoStateDown)
+        cache.postUpdate(prefix_auto + shutterName, autoStateSun)
+        ssr.flush()
+        assert cache.getWriteStats() == {'writes': 1, 'writesSaved': 3}
+
+    def commandSuppressionTest(self):
+        shutterName = "shutter_living"
+        labels = (('shutter', shutterName), ('action', "DOWN"))
+        counted = metrics.get('shutters_commands_total', labels)
+        bus = SimulatedItemBus({shutterName: "0"})
+        cache = StateCache(bus)
+        cache.track([shutterName], [])
+        now = [1000]
+        cache.clock = lambda: now[0]
+        cache.resendInterval = 3600
+
+        # e.g. close_dusk triggered by nautic dusk and by the 22:00 cron
+        cache.sendCommand(shutterName, "DOWN")
+        cache.update(shutterName, "100")
+        now[0] += 1800
+        cache.sendCommand(shutterName, "DOWN")
+        assert cache.commandsSent == 1 and cache.commandsSuppressed == 1
+        # a suppressed command is not counted as sent
+        assert metrics.get('shutters_commands_total', labels) == counted + 1
+        assert metrics.get('shutters_commands_suppressed_total', labels) >= 1
+
+        # moved by someone else
+        cache.update(shutterName, "40")
+        cache.sendCommand(shutterName, "DOWN")
+        assert cache.commandsSent == 2
+
+        # STOP is repeated only if the shutter moved since
+        cache.update(shutterName, "100")
+        cache.sendCommand(shutterName, "STOP")
+        cache.sendCommand(shutterName, "STOP")
+        assert cache.commandsSent == 3
+        cache.update(shutterName, "0")
+        cache.sendCommand(shutterName, "STOP")
+        assert cache.commandsSent == 4
+
+        # sent again after the resend interval
+        cache.sendCommand(shutterName, "UP")
+        cache.update(shutterName, "0")
+        now[0] += 3600
+        cache.sendCommand(shutterName, "UP")
+        assert cache.commandsSent == 6 and cache.commandsSuppressed == 2
+
+        # the position is unknown: always sent
+        cache.update(shutterName, "NULL")
+        cache.sendCommand(shutterName, "DOWN")
+        cache.sendCommand(shutterName, "DOWN")
+        cache.sendCommand(shutterName, "STOP")
+        cache.sendCommand(shutterName, "STOP")
+        assert cache.commandsSent == 10 and cache.commandsSuppressed == 2
+
+    def commandDispatcherTest(self):
+        global activeScheduleRules
+        sent = []
+        failures = ["shutter_office"]
+        def commandListener(itemName, command):
+            if itemName in failures:
+                failures.remove(itemName)
+                raise Exception("transmitter busy")
+            sent.append(itemName)
+        dispatcher = CommandDispatcher(Yaml().load("""
+            rfxcom: { items: [shutter_kitchen, shutter_living, shutter_office], spacing: 0.01, retries: 1 }
+            """), SimulatedItemBus({"shutter_automation": "ON"}, commandListener=commandListener))
+        shutterNames = ["shutter_kitchen", "shutter_office", "shutter_living", "shutter_other"]
+        # rule -> state cache -> dispatcher, as wired by setupStateCache
+        cache = StateCache(dispatcher)
+        cache.track(shutterNames, ["shutter_automation"])
+        rule = ShutterScheduleRule(autoStateDown, shutterNames, "dispatcherTest", "shutter_automation", bus=cache)
+        previous = activeScheduleRules
+        try:
+            activeScheduleRules = frozenset(["dispatcherTest"])
+            rule.execute(None, {})
+            dispatcher.join()
+            assert sorted(sent) == ["shutter_kitchen", "shutter_living", "shutter_office", "shutter_other"]
+            assert [s for s in sent if s != "shutter_other"] == ["shutter_kitchen", "shutter_office", "shutter_living"]
+            # the execution closed its batch
+            assert len(dispatcher.latencies) == 1
+            assert getattr(dispatcher.batches, 'batch', None) == None
+
+            # the next execution gets a batch of its own
+            cache.resendInterval = 0
+            rule.execute(None, {})
+            dispatcher.join()
+            assert len(sent) == 8
+            assert len(dispatcher.latencies) == 2
+        finally:
+            activeScheduleRules = previous
+            dispatcher.stop()
+
+    def commandFailureTest(self):
+        global activeScheduleRules
+        def commandListener(itemName, command):
+            if itemName == "shutter_office":
+                raise Exception("transmitter busy")
+        dispatcher = CommandDispatcher(Yaml().load("""
+            rfxcom: { items: [shutter_kitchen, shutter_office], retries: 1 }
+            """), SimulatedItemBus({"shutter_automation": "ON"}, commandListener=commandListener))
+        # the dropped command is logged as error
+        class ErrorRecorder():
+            def __init__(self):
+                self.errors = []
+            def warn(self, message):
+                pass
+            def error(self, message):
+                self.errors.append(message)
+        recorder = ErrorRecorder()
+        dispatcher.queues['rfxcom'].logger = recorder
+        labels = (('shutter', "shutter_office"), ('action', "DOWN"))
+        failed = metrics.get('shutters_commands_failed_total', labels)
+        cache = StateCache(dispatcher)
+        cache.resendInterval = 0
+        cache.track(["shutter_kitchen", "shutter_office"], ["shutter_automation"])
+        previous = activeScheduleRules
+        try:
+            activeScheduleRules = frozenset(["failureTest", "mixedTest"])
+            # no command got through: no latency
+            ShutterScheduleRule(autoStateDown, ["shutter_office"], "failureTest", "shutter_automation", bus=cache).execute(None, {})
+            dispatcher.join()
+            assert len(recorder.errors) == 1
+            assert metrics.get('shutters_commands_failed_total', labels) == failed + 1
+            assert len(dispatcher.latencies) == 0
+            ShutterScheduleRule(autoStateDown, ["shutter_kitchen", "shutter_office"], "mixedTest", "shutter_automation",
+                                bus=cache).execute(None, {})
+            dispatcher.join()
+            assert len(recorder.errors) == 2
+            assert metrics.get('shutters_commands_failed_total', labels) == failed + 2
+            assert len(dispatcher.latencies) == 1
+        finally:
+            activeScheduleRules = previous
+            dispatcher.stop()
+
+    def hysteresisTest(self):
+        shutterName = "shutter_living"
+        bus = SimulatedItemBus({prefix_auto + shutterName: autoStateSun, prefix_sunlit + shutterName: sunlitStateFalse,
+                                "sun_sensor": "NULL", "shutter_automation": "ON"})
+        exposure = {shutterName: SunExposure(Yaml().load("{orientation: 240, sun_openings: [{azimuth: 160}, {azimuth: 330}]}"))}
+        ser = SunExposureRule(exposure, "astro_sun_azimuth", "astro_sun_elevation", "sun_sensor", "shutter_automation", bus=bus)
+        ser.setHysteresis(2, 600, (40000, 20000))
+
+        # sunny from 40000 lux on, cloudy from 20000 lux on
+        assert not ser.isSunny()
+        bus.postUpdate("sun_sensor", "30000")
+        assert not ser.isSunny()
+        bus.postUpdate("sun_sensor", "50000")
+        assert ser.isSunny()
+        bus.postUpdate("sun_sensor", "30000")
+        assert ser.isSunny()
+        bus.postUpdate("sun_sensor", "10000")
+        assert not ser.isSunny()
+        bus.postUpdate("sun_sensor", "50000")
+
+        # 1 degree into the opening is within the margin
+        ser.run(161, 30, True, 1000)
+        assert bus.getState(prefix_sunlit + shutterName) == sunlitStateFalse
+        ser.run(163, 30, True, 1000)
+        assert bus.getState(prefix_sunlit + shutterName) == sunlitStateTrue
+
+        # minimal dwell time
+        ser.run(60, 30, True, 1300)
+        assert bus.getState(prefix_sunlit + shutterName) == sunlitStateTrue
+        ser.run(60, 30, True, 1600)
+        assert bus.getState(prefix_sunlit + shutterName) == sunlitStateFalse
+
+        # per shutter overrides
+        exposureConfig = Yaml().load("""
+            shutter_living: {orientation: 240, sun_openings: [{azimuth: 160}, {azimuth: 330}]}
+            shutter_kitchen: {orientation: 240, sun_openings: [{azimuth: 160}, {azimuth: 330}], sunlit_margin: 0, sunny_on_threshold: 60000}
+            """)
+        settings = {'sunlit_margin': 2, 'sunlit_min_dwell': 600, 'sunny_on_threshold': 40000, 'sunny_off_threshold': 20000}
+        defaultHysteresis, hysteresis = getHysteresisSettings(settings, exposureConfig)
+        assert defaultHysteresis == (2, 600, (40000, 20000))
+        assert hysteresis == {"shutter_kitchen": (0, 600, (60000, 20000))}
+        states = {"sun_sensor": "50000", "shutter_automation": "ON"}
+        for name in exposureConfig:
+            states[prefix_auto + name] = autoStateSun
+            states[prefix_sunlit + name] = sunlitStateFalse
+        cache = StateCache(SimulatedItemBus(states))
+        cache.track(list(exposureConfig), ["shutter_automation"], ["sun_sensor"])
+        def createRule():
+            rule = SunExposureRule(createSunExposures(exposureConfig, {}), "astro_sun_azimuth", "astro_sun_elevation", "sun_sensor",
+                                   "shutter_automation", bus=cache)
+            rule.setHysteresis(*defaultHysteresis, shutters=hysteresis)
+            return rule
+        ser = createRule()
+        ser.run(161, 30, True, 1000)
+        assert cache.getState(prefix_sunlit + "shutter_kitchen") == sunlitStateFalse
+        # update of the sun sensor received by the StateCacheRule
+        cache.update("sun_sensor", "70000")
+        ser.run(161, 30, True, 1000)
+        assert cache.getState(prefix_sunlit + "shutter_kitchen") == sunlitStateTrue
+        assert cache.getState(prefix_sunlit + "shutter_living") == sunlitStateFalse
+
+        # the dwell time is kept in the StateCache when the rule is recreated by a reload
+        ser = createRule()
+        ser.run(60, 30, True, 1300)
+        assert cache.getState(prefix_sunlit + "shutter_kitchen") == sunlitStateTrue
+        ser.run(60, 30, True, 1700)
+        assert cache.getState(prefix_sunlit + "shutter_kitchen") == sunlitStateFalse
+
+    # the timeline includes the margin, so the timed transitions aren't kept back by it
+    def timelineMarginTest(self):
+        shutterName = "shutter_living"
+        exposure = {shutterName: SunExposure(Yaml().load("{orientation: 240, sun_openings: [{azimuth: 160, above: [{elevation: 5}]}, {azimuth: 330}]}"))}
+        engine = SolarEngine((46.0, 8.8))
+        day = datetime.date(2017, 6, 21)
+        plain = computeSunlitTimelines(exposure, engine, day)[shutterName]
+        timelines = computeSunlitTimelines(exposure, engine, day, {shutterName: 2})
+        start, end = timelines[shutterName].intervals[0]
+        assert start > plain.intervals[0][0] + 60 and end > plain.intervals[0][1] + 60
+
+        bus = SimulatedItemBus({prefix_auto + shutterName: autoStateSun, prefix_sunlit + shutterName: sunlitStateFalse,
+                                "weather_sunny": "ON", "shutter_automation": "ON"})
+        ser = SunExposureRule(exposure, "astro_sun_azimuth", "astro_sun_elevation", "weather_sunny", "shutter_automation", bus=bus)
+        ser.setHysteresis(2)
+        ser.setTimelines(timelines)
+        # as fired by the SunlitTransitionRule
+        for t, sunlitState in [(math.ceil(start), sunlitStateTrue), (math.ceil(end), sunlitStateFalse)]:
+            azimuth, elevation = engine.positionAt(t)
+            ser.run(azimuth, elevation, True, t)
+            assert bus.getState(prefix_sunlit + shutterName) == sunlitState
+
+    def shardTest(self):
+        exposure = createSunExposures(Yaml().load("""
+            south_1: {orientation: 180, sun_openings: [{azimuth: 100}, {azimuth: 200}]}
+            south_2: {orientation: 180, sun_openings: [{azimuth: 150}, {azimuth: 260}]}
+            south_3: {orientation: 180, sun_openings: [{azimuth: 265}, {azimuth: 270}]}
+            north: {orientation: 0, sun_openings: [{azimuth: 30}, {azimuth: 60}]}
+            """), {})
+        shards = createSunExposureShards(exposure, 2)
+        assert shards == [("0:30-60", ["north"], (28, 62)),
+                          ("180:100-260", ["south_1", "south_2"], (98, 262)),
+                          ("180:265-270", ["south_3"], (263, 272))]
+
+        states = {"weather_sunny": "ON", "shutter_automation": "ON"}
+        for shutterName in exposure:
+            states[prefix_auto + shutterName] = autoStateSun
+            states[prefix_sunlit + shutterName] = sunlitStateFalse
+        bus = SimulatedItemBus(states)
+        rules = []
+        for shardName, shutterNames, reachable in shards:
+            rule = SunExposureRule(dict((name, exposure[name]) for name in shutterNames), "astro_sun_azimuth",
+                                   "astro_sun_elevation", "weather_sunny", "shutter_automation", bus=bus, shardName=shardName)
+            rule.setReachableRange(reachable)
+            rules.append(rule)
+        assert rules[1].getName() == module_name + ":SunExposureRule:180:100-260"
+        assert [rule.isAwake(120) for rule in rules] == [False, True, False]
+
+        # the shard stays awake until its shutters are opened again
+        rules[0].run(45, 20, True, 1000)
+        assert bus.getState(prefix_sunlit + "north") == sunlitStateTrue
+        assert rules[0].isAwake(120)
+        rules[0].run(120, 20, True, 1100)
+        assert bus.getState(prefix_sunlit + "north") == sunlitStateFalse
+        assert not rules[0].isAwake(120)
+
+    def cronDispatcherTest(self):
+        global activeScheduleRules
+        bus = SimulatedItemBus({prefix_auto + "shutter_living": autoStateSun, prefix_auto + "shutter_kids": autoStateSun,
+                                "shutter_automation": "ON", "kids_asleep": "OFF"})
+        close = ShutterScheduleRule(autoStateDown, ["shutter_living"], "close", "shutter_automation", bus=bus, cronDispatched=True)
+        close.addCronTrigger("0 0 22")
+        kids = ShutterScheduleRule(autoStateDown, ["shutter_kids"], "kids", "shutter_automation", bus=bus, cronDispatched=True)
+        kids.addCronTrigger("0 0 22")
+        kids.addCronTrigger("0 30 20")
+        kids.addItemStateCondition({'item_name': "kids_asleep", 'operator': "=", 'state': "ON"})
+        assert len(close.triggerList) == 0
+
+        dispatcher = CronDispatcher(bus)
+        start = time.mktime((2025, 6, 2, 20, 0, 0, 0, 0, -1))
+        dispatcher.clock = lambda: start
+        dispatcher.schedule([close, kids])
+        assert [due for due, index in dispatcher.timeline] == [(start + 1800) * 1000, (start + 7200) * 1000]
+        assert dispatcher.takeDue(start + 1799) == []
+        assert dispatcher.takeDue(start + 1800) == [kids]
+        # both rules in one wakeup; the same rule only once after missed times
+        assert dispatcher.takeDue(start + 7200) == [close, kids]
+        assert dispatcher.takeDue(start + 86400 + 7200) == [kids, close]
+        assert [due for due, index in dispatcher.timeline] == [(start + 2 * 86400 + 1800) * 1000, (start + 2 * 86400 + 7200) * 1000]
+
+        previous = activeScheduleRules
+        try:
+            activeScheduleRules = frozenset(["close", "kids"])
+            dispatcher.fire([close, kids])
+            assert bus.getState(prefix_auto + "shutter_living") == autoStateDown
+            assert bus.getState(prefix_auto + "shutter_kids") == autoStateSun
+        finally:
+            activeScheduleRules = previous
+
+    def replayTest(self):
+        import tempfile
+        import shutil
+        for value in ["1748858700", "1748858700000", "2025-06-02T10:05:00Z", "2025-06-02 12:05:00+02:00", "2025-06-02T05:05:00-0500"]:
+            assert parseEventTime(value) == 1748858700
+        assert parseEventTime("2025-06-02T10:05:00.25Z") == 1748858700.25
+        assert parseEventTime("2025-06-02 12:05:00") == time.mktime((2025, 6, 2, 12, 5, 0, 0, 0, -1))
+        directory = tempfile.mkdtemp()
+        try:
+            files = {
+                'shutters.yml': """
+                    items: { azimuth: azimuth, elevation: elevation, weather_sunny: sunny, shutter_automation: auto }
+                    sun_exposure:
+                      shutter_living: { orientation: 240, sun_openings: [ { azimuth: 160 }, { azimuth: 330 } ] }
+                    """,
+                'schedule.yml': """
+                    calendar:
+                      - { cron: "? * * *", daily_schedule: everyday }
+                    daily_schedules:
+                      everyday: [ open, sun ]
+                    rules:
+                      open: { triggers: [ { cron: '0 0 7' } ], action: UP, items: [ shutter_living ] }
+                      sun: { triggers: [ { channel_event: { channel: 'astro:sun:local:rise#event', event: START } } ], action: SUN, items: [ shutter_living ] }
+                    """,
+                'events.csv': "time,item,state\n"
+                              "2025-06-02 06:00:00,auto,ON\n"
+                              "2025-06-02 06:00:00,sunny,OFF\n"
+                              "2025-06-02 06:00:00,state_auto_shutter_living,DOWN\n"
+                              "2025-06-02 06:00:00,state_sunlit_shutter_living,False\n"
+                              "2025-06-02 06:00:00,shutter_living,100\n"
+                              "2025-06-02 07:30:00,astro:sun:local:rise#event,START\n"
+                              "2025-06-02 07:30:00,elevation,20\n"
+                              "2025-06-02 07:30:00,azimuth,150\n"
+                              "2025-06-02 12:00:00,azimuth,170\n"
+                              "yesterday,azimuth,170\n"
+                              "2025-06-02 12:03:00,sunny,ON\n"
+                              "2025-06-02 12:05:00,azimuth,170\n",
+            }
+            for name in files:
+                out = open(os.path.join(directory, name), 'w')
+                out.write(files[name])
+                out.close()
+            replay = EventReplay(os.path.join(directory, 'shutters.yml'), os.path.join(directory, 'schedule.yml'))
+            commands = [(time.strftime("%H:%M", time.localtime(t)), itemName, command)
+                        for t, itemName, command in replay.replay(readEvents(os.path.join(directory, 'events.csv')))]
+            # the unchanged azimuth at 12:05 is evaluated again, now that it is sunny
+            assert commands == [("07:00", "shutter_living", "UP"), ("12:05", "shutter_living", "STOP")]
+        finally:
+            shutil.rmtree(directory)
+
+    # the simulator applies the hysteresis settings and suppresses redundant commands
+    def simulatorTest(self):
+        import tempfile
+        import shutil
+        directory = tempfile.mkdtemp()
+        try:
+            files = {
+                'shutters.yml': """
+                    items: { azimuth: azimuth, elevation: elevation, weather_sunny: sunny, shutter_automation: auto }
+                    sun_exposure:
+                      shutter_living: { orientation: 240, sun_openings: [ { azimuth: 160 }, { azimuth: 330 } ], sunlit_margin: 3 }
+                    settings:
+                      location: { latitude: 46.0, longitude: 8.8 }
+                      sunlit_min_dwell: 600
+                    """,
+                'schedule.yml': """
+                    calendar:
+                      - { cron: "? * * *", daily_schedule: everyday }
+                    daily_schedules:
+                      everyday: [ close, close_again ]
+                    rules:
+                      close: { triggers: [ { cron: '0 0 21' } ], action: DOWN, items: [ shutter_living ] }
+                      close_again: { triggers: [ { cron: '0 0 22' } ], action: DOWN, items: [ shutter_living ] }
+                    """,
+            }
+            for name in files:
+                out = open(os.path.join(directory, name), 'w')
+                out.write(files[name])
+                out.close()
+            simulator = ShadingSimulator(2017, os.path.join(directory, 'shutters.yml'), os.path.join(directory, 'schedule.yml'))
+            assert simulator.sunExposureRule.getHysteresis("shutter_living") == (3, 600, None)
+            simulator.simulateDay(datetime.date(2017, 6, 21))
+            simulator.simulateDay(datetime.date(2017, 6, 22))
+            # the second DOWN of each day is suppressed
+            assert simulator.report["shutter_living"]['commandsByType']['DOWN'] == 2
+        finally:
+            shutil.rmtree(directory)
+
     def run(self):
         self.logger.info("TEST start")
         try:
             self.sunExposureRuleTest()
             self.shutterScheduleRuleTest()
+            self.stateCacheTest()
+            self.commandSuppressionTest()
+            self.commandDispatcherTest()
+            self.commandFailureTest()
+            self.hysteresisTest()
+            self.timelineMarginTest()
+            self.shardTest()
+            self.cronDispatcherTest()
+            self.replayTest()
+            self.simulatorTest()
         except Exception as e:
             self.logger.error(traceback.format_exc())
 
@@ -819,11 +3527,15 @@ class RulesTest():
 # Calendar
 
 class Rules():
-    def __init__(self, config, items):
+    def __init__(self, config, items, bus=None, previous=None, cronDispatched=False):
         self.logger = LoggerFactory.getLogger(logger_name + ".Rules")
         self.config = config
         self.items = items
+        self.bus = bus
+        self.previous = previous
+        self.cronDispatched = cronDispatched
         self.rules = {}
+        self.signatures = {}
         self.parseRules()
 
     def getRule(self, ruleName):
@@ -832,9 +3544,18 @@ class Rules():
     def parseRules(self):
         for rule_name in self.config:
             config = self.config[rule_name]
+            signature = str(config) + "|" + str(self.items['shutter_automation']) + "|" + str(self.cronDispatched)
+            self.signatures[rule_name] = signature
+            if self.previous != None and self.previous.signatures.get(rule_name) == signature:
+                # unchanged: keep the (possibly registered) rule
+                self.rules[rule_name] = self.previous.rules[rule_name]
+                continue
             forced = config.get('forced')
             if forced == None:
                 forced = False
+            desc = config.get('desc')
+            if desc == None:
+                desc = ""
             self.logger.info("Parser: found rule: " + rule_name + ("(forced)" if forced else ""))
             trigger_configs = config['triggers']
             condition_configs = config.get('conditions')
@@ -847,12 +3568,14 @@ class Rules():
                                        actionItems,
                                        rule_name,
                                        self.items['shutter_automation'],
-                                       config['desc'],
-                                       forced=forced
+                                       desc,
+                                       forced=forced,
+                                       bus=self.bus,
+                                       cronDispatched=self.cronDispatched
                                        );
             for triggerConfig in trigger_configs:
                 self.logger.debug("Trigger_Config: " + str(triggerConfig))
-                triggerType = triggerConfig.keys()
+                triggerType = list(triggerConfig.keys())
                 if len(triggerType) > 0:
                     triggerType = triggerType[0]                 
                     if triggerType == 'channel_event':
@@ -864,7 +3587,7 @@ class Rules():
                         self.logger.error("Unknown trigger type: " + str(triggerType))                    
             for conditionConfig in condition_configs:
                 self.logger.debug("Condition Config: " + str(conditionConfig))
-                conditionType = conditionConfig.keys()
+                conditionType = list(conditionConfig.keys())
                 if len(conditionType) > 0:
                     conditionType = conditionType[0]                   
                     if conditionType == "item_state":
@@ -896,15 +3619,28 @@ class DailySchedules():
                 rules.append(self.rules.getRule(ruleName))
             self.schedules[scheduleName] = rules
 
+    # the rules of all daily schedules
+    def getScheduledRules(self):
+        rules = OrderedDict()
+        for scheduleName in sorted(self.schedules):
+            for rule in self.schedules[scheduleName]:
+                rules[rule.ruleName] = rule
+        return list(rules.values())
+
 class Calendar():
     def __init__(self, config, schedules):
         self.logger = LoggerFactory.getLogger(logger_name + ".Calendar")
         self.config = config
         self.schedules = schedules
-
-    def getDailyScheduleName(self):
-        self.scheduleName = None
-        now = Date()
+        self.entries = []
+        self.index = {}
+        self.firstDay = None
+        self.lastDay = None
+        self.parseCalendar()
+        self.compile()
+
+    def parseCalendar(self):
+        df = DateFormat.getDateInstance(DateFormat.SHORT, Locale.GERMAN)
         for calendarItem in self.config:
             self.logger.info("Parser: found calendar item: " + str(calendarItem))
             # check if daily schedule exists:
@@ -915,54 +3651,183 @@ class Calendar():
                 raise e
 
             if calendarItem.get('cron') != None:
-                cronExpression = "* * * " + calendarItem.get('cron')
-                self.logger.debug(cronExpression)
-                self.logger.debug(str(now))
-                if CronExpression(cronExpression).isSatisfiedBy(now):
-                    # don't break we want to test the config
-                    if self.scheduleName == None:
-                        self.scheduleName = calendarItem['daily_schedule']
+                cronExpression = CronExpression("* * * " + calendarItem.get('cron'))
+                self.entries.append((cronExpression, None, None, calendarItem['daily_schedule']))
             else: # has to be timerange
-                df = DateFormat.getDateInstance(DateFormat.SHORT, Locale.GERMAN)
                 fromDate = df.parse(calendarItem['timerange']['from'])
                 toDate = df.parse(calendarItem['timerange']['to'])
-                self.logger.debug(calendarItem['timerange']['from'])
-                self.logger.debug(str(fromDate))
-                self.logger.debug(calendarItem['timerange']['to'])
-                self.logger.debug(str(toDate))
-                self.logger.debug(str(now))
-                if now.before(toDate) and now.after(fromDate):
-                    # don't break we want to test the config
-                    if self.scheduleName == None:
-                        self.scheduleName = calendarItem['daily_schedule']
-
-        if self.scheduleName == None:
-            self.logger.warn("Todays daily schedule: " + str(self.scheduleName))
+                self.entries.append((None, fromDate, toDate, calendarItem['daily_schedule']))
+
+    def _match(self, now):
+        for cronExpression, fromDate, toDate, scheduleName in self.entries:
+            if cronExpression != None:
+                if cronExpression.isSatisfiedBy(now):
+                    return scheduleName
+            elif now.before(toDate) and now.after(fromDate):
+                return scheduleName
+        return None
+
+    # day -> daily schedule name for the current and the next year
+    def compile(self, year=None):
+        if year == None:
+            year = datetime.date.today().year
+        self.index = {}
+        self.firstDay = datetime.date(year, 1, 1).toordinal()
+        self.lastDay = datetime.date(year + 2, 1, 1).toordinal() - 1
+        key = snapshotKey("calendar", str(self.config) + "|" + str(year))
+        cached = configSnapshot.get(key) if configSnapshot != None else None
+        if cached != None and len(cached) == self.lastDay - self.firstDay + 1:
+            for i in range(len(cached)):
+                self.index[self.firstDay + i] = cached[i]
+            self.logger.info("Calendar loaded from snapshot")
+            return
+        for ordinal in range(self.firstDay, self.lastDay + 1):
+            day = datetime.date.fromordinal(ordinal)
+            noon = Date(int((time.mktime(day.timetuple()) + 12 * 3600) * 1000))
+            self.index[ordinal] = self._match(noon)
+        if configSnapshot != None:
+            configSnapshot.put(key, [self.index[ordinal] for ordinal in range(self.firstDay, self.lastDay + 1)])
+        self.logger.info("Calendar compiled: " + str(self.lastDay - self.firstDay + 1) + " days")
+
+    def getRules(self):
+        return self.schedules.rules
+
+    def getScheduledRules(self):
+        return self.schedules.getScheduledRules()
+
+    def covers(self, day):
+        return self.firstDay <= day.toordinal() <= self.lastDay
+
+    def getDailyScheduleName(self, now=None):
+        if now == None:
+            day = datetime.date.today()
         else:
-            self.logger.info("todays daily schedule: " + str(self.scheduleName))
-        return self.scheduleName
+            day = datetime.date.fromtimestamp(now.getTime() / 1000.0)
+        if self.covers(day):
+            return self.index[day.toordinal()]
+        return self._match(now if now != None else Date())
 
-    def getTodaysRules(self):
-        return self.schedules.getSchedules(self.getDailyScheduleName())
+    def getTodaysRules(self, now=None):
+        return self.schedules.getSchedules(self.getDailyScheduleName(now))
 
     def loadTodaysRules(self):
-        rules = self.getTodaysRules()
-        self.logger.info("loading todays rules...")
-        for rule in rules:
-            automationManager.addRule(rule)
+        started = time.time()
+        if not self.covers(datetime.date.today()):
+            self.compile()
+        scheduleName = self.getDailyScheduleName()
+        if scheduleName == None:
+            self.logger.warn("Todays daily schedule: " + str(scheduleName))
+        else:
+            self.logger.info("todays daily schedule: " + str(scheduleName))
+        if ruleTimings.enabled:
+            ruleTimings.record("Calendar.loadTodaysRules", time.time() - started)
+        return self.schedules.getSchedules(scheduleName)
 
 
+#######################################################
+# Rule registry: keeps track of the rules added to the automation manager,
+# so that a reload only removes and adds the rules that changed.
+
+class RuleRegistry():
+    def __init__(self, manager=None):
+        self.logger = LoggerFactory.getLogger(logger_name + ".RuleRegistry")
+        self.manager = manager
+        # key -> (rule, uid)
+        self.rules = {}
+
+    def _getManager(self):
+        return self.manager if self.manager != None else automationManager
+
+    def get(self, key):
+        entry = self.rules.get(key)
+        return entry[0] if entry != None else None
+
+    def register(self, key, rule):
+        if key in self.rules:
+            self.unregister(key)
+        added = self._getManager().addRule(rule)
+        self.rules[key] = (rule, added.getUID() if added != None else None)
+
+    def unregister(self, key):
+        rule, uid = self.rules.pop(key)
+        if uid != None:
+            self._getManager().removeRule(uid)
+
+    def clear(self):
+        self._getManager().removeAll()
+        self.rules = {}
+
+    # desired: key -> rule; rules are compared by identity
+    def sync(self, desired):
+        removed = 0
+        added = 0
+        for key in list(self.rules):
+            if key not in desired or desired[key] is not self.rules[key][0]:
+                self.unregister(key)
+                removed += 1
+        for key in desired:
+            if key not in self.rules:
+                self.register(key, desired[key])
+                added += 1
+        self.logger.info("Rules: " + str(added) + " added, " + str(removed) + " removed, "
+                         + str(len(self.rules) - added) + " unchanged")
+        return (added, removed)
+
+#######################################################
+class RuleRegistryTest():
+    def __init__(self):
+        self.logger = LoggerFactory.getLogger(logger_name + ".RuleRegistryTest")
+
+    class Manager():
+        def __init__(self):
+            self.calls = []
+        def addRule(self, rule):
+            self.calls.append(("add", rule))
+            return None
+        def removeRule(self, uid):
+            self.calls.append(("remove", uid))
+        def removeAll(self):
+            self.calls.append(("removeAll", None))
+
+    def syncTest(self):
+        self.logger.info("syncTest")
+        manager = RuleRegistryTest.Manager()
+        registry = RuleRegistry(manager)
+        a = object()
+        b = object()
+        c = object()
+        assert registry.sync({"a": a, "b": b}) == (2, 0)
+        assert registry.sync({"a": a, "b": b}) == (0, 0)
+        assert registry.sync({"a": a, "b": c}) == (1, 1)
+        assert registry.sync({"b": c}) == (0, 1)
+        assert registry.get("b") is c
+        assert len([call for call in manager.calls if call[0] == "add"]) == 3
+
+    def run(self):
+        self.logger.info("TEST start")
+        try:
+            self.syncTest()
+        except Exception as e:
+            self.logger.error(traceback.format_exc())
+
+        self.logger.info("TEST end")
+
 #######################################################
 class DailyReloadRule(JythonSimpleRule):
     def __init__(self):
+        self.logger = LoggerFactory.getLogger(logger_name + ".DailyReloadRule")
         self.triggers = [cronTrigger("0 10 0 ? * * *", "reloadAtMidnight")]
         self.setName(module_name + ":DailyReloadRule")
         self.setDescription("Determines each day, which daily schedule to run.")
 
 
     def _execute(self, module, input):
-        automationManager.removeAll()
-        addAllRules()
+        activateTodaysSchedule()
+        setupSunlitTimeline(config.getSettings())
+        syncRules()
+        stats = itemStateCache.getWriteStats()
+        self.logger.info("State item updates: " + str(stats['writes']) + " written, " + str(stats['writesSaved']) + " saved")
+        ruleTimings.report()
 
 #######################################################
 class CalendarTest():
@@ -982,7 +3847,45 @@ class CalendarTest():
             - desc: "Workdays"
               cron: "? * 2-6 *"
               daily_schedule: workday
-        """), schedules).getDailyScheduleName()
+        """), schedules)
+        assert calendar.getDailyScheduleName() in ("weekend", "workday")
+
+        calendar.compile(2017)
+        df = DateFormat.getDateInstance(DateFormat.SHORT, Locale.GERMAN)
+        assert calendar.getDailyScheduleName(df.parse("11.06.2017")) == "weekend"
+        assert calendar.getDailyScheduleName(df.parse("12.06.2017")) == "vacation"
+        assert calendar.getDailyScheduleName(df.parse("15.08.2017")) == "vacation"
+        assert calendar.getDailyScheduleName(df.parse("16.08.2017")) == "workday"
+        assert calendar.getDailyScheduleName(df.parse("19.08.2017")) == "weekend"
+        # outside of the index
+        assert calendar.getDailyScheduleName(df.parse("19.08.2020")) == "workday"
+
+    def scheduleSwitchTest(self, schedules):
+        self.logger.info("scheduleSwitchTest")
+        global activeScheduleRules
+        rules = schedules.getScheduledRules()
+        assert sorted([rule.ruleName for rule in rules]) == ["kids_evening", "kids_open"]
+
+        # rules not in the active daily schedule are registered but do nothing
+        shutterName = "shutter_living"
+        bus = SimulatedItemBus({prefix_auto + shutterName: autoStateSun, prefix_sunlit + shutterName: sunlitStateFalse,
+                                "shutter_automation": "ON"})
+        rule = ShutterScheduleRule(autoStateManual, [shutterName], "kids_evening", "shutter_automation", bus=bus)
+        labels = (('rule', rule.getName()),)
+        executions = metrics.get('shutters_rule_executions_total', labels)
+        previous = activeScheduleRules
+        try:
+            activeScheduleRules = frozenset(["kids_open"])
+            rule.execute(None, {})
+            assert bus.getState(prefix_auto + shutterName) == autoStateSun
+            # not counted as an execution
+            assert metrics.get('shutters_rule_executions_total', labels) == executions
+            activeScheduleRules = frozenset([r.ruleName for r in schedules.getSchedules("weekend")])
+            rule.execute(None, {})
+            assert bus.getState(prefix_auto + shutterName) == autoStateManual
+            assert metrics.get('shutters_rule_executions_total', labels) == executions + 1
+        finally:
+            activeScheduleRules = previous
 
     def dailySchedulesTest(self, rules):
         self.logger.info("dailySchedulesTest")
@@ -1024,6 +3927,7 @@ class CalendarTest():
             rules = self.rulesTest()
             schedules = self.dailySchedulesTest(rules)
             self.calendarTest(schedules)
+            self.scheduleSwitchTest(schedules)
 
         except Exception as e:
             self.logger.error(traceback.format_exc())
@@ -1044,87 +3948,795 @@ class MiscTest():
         assert CronExpression("* * * ? * SAT,SUN *").isSatisfiedBy(dateFormat.parse("30.07.2017"))
         assert CronExpression("* * * ? * SAT,SUN *").isSatisfiedBy(dateFormat.parse("03.09.2017"))
 
+    def ruleTimingsTest(self):
+        self.logger.info("ruleTimingsTest")
+        timings = RuleTimings()
+        for i in range(100):
+            timings.record("rule", i / 1000.0)
+        percentiles = timings.percentiles("rule")
+        assert percentiles[50] == 0.05 and percentiles[99] == 0.099 and percentiles[100] == 0.099
+        assert timings.phases("rule") is nullPhaseTimer
+
+        timings.enabled = True
+        phases = timings.phases("rule")
+        phases.phase("state")
+        phases.phase("geometry")
+        phases.stop()
+        assert len(timings.samples["rule:state"]) == 1 and len(timings.samples["rule:geometry"]) == 1
+
+        done = []
+        timings.startProfiling(2, lambda: done.append(True))
+        for i in range(3):
+            assert timings.run("rule", lambda x: x + 1, i) == i + 1
+        assert done == [True] and timings.profileExecutions == 0
+
+    def metricsTest(self):
+        self.logger.info("metricsTest")
+        m = Metrics()
+        m.inc('shutters_commands_total', (('shutter', 'shutter_kitchen'), ('action', 'DOWN')))
+        m.inc('shutters_commands_total', (('shutter', 'shutter_kitchen'), ('action', 'DOWN')))
+        m.observe('shutters_rule_duration_seconds', 0.02, (('rule', 'shutters:SunExposureRule'),))
+        m.observe('shutters_rule_duration_seconds', 60, (('rule', 'shutters:SunExposureRule'),))
+        m.collectors.append(lambda: [('shutters_state_updates_saved_total', (), 7)])
+        assert m.get('shutters_commands_total', (('shutter', 'shutter_kitchen'), ('action', 'DOWN'))) == 2
+        text = m.render()
+        assert '# TYPE shutters_commands_total counter' in text
+        assert 'shutters_commands_total{shutter="shutter_kitchen",action="DOWN"} 2' in text
+        assert 'shutters_rule_duration_seconds_bucket{rule="shutters:SunExposureRule",le="0.01"} 0' in text
+        assert 'shutters_rule_duration_seconds_bucket{rule="shutters:SunExposureRule",le="0.025"} 1' in text
+        assert 'shutters_rule_duration_seconds_bucket{rule="shutters:SunExposureRule",le="+Inf"} 2' in text
+        assert 'shutters_rule_duration_seconds_count{rule="shutters:SunExposureRule"} 2' in text
+        assert 'shutters_state_updates_saved_total 7' in text
+
+    # the command latency is observed by the dispatcher of a real rule execution
+    def commandLatencyMetricsTest(self):
+        self.logger.info("commandLatencyMetricsTest")
+        global activeScheduleRules
+        def latencyCount():
+            found = re.search(r'^shutters_command_latency_seconds_count (\d+)$', metrics.render(), re.M)
+            return int(found.group(1)) if found != None else 0
+        before = latencyCount()
+        dispatcher = CommandDispatcher({}, SimulatedItemBus({"shutter_automation": "ON"}))
+        cache = StateCache(dispatcher)
+        cache.track(["shutter_kitchen"], ["shutter_automation"])
+        rule = ShutterScheduleRule(autoStateDown, ["shutter_kitchen"], "latencyTest", "shutter_automation", bus=cache)
+        previous = activeScheduleRules
+        try:
+            activeScheduleRules = frozenset(["latencyTest"])
+            rule.execute(None, {})
+            dispatcher.join()
+        finally:
+            activeScheduleRules = previous
+            dispatcher.stop()
+        assert latencyCount() == before + 1 and latencyCount() > 0
+
     def run(self):
         self.logger.info("TEST start")
         try:
             self.cronTest()
+            self.ruleTimingsTest()
+            self.commandLatencyMetricsTest()
+            self.metricsTest()
         except Exception as e:
             self.logger.error(traceback.format_exc())
   
         self.logger.info("TEST end")
     
+#######################################################
+#######################################################
+#######################################################
+# Simulator: sweeps a whole year through the sun exposure models and the
+# rules, using simulated items.
+
+# astro channel events: (elevation, rising) at START and END
+astroEvents = {
+    'astroDawn': ((-18, True), (-12, True)),
+    'nauticDawn': ((-12, True), (-6, True)),
+    'civilDawn': ((-6, True), (-0.833, True)),
+    'rise': ((-0.833, True), (-0.833, True)),
+    'set': ((-0.833, False), (-0.833, False)),
+    'civilDusk': ((-0.833, False), (-6, False)),
+    'nauticDusk': ((-6, False), (-12, False)),
+    'astroDusk': ((-12, False), (-18, False)),
+}
+
+def itemStateConditionsMet(conditions, bus):
+    for condition in conditions:
+        state = bus.getState(condition['item_name'])
+        expected = str(condition['state'])
+        operator = condition['operator']
+        if operator == '=':
+            met = state == expected
+        elif operator == '!=':
+            met = state != expected
+        else:
+            try:
+                value = float(state)
+                expected = float(expected)
+            except ValueError:
+                return False
+            met = {'>': value > expected, '<': value < expected,
+                   '>=': value >= expected, '<=': value <= expected}.get(operator, False)
+        if not met:
+            return False
+    return True
+
+class ShadingSimulator():
+    def __init__(self, year, shuttersFileName=None, scheduleFileName=None, sunny=True, itemStates=None):
+        self.logger = LoggerFactory.getLogger(logger_name + ".ShadingSimulator")
+        self.year = year
+        self.config = Config(shuttersFileName, scheduleFileName)
+        settings = self.config.getSettings()
+        items = self.config.getItems()
+        location = getLocation(settings)
+        if location == None:
+            raise Exception("Simulator: no location configured")
+        self.engine = SolarEngine(location, 2)
+        self.now = 0
+        exposure = createSunExposures(self.config.getSunExposure(), settings)
+        self.shutters = set(exposure)
+        for rule in self.config.getRules().values():
+            self.shutters.update(rule['items'])
+        states = {items['weather_sunny']: "ON" if sunny else "OFF",
+                  items['shutter_automation']: "ON"}
+        for shutterName in self.shutters:
+            states[prefix_auto + shutterName] = autoStateDown
+            states[prefix_sunlit + shutterName] = sunlitStateFalse
+        # hysteresis, dwell time and sunny thresholds as configured
+        defaultHysteresis, hysteresis = getHysteresisSettings(settings, self.config.getSunExposure())
+        sunnyThresholds = [h[2] for h in [defaultHysteresis] + list(hysteresis.values()) if h[2] != None]
+        if len(sunnyThresholds) > 0:
+            # e.g. a sun sensor
+            states[items['weather_sunny']] = str(max([on for on, off in sunnyThresholds])) if sunny else "0"
+        if itemStates != None:
+            states.update(itemStates)
+        self.simulatedBus = SimulatedItemBus(states, self._commandSent)
+        # redundant commands are suppressed like in the live system
+        self.bus = StateCache(self.simulatedBus)
+        self.bus.clock = lambda: self.now
+        resendInterval = settings.get('command_resend_interval')
+        self.bus.resendInterval = resendInterval if resendInterval != None else defaultCommandResendInterval
+        if len(sunnyThresholds) > 0:
+            self.bus.track(self.shutters, [items['shutter_automation']], [items['weather_sunny']])
+        else:
+            self.bus.track(self.shutters, [items['weather_sunny'], items['shutter_automation']])
+        self.sunExposureRule = SunExposureRule(exposure, items['azimuth'], items['elevation'],
+                                               items['weather_sunny'], items['shutter_automation'], bus=self.bus)
+        self.sunExposureRule.setHysteresis(*defaultHysteresis, shutters=hysteresis)
+        self.calendar = Calendar(self.config.getCalendar(),
+                                 DailySchedules(self.config.getDailySchedules(),
+                                                Rules(self.config.getRules(), items, self.bus)))
+        self.day = None
+        self.report = {}
+        for shutterName in self.shutters:
+            self.report[shutterName] = {'sunlitMinutes': 0, 'commands': 0, 'commandsByType': {},
+                                        'transitions': 0, 'maxTransitionsPerDay': 0}
+        self.dailyTransitions = {}
+        self.ignoredChannels = set()
+
+    def _commandSent(self, itemName, command):
+        # the rollershutter reports the position it moved to
+        position = commandPositions.get(command, command if command.isdigit() else None)
+        if position != None:
+            self.bus.update(itemName, position)
+        report = self.report.get(itemName)
+        if report == None:
+            return
+        report['commands'] += 1
+        report['commandsByType'][command] = report['commandsByType'].get(command, 0) + 1
+
+    def _cronTimes(self, schedule, start, end):
+        times = []
+        cron = CronExpression(schedule + " ? * * *")
+        t = cron.getNextValidTimeAfter(Date(int((start - 1) * 1000)))
+        while t != None and t.getTime() / 1000.0 < end:
+            times.append(t.getTime() / 1000.0)
+            t = cron.getNextValidTimeAfter(t)
+        return times
+
+    def _channelEventTime(self, day, channelUID, event):
+        name = channelUID.split(':')[-1].split('#')[0]
+        if not channelUID.startswith('astro:sun:') or name not in astroEvents or event not in ('START', 'END'):
+            if channelUID not in self.ignoredChannels:
+                self.logger.warn("Simulator: channel event not simulated: " + channelUID + " " + event)
+                self.ignoredChannels.add(channelUID)
+            return None
+        elevation, rising = astroEvents[name][0 if event == 'START' else 1]
+        return self.engine.findCrossing(day, elevation, rising)
+
+    def _sunlitStates(self):
+        states = {}
+        for shutterName in self.sunExposureRule.exposure:
+            states[shutterName] = self.bus.getState(prefix_sunlit + shutterName)
+        return states
+
+    def simulateDay(self, day):
+        start, end = getDayBounds(day)
+        exposure = self.sunExposureRule.exposure
+        timelines = computeSunlitTimelines(exposure, self.engine, day,
+                                           dict((name, self.sunExposureRule.getHysteresis(name)[0]) for name in exposure))
+        self.sunExposureRule.setTimelines(timelines)
+        # (time, order, rule): rules before sun exposure at the same time
+        timeline = []
+        for shutterName in timelines:
+            self.report[shutterName]['sunlitMinutes'] += sum([i[1] - i[0] for i in timelines[shutterName].intervals]) / 60.0
+            for transition in timelines[shutterName].getTransitions():
+                timeline.append((transition, 1, None))
+        noon = Date(int((start + 12 * 3600) * 1000))
+        for rule in self.calendar.getTodaysRules(noon):
+            for schedule in rule.cronSchedules:
+                for t in self._cronTimes(schedule, start, end):
+                    timeline.append((t, 0, rule))
+            for channelUID, event in rule.channelEvents:
+                t = self._channelEventTime(day, channelUID, event)
+                if t != None:
+                    timeline.append((t, 0, rule))
+        timeline.sort(key=lambda e: (e[0], e[1]))
+        transitions = dict([(shutterName, 0) for shutterName in timelines])
+        for t, order, rule in timeline:
+            self.now = t
+            before = self._sunlitStates()
+            if rule != None and itemStateConditionsMet(rule.itemStateConditions, self.bus):
+                rule.run(True)
+                self.bus.flush()
+            # the sun exposure rule also runs right after a schedule rule (next tick in openHAB)
+            azimuth, elevation = self.engine.positionAt(t)
+            self.sunExposureRule.run(azimuth, elevation, True, t)
+            self.bus.flush()
+            after = self._sunlitStates()
+            for shutterName in after:
+                if after[shutterName] != before[shutterName]:
+                    transitions[shutterName] += 1
+        for shutterName in transitions:
+            report = self.report[shutterName]
+            report['transitions'] += transitions[shutterName]
+            report['maxTransitionsPerDay'] = max(report['maxTransitionsPerDay'], transitions[shutterName])
+
+    def run(self):
+        started = time.time()
+        day = datetime.date(self.year, 1, 1)
+        days = 0
+        while day.year == self.year:
+            self.simulateDay(day)
+            day += datetime.timedelta(days=1)
+            days += 1
+        for shutterName in sorted(self.report):
+            report = self.report[shutterName]
+            report['transitionsPerDay'] = report['transitions'] / float(days)
+            self.logger.info(shutterName + ": sunlit: " + str(int(report['sunlitMinutes'])) + " min"
+                             + "; commands: " + str(report['commands']) + " " + str(report['commandsByType'])
+                             + "; transitions/day: " + ("%.2f" % report['transitionsPerDay'])
+                             + " (max " + str(report['maxTransitionsPerDay']) + ")")
+        self.logger.info("Simulated " + str(days) + " days in " + ("%.1f" % (time.time() - started)) + "s")
+        return self.report
+
+#######################################################
+#######################################################
+#######################################################
+# Replay: streams recorded item updates (e.g. exported from the persistence) through
+# the rules and yields the commands they send. Events are read one at a time, so
+# months of history replay in constant memory.
+
+# fractions of a second and the zone after "2025-06-01 12:00:00": "Z", "+02:00", "+0200"
+eventTimeSuffix = re.compile(r"^(\.\d+)?(Z|([+-])(\d\d):?(\d\d))?$")
+
+# epoch seconds or milliseconds, or a time as stored by the persistence ("2025-06-01 12:00:00",
+# optionally with 'T', fractions of a second and a zone). Times without a zone are local.
+def parseEventTime(value):
+    try:
+        t = float(value)
+        return t / 1000.0 if t > 1e11 else t
+    except ValueError:
+        pass
+    value = str(value).strip().replace('T', ' ')
+    suffix = eventTimeSuffix.match(value[19:])
+    if suffix == None:
+        raise ValueError("Unknown time format: " + value)
+    fraction = float('0' + suffix.group(1)) if suffix.group(1) != None else 0
+    if suffix.group(2) == None:
+        return time.mktime(time.strptime(value[:19], "%Y-%m-%d %H:%M:%S")) + fraction
+    offset = 0
+    if suffix.group(3) != None:
+        offset = (int(suffix.group(4)) * 3600 + int(suffix.group(5)) * 60) * (1 if suffix.group(3) == '+' else -1)
+    utc = datetime.datetime.strptime(value[:19], "%Y-%m-%d %H:%M:%S") - datetime.datetime(1970, 1, 1)
+    return utc.days * 86400 + utc.seconds - offset + fraction
+
+# yields (time, item name or channel UID, state) from a csv ("time,item,state") or
+# jsonl ({"time": ..., "item": ..., "state": ...}) file; lines that don't parse are skipped
+# and counted
+def readEvents(fileName):
+    logger = LoggerFactory.getLogger(logger_name + ".readEvents")
+    jsonLines = fileName.endswith('.jsonl') or fileName.endswith('.json')
+    last = None
+    skipped = 0
+    with open(fileName) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#') or (not jsonLines and line.startswith('time,')):
+                continue
+            try:
+                if jsonLines:
+                    record = json.loads(line)
+                    event = (parseEventTime(record['time']), str(record['item']), str(record['state']))
+                else:
+                    fields = [field.strip().strip('"') for field in line.split(',', 2)]
+                    event = (parseEventTime(fields[0]), fields[1], fields[2])
+            except (ValueError, KeyError, IndexError):
+                if skipped == 0:
+                    logger.warn("Skipping line: " + line)
+                skipped += 1
+                continue
+            if last != None and event[0] < last:
+                logger.warn("Events not in chronological order at " + line)
+            last = event[0]
+            yield event
+    if skipped > 0:
+        logger.warn(str(skipped) + " lines of " + fileName + " skipped")
+
+class EventReplay():
+    def __init__(self, shuttersFileName=None, scheduleFileName=None):
+        self.logger = LoggerFactory.getLogger(logger_name + ".EventReplay")
+        self.config = Config(shuttersFileName, scheduleFileName)
+        settings = self.config.getSettings()
+        self.items = self.config.getItems()
+        self.now = 0
+        # commands sent since the last event: [(time, item, command)]
+        self.sent = []
+        self.simulatedBus = SimulatedItemBus(commandListener=lambda itemName, command: self.sent.append((self.now, itemName, command)))
+        # redundant commands are suppressed like in the live system
+        self.bus = StateCache(self.simulatedBus)
+        self.bus.clock = lambda: self.now
+        resendInterval = settings.get('command_resend_interval')
+        self.bus.resendInterval = resendInterval if resendInterval != None else defaultCommandResendInterval
+        self.sunExposureRule = SunExposureRule(createSunExposures(self.config.getSunExposure(), settings), self.items['azimuth'],
+                                               self.items['elevation'], self.items['weather_sunny'],
+                                               self.items['shutter_automation'], bus=self.bus)
+        defaultHysteresis, hysteresis = getHysteresisSettings(settings, self.config.getSunExposure())
+        self.sunExposureRule.setHysteresis(*defaultHysteresis, shutters=hysteresis)
+        self.calendar = Calendar(self.config.getCalendar(),
+                                 DailySchedules(self.config.getDailySchedules(),
+                                                Rules(self.config.getRules(), self.items, self.bus, cronDispatched=True)))
+        self.rules = self.calendar.getScheduledRules()
+        shutters = set(self.sunExposureRule.exposure)
+        for rule in self.rules:
+            shutters.update(rule.items)
+        if self.sunExposureRule.getSunnyThresholds() != set([None]):
+            self.bus.track(shutters, [self.items['shutter_automation']], [self.items['weather_sunny']])
+        else:
+            self.bus.track(shutters, [self.items['weather_sunny'], self.items['shutter_automation']])
+        self.cron = CronDispatcher(self.bus)
+        self.activeDay = None
+        self.activeRules = frozenset()
+
+    # the daily schedule is switched at 00:10 (DailyReloadRule)
+    def _isActive(self, rule, t):
+        day = datetime.date.fromtimestamp(t - 600).toordinal()
+        if day != self.activeDay:
+            self.activeDay = day
+            self.activeRules = frozenset([r.ruleName for r in self.calendar.getTodaysRules(Date(int((t - 600) * 1000)))])
+        return rule.ruleName in self.activeRules
+
+    def _runRule(self, rule, t):
+        if self._isActive(rule, t) and itemStateConditionsMet(rule.itemStateConditions, self.bus):
+            rule.run(self.bus.isOn(self.items['shutter_automation']))
+            self.bus.flush()
+
+    def _update(self, t, itemName, state):
+        if ':' in itemName:
+            # channel event, e.g. astro:sun:local:set#event START
+            for rule in self.rules:
+                if (itemName, state) in rule.channelEvents:
+                    self._runRule(rule, t)
+            return
+        self.simulatedBus.postUpdate(itemName, state)
+        self.bus.update(itemName, state)
+        # like the item state trigger of the live rule: every update, changed or not
+        if itemName == self.items['azimuth']:
+            try:
+                azimuth = float(state)
+                elevation = float(self.bus.getState(self.items['elevation']))
+            except ValueError:
+                return
+            self.sunExposureRule.run(azimuth, elevation, self.bus.isOn(self.items['shutter_automation']), t)
+            self.bus.flush()
+
+    # events: iterable of (time, item, state); yields (time, item, command)
+    def replay(self, events):
+        started = None
+        for t, itemName, state in events:
+            if started == None:
+                started = t
+                self.cron.clock = lambda: started
+                self.cron.schedule(self.rules)
+            # cron schedules due before the event, one instant at a time
+            while len(self.cron.timeline) > 0 and self.cron.timeline[0][0] <= t * 1000:
+                due = self.cron.timeline[0][0] / 1000.0
+                self.now = due
+                for rule in self.cron.takeDue(due):
+                    self._runRule(rule, due)
+                for command in self.sent:
+                    yield command
+                self.sent = []
+            self.now = t
+            self._update(t, itemName, state)
+            for command in self.sent:
+                yield command
+            self.sent = []
+
+#######################################################
+#######################################################
+#######################################################
+# Benchmarks: ns/op (and bytes/op on the JVM) of the hot paths, compared
+# against a stored baseline. The geometry benchmarks don't need openHAB.
+
+benchmarkExposureConfig = """
+    orientation: 240
+    sun_openings:
+      - azimuth: 160
+        below:
+          - { azimuth: 240, elevation: 60 }
+        above:
+          - { elevation: 5 }
+      - azimuth: 240
+        below:
+          - { azimuth: 240, elevation: 60 }
+          - { azimuth: 280, elevation: 10 }
+        above:
+          - { azimuth: 240, elevation: 3 }
+      - azimuth: 280
+        below:
+          - { azimuth: 280, elevation: 60, angle: 35 }
+        above:
+          - { azimuth: 240, elevation: 3 }
+      - azimuth: 330
+    """
+
+benchmarkRulesConfig = """
+    kids_evening:
+        desc: "kids evening"
+        triggers:
+          - cron: '0 30 19'
+        action: MANUAL
+        items:
+          - shutter_living
+    kids_open:
+        desc: "kids open"
+        triggers:
+          - cron: '0 30 20'
+          - channel_event: {channel: 'astro:sun:local:nauticDusk#event', event: 'START'}
+        conditions:
+          - item_state: {item_name: 'condition_item', operator: '=', state: 'ON'}
+        action: SUN
+        items:
+          - shutter_living
+    """
+
+benchmarkSchedulesConfig = """
+    weekend:
+      - kids_evening
+      - kids_open
+    workday:
+      - kids_open
+    vacation:
+      - kids_open
+    """
+
+benchmarkCalendarConfig = """
+    - desc: "Sommerferien"
+      timerange: {from: "12.06.2017", to: "16.08.2017" }
+      daily_schedule: vacation
+    - desc: "Weekend"
+      cron: "? * 7,1 *"
+      daily_schedule: weekend
+    - desc: "Workdays"
+      cron: "? * 2-6 *"
+      daily_schedule: workday
+    """
+
+# bytes allocated by the current thread (JVM only), None if not available
+def allocatedBytesCounter():
+    try:
+        from java.lang import Thread as JavaThread
+        from java.lang.management import ManagementFactory
+        bean = ManagementFactory.getThreadMXBean()
+        if not bean.isThreadAllocatedMemorySupported():
+            return None
+        bean.setThreadAllocatedMemoryEnabled(True)
+        return lambda: bean.getThreadAllocatedBytes(JavaThread.currentThread().getId())
+    except ImportError:
+        return None
+
+class Benchmark():
+    def __init__(self, baselineFile=None, minTime=0.2, tolerance=1.25):
+        self.logger = LoggerFactory.getLogger(logger_name + ".Benchmark")
+        self.baselineFile = baselineFile or benchmarkBaselineFile
+        self.minTime = minTime
+        self.tolerance = tolerance
+        self.allocatedBytes = allocatedBytesCounter()
+        self.results = {}
+
+    def measure(self, name, function, arguments):
+        # calibrate the number of calls so that a run takes at least minTime
+        n = len(arguments)
+        while True:
+            started = time.time()
+            for i in range(n):
+                function(arguments[i % len(arguments)])
+            elapsed = time.time() - started
+            if elapsed >= self.minTime or n >= 10000000:
+                break
+            n *= 10 if elapsed < self.minTime / 10 else 2
+        # best of three to reduce the noise
+        for repeat in range(2):
+            started = time.time()
+            for i in range(n):
+                function(arguments[i % len(arguments)])
+            elapsed = min(elapsed, time.time() - started)
+        allocated = None
+        if self.allocatedBytes != None:
+            before = self.allocatedBytes()
+            for i in range(n):
+                function(arguments[i % len(arguments)])
+            allocated = (self.allocatedBytes() - before) / float(n)
+        result = {'ns_per_op': elapsed * 1e9 / n, 'bytes_per_op': allocated}
+        self.results[name] = result
+        self.logger.info(name + ": " + ("%.0f" % result['ns_per_op']) + " ns/op"
+                         + ("" if allocated == None else "; " + ("%.0f" % allocated) + " bytes/op"))
+        return result
+
+    def geometryBenchmarks(self):
+        exposure = SunExposure(Yaml().load(benchmarkExposureConfig), 1)
+        exact = SunExposure(Yaml().load(benchmarkExposureConfig), 0)
+        horizon = exposure.getObstacle(160, 'above')
+        hline = exposure.getObstacle(160, 'below')
+        line = exposure.getObstacle(240, 'below')
+        azimuths = [100 + 0.37 * i for i in range(700)]
+        positions = [(a, (a * 7.3) % 100 - 10) for a in azimuths]
+        self.measure("Horizon.getElevationAtAzimuth", horizon.getElevationAtAzimuth, azimuths)
+        self.measure("HLine.getElevationAtAzimuth", hline.getElevationAtAzimuth, azimuths)
+        self.measure("Line.getElevationAtAzimuth", line.getElevationAtAzimuth, azimuths)
+        self.measure("SunExposure.isSunlit", lambda p: exposure.isSunlit(p[0], p[1]), positions)
+        self.measure("SunExposure.isSunlit(exact)", lambda p: exact.isSunlit(p[0], p[1]), positions)
+        batchAzimuths = [p[0] for p in positions]
+        batchElevations = [p[1] for p in positions]
+        self.measure("SunExposure.isSunlitBatch(700)",
+                              lambda p: exposure.isSunlitBatch(batchAzimuths, batchElevations), [None])
+        engine = SolarEngine((46.0, 8.8))
+        self.measure("sunPosition", engine.position, [1498044300 + 600 * i for i in range(144)])
+
+    def openhabBenchmarks(self):
+        items = {'shutter_automation': 'shutter_automation'}
+        rulesConfig = Yaml().load(benchmarkRulesConfig)
+        rules = Rules(rulesConfig, items)
+        schedules = DailySchedules(Yaml().load(benchmarkSchedulesConfig), rules)
+        calendar = Calendar(Yaml().load(benchmarkCalendarConfig), schedules)
+        self.measure("Calendar.getDailyScheduleName", lambda d: calendar.getDailyScheduleName(), [None])
+        self.measure("Calendar.compile", lambda d: calendar.compile(), [None])
+        self.measure("Rules.parseRules", lambda d: Rules(rulesConfig, items), [None])
+        if os.path.isfile(shuttersFile) and os.path.isfile(scheduleFile):
+            self.measure("Config.__init__", lambda d: Config(), [None])
+
+    def loadBaseline(self):
+        if not os.path.isfile(self.baselineFile):
+            return None
+        return json.load(open(self.baselineFile))
+
+    def saveBaseline(self):
+        out = open(self.baselineFile, 'w')
+        json.dump(self.results, out, indent=2, sort_keys=True)
+        out.close()
+        self.logger.info("Baseline saved: " + self.baselineFile)
+
+    # returns the names of the benchmarks that got slower than the baseline
+    def compare(self, baseline):
+        regressions = []
+        for name in sorted(self.results):
+            if name not in baseline:
+                continue
+            ratio = self.results[name]['ns_per_op'] / baseline[name]['ns_per_op']
+            if ratio > self.tolerance:
+                regressions.append(name)
+                self.logger.warn("Regression: " + name + ": " + ("%.2f" % ratio) + "x baseline")
+            else:
+                self.logger.info(name + ": " + ("%.2f" % ratio) + "x baseline")
+        return regressions
+
+    def run(self, geometryOnly=False, updateBaseline=False):
+        self.logger.info("BENCHMARK start")
+        self.geometryBenchmarks()
+        if not geometryOnly:
+            self.openhabBenchmarks()
+        baseline = self.loadBaseline()
+        regressions = []
+        if baseline != None:
+            regressions = self.compare(baseline)
+        if baseline == None or updateBaseline:
+            self.saveBaseline()
+        self.logger.info("BENCHMARK end")
+        return regressions
+
 #######################################################
 #######################################################
 #######################################################
 #fileWatcher
 
-automationDirPath = FileSystems.getDefault().getPath(automationDir)
-configFileWatcher = FileSystems.getDefault().newWatchService()
-configFileWatcherKey = automationDirPath.register(configFileWatcher, StandardWatchEventKinds.ENTRY_MODIFY);
+configFileWatcher = None
+configFileWatcherKeys = []
+
+# seconds without further changes before the config is reloaded
+defaultConfigQuietPeriod = 2.0
+
+def getChangedConfigFiles(key):
+    changed = set()
+    directory = str(key.watchable())
+    for event in key.pollEvents():
+        filename = str(event.context())
+        if directory == str(fragmentsDir):
+            if filename.endswith('.yml') or filename.endswith('.yaml'):
+                changed.add(fragmentsDirName + '/' + filename)
+        elif filename == shuttersFileName or filename == scheduleFileName or filename.endswith('.csv'):
+            changed.add(filename)
+    key.reset()
+    return changed
 
 def fileWatcher():
     logger = LoggerFactory.getLogger(logger_name + ".fileWatcher")
     logger.info("Start watching config files")
     try:
         while True:
-            key = configFileWatcher.take()
-            logger.info("configFileWatcher got key")
-            for event in key.pollEvents():
-                filename = event.context()
-                logger.debug(filename)
-                if str(filename) == shuttersFileName or str(filename) == scheduleFileName:
-                    logger.info("File " + str(filename) + " changed. Reloading config")
-                    try:
-                        restart()
-                    except Exception as e:
-                        logger.error("Failed reloading rules.")
-                        logger.error(traceback.format_exc())
-            key.reset()
+            changed = getChangedConfigFiles(configFileWatcher.take())
+            # editors write in several steps: wait until the files are quiet
+            quietPeriod = defaultConfigQuietPeriod
+            if config != None and config.getSettings().get('config_quiet_period') != None:
+                quietPeriod = float(config.getSettings()['config_quiet_period'])
+            while True:
+                key = configFileWatcher.poll(int(quietPeriod * 1000), TimeUnit.MILLISECONDS)
+                if key == None:
+                    break
+                changed.update(getChangedConfigFiles(key))
+            if len(changed) == 0:
+                continue
+            logger.info("Files " + ", ".join(sorted(changed)) + " changed. Reloading config")
+            try:
+                Config().validate()
+            except Exception as e:
+                metrics.inc('shutters_config_reloads_total', (('result', 'invalid'),))
+                logger.error("Config not reloaded: " + str(e))
+                continue
+            try:
+                restart()
+            except Exception as e:
+                metrics.inc('shutters_config_reloads_total', (('result', 'failed'),))
+                logger.error("Failed reloading rules.")
+                logger.error(traceback.format_exc())
     except InterruptedException:
         logger.info("Stop Watching")
-        Thread.currentThread().interrupt()
 
 #http://www.jython.org/jythonbook/en/1.0/Concurrency.html
 fileWatcherThread = Thread(target=lambda: fileWatcher())
 
+def startFileWatcher():
+    global configFileWatcher
+    global configFileWatcherKeys
+    fileSystem = FileSystems.getDefault()
+    configFileWatcher = fileSystem.newWatchService()
+    kinds = [StandardWatchEventKinds.ENTRY_MODIFY, StandardWatchEventKinds.ENTRY_CREATE]
+    configFileWatcherKeys = [fileSystem.getPath(automationDir).register(configFileWatcher, kinds)]
+    if os.path.isdir(fragmentsDir):
+        configFileWatcherKeys.append(fileSystem.getPath(fragmentsDir).register(configFileWatcher,
+                                     kinds + [StandardWatchEventKinds.ENTRY_DELETE]))
+    fileWatcherThread.start()
+
 #######################################################
 #######################################################
 #######################################################
 # __main__
 
-def addAllRules():
-    for rule in globalRules:
-        automationManager.addRule(rule)
-    calendar.loadTodaysRules()
+def syncRules():
+    rules = {
+        "StateCacheRule": stateCacheRule,
+        "DailyReloadRule": dailyReloadRule,
+    }
+    rules.update(sunExposureRules)
+    if sunlitTransitionRule != None:
+        rules["SunlitTransitionRule"] = sunlitTransitionRule
+    if profilerRule != None:
+        rules["ProfilerRule"] = profilerRule
+    if metricsRule != None:
+        rules["MetricsRule"] = metricsRule
+    for rule in calendar.getScheduledRules():
+        # rules with cron schedules only are executed by the cron dispatcher
+        if len(rule.triggerList) > 0:
+            rules["ShutterScheduleRule:" + rule.ruleName] = rule
+    ruleRegistry.sync(rules)
+
+def activateTodaysSchedule():
+    global activeScheduleRules
+    rules = calendar.loadTodaysRules()
+    activeScheduleRules = frozenset([rule.ruleName for rule in rules])
+    if cronDispatcher != None:
+        cronDispatcher.schedule(rules)
 
 def runTests():
         #MiscTest().run()
         ShutterTest().run()
+        #SunPositionTest().run()
         #RulesTest().run()
         #CalendarTest().run()
+        #RuleRegistryTest().run()
+        #ConfigTest().run()
         pass
  
+def runBenchmarks(geometryOnly=False, updateBaseline=False):
+    return Benchmark().run(geometryOnly, updateBaseline)
+
+def runSimulation(year=None):
+    if year == None:
+        year = datetime.date.today().year
+    return ShadingSimulator(year).run()
+
+# logs the commands the rules send for the recorded events in fileName, returns their number
+def runReplay(fileName):
+    logger = LoggerFactory.getLogger(logger_name + ".runReplay")
+    commands = 0
+    for t, itemName, command in EventReplay().replay(readEvents(fileName)):
+        logger.info(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)) + " " + itemName + " " + command)
+        commands += 1
+    return commands
+
+# (re)loads the config; rules that did not change stay registered
 def load():
     global config
     global calendar
-    global globalRules
-
-    globalRules = []
-    config = Config()
-
-    initStateItems()
-
-    setupSunExposureRule(config.getSunExposure(), config.getItems())
-
+    global ruleRegistry
+    global dailyReloadRule
+    global configSnapshot
+
+    started = time.time()
+    if configSnapshot == None:
+        configSnapshot = ConfigSnapshot(configSnapshotFile)
+    newConfig = Config(snapshot=configSnapshot)
+    newConfig.validate()
+    previousRules = calendar.getRules() if calendar != None else None
+    config = newConfig
+    setupProfiling(config.getSettings())
+    setupMetrics(config.getSettings())
+    phases = ruleTimings.phases("load")
+
+    phases.phase("state items")
+    setupStateCache(config)
+    initStateItems(bus=itemStateCache)
+    itemStateCache.flush()
+
+    phases.phase("sun exposure")
+    clearObstacleCache()
+    setupSunExposureRule(config.getSunExposure(), config.getItems(), config.getSettings())
+    setupSolarEngine(config.getSettings())
+    setupSunlitTimeline(config.getSettings())
+
+    phases.phase("rules")
+    setupCronDispatcher(config.getSettings())
     calendar = Calendar(config.getCalendar(),
                         DailySchedules(config.getDailySchedules(),
                                        Rules(config.getRules(),
-                                             config.getItems())))
-    globalRules.append(DailyReloadRule())
-    addAllRules()
+                                             config.getItems(),
+                                             bus=itemStateCache,
+                                             previous=previousRules,
+                                             cronDispatched=cronDispatcher != None)))
+    if ruleRegistry == None:
+        ruleRegistry = RuleRegistry()
+    if dailyReloadRule == None:
+        dailyReloadRule = DailyReloadRule()
+    phases.phase("sync")
+    activateTodaysSchedule()
+    syncRules()
+    configSnapshot.save()
+    phases.stop()
+    metrics.inc('shutters_config_reloads_total', (('result', 'ok'),))
+    if ruleTimings.enabled:
+        ruleTimings.record("load", time.time() - started)
 
 def restart():
-    automationManager.removeAll()
     load()
 
 #######################################################
@@ -1132,7 +4744,7 @@ def restart():
 
 def scriptLoaded(id):
     try:
-        fileWatcherThread.start()
+        startFileWatcher()
         #runTests()
 
         load()
@@ -1148,5 +4760,13 @@ def scriptLoaded(id):
 
 def scriptUnloaded():
     fileWatcherThread.interrupt()
-    configFileWatcherKey.cancel()
+    if commandDispatcher != None:
+        commandDispatcher.stop()
+    if cronDispatcher != None:
+        cronDispatcher.stop()
+    if metricsServer != None:
+        metricsServer.shutdown()
+        metricsServer.server_close()
+    for key in configFileWatcherKeys:
+        key.cancel()
 